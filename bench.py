@@ -0,0 +1,4 @@
+import sys
+import src.bench as bench
+
+sys.exit(1 if bench.run() else 0)
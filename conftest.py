@@ -0,0 +1,2 @@
+# Makes the repository root importable, so the tests import `src` when the
+# suite is run with a bare `pytest` as well as with `python -m pytest`.
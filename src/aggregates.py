@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from .schema import TEXT
+
+# aggregate tables of the report, by the columns they group its rows by,
+# internet_allowed compares assessments taken online with offline ones
+TABLES = {
+    "subjects": ["subject_id"],
+    "trainings": ["training_id"],
+    "users": ["user_id"],
+    "modes": ["mode"],
+    "internet_allowed": ["internet_allowed"],
+}
+
+# percentiles of the marks in every group
+PERCENTILES = [25, 50, 75, 90]
+
+# columns of the report rows the tables are built from
+COLUMNS = ["user_id", "training_id", "subject_id", "mode", "internet_allowed"]
+
+# dtypes of the counts, to read saved counts back with
+DTYPES = {
+    "user_id": TEXT,
+    "training_id": TEXT,
+    "subject_id": TEXT,
+    "mode": TEXT,
+    "internet_allowed": "bool",
+    "marks": "int64",
+    "count": "int64",
+    "passed": "int64",
+}
+
+
+class Aggregates:
+    """Counts of the report rows by group and marks, for every table.
+
+    Counts merge by addition, so the tables are built in the same pass as the
+    report, chunk by chunk, and rows can be removed again by subtracting their
+    counts. Marks are integers, the counts per mark are a histogram of each
+    group, from which mean and percentiles are exact."""
+
+    def __init__(self):
+        self.counts = {table: None for table in TABLES}
+
+    def add(self, rows, sign=1):
+        """Count `rows`, with the `COLUMNS`, marks and is_passed, or uncount them
+        when `sign` is -1."""
+        for table, keys in TABLES.items():
+            counts = rows.groupby(keys + ["marks"], observed=True, dropna=False).agg(
+                count=("is_passed", "size"), passed=("is_passed", "sum")
+            )
+            counts = counts.astype("int64") * sign
+
+            if self.counts[table] is not None:
+                counts = self.counts[table].add(counts, fill_value=0).astype("int64")
+            self.counts[table] = counts[counts["count"] != 0]
+
+    def remove(self, rows):
+        """Uncount `rows` counted before."""
+        self.add(rows, sign=-1)
+
+    def table(self, table):
+        """Return the `table` aggregates: count, passed, pass_rate, mean_marks and
+        the marks percentiles of every group."""
+        keys = TABLES[table]
+        columns = keys + ["count", "passed", "pass_rate", "mean_marks"]
+        columns += [f"p{percentile}_marks" for percentile in PERCENTILES]
+        if self.counts[table] is None or self.counts[table].empty:
+            return pd.DataFrame(columns=columns)
+
+        counts = self.counts[table].reset_index().sort_values(keys + ["marks"])
+        groups = counts.groupby(keys, observed=True, dropna=False, sort=True)
+        counts["cumulative"] = groups["count"].cumsum()
+        counts["total"] = groups["count"].transform("sum")
+        counts["marks_sum"] = counts["marks"] * counts["count"]
+
+        summary = counts.groupby(keys, observed=True, dropna=False, sort=True).agg(
+            count=("count", "sum"),
+            passed=("passed", "sum"),
+            marks_sum=("marks_sum", "sum"),
+        )
+        summary["pass_rate"] = summary["passed"] / summary["count"]
+        summary["mean_marks"] = summary["marks_sum"] / summary["count"]
+
+        # nearest-rank percentiles, the first marks whose cumulative count
+        # reaches the rank
+        for percentile in PERCENTILES:
+            rank = np.maximum(np.ceil(percentile / 100 * counts["total"]), 1)
+            reached = counts[counts["cumulative"] >= rank]
+            summary[f"p{percentile}_marks"] = reached.groupby(
+                keys, observed=True, dropna=False, sort=True
+            )["marks"].first()
+
+        return summary.reset_index()[columns]
+
+    def tables(self):
+        """Return every table by name."""
+        return {table: self.table(table) for table in TABLES}
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import sys
+import time
+from . import cache, fake, metrics, prep, rejects, report, stage
+from .metrics import peak_rss, reset_peak_rss
+from .logger import create_logger
+from .references import ReferenceIndex
+
+logger = create_logger("bench")
+
+
+# options to configure the benchmark
+class Options:
+    # assessments generated per dataset, users, subjects and trainings are
+    # generated in proportion
+    scales = [10_000, 1_000_000, 10_000_000]
+    parent_ratio = 0.1
+    # unclean_percentage of the generated datasets
+    unclean_percentages = [0, 10]
+    seed = 0
+    workers = 1
+    work_dir = "out/bench"
+    results_file = "out/bench/results.json"
+    # results to compare against, written with the results of this run when
+    # `update_baseline` is set
+    baseline_file = "bench/baseline.json"
+    update_baseline = False
+    # relative drop of rows per second, or growth of peak RSS, flagged as a
+    # regression
+    tolerance = 0.2
+
+
+options = Options()
+
+
+def measure(steps, name, rows, function, *args):
+    """Run `function`, recording its time and peak RSS in `steps`, returns its result."""
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+
+    steps[name] = {
+        "rows": rows,
+        "seconds": round(seconds, 6),
+        "rows_per_second": round(rows / seconds, 1),
+        "peak_rss": peak_rss(),
+    }
+    return result
+
+
+def generate(scale, unclean_percentage, input_dir):
+    parents = max(int(scale * options.parent_ratio), 1)
+
+    fake.options.bulk = True
+    fake.options.seed = options.seed
+    fake.options.reference_time = "2025-01-01"
+    fake.options.workers = options.workers
+    fake.options.unclean_percentage = unclean_percentage
+    fake.options.user_count = parents
+    fake.options.subject_count = parents
+    fake.options.training_count = parents
+    fake.options.assessment_count = scale
+    fake.options.out_dir = input_dir
+    fake.run()
+
+
+def bench_dataset(scale, unclean_percentage):
+    """Benchmark stage, prep and report on one generated dataset."""
+    # nothing recorded for the previous dataset is kept in memory or counted again
+    rejects.reset()
+    metrics.reset()
+
+    dataset_dir = os.path.join(options.work_dir, f"{scale}-{unclean_percentage}")
+    input_dir = os.path.join(dataset_dir, "input")
+    generate(scale, unclean_percentage, input_dir)
+
+    stage.options.input_dir = input_dir
+    stage.options.stage_dir = os.path.join(dataset_dir, "stage")
+    prep.options.stage_folder = stage.options.stage_dir
+    prep.options.stage_format = stage.options.stage_format
+
+    input_rows = (
+        fake.options.user_count
+        + fake.options.subject_count
+        + fake.options.training_count
+        + fake.options.assessment_count
+    )
+
+    steps = {}
+    measure(steps, "stage.run", input_rows, stage.run)
+
+    users, subjects, trainings, assessments = prep.load_stage_outputs()
+    users = measure(steps, "prep.clean_users", len(users), prep.clean_users, users)
+    subjects = measure(
+        steps, "prep.clean_subjects", len(subjects), prep.clean_subjects, subjects
+    )
+    trainings = measure(
+        steps,
+        "prep.clean_trainings",
+        len(trainings),
+        prep.clean_trainings,
+        trainings,
+        ReferenceIndex(subjects=subjects),
+    )
+    assessments = measure(
+        steps,
+        "prep.clean_assessments",
+        len(assessments),
+        prep.clean_assessments,
+        assessments,
+        ReferenceIndex(users, subjects, trainings),
+    )
+    measure(
+        steps,
+        "report.generate_report",
+        len(assessments),
+        report.generate_report,
+        users,
+        subjects,
+        trainings,
+        assessments,
+    )
+
+    return {
+        "scale": scale,
+        "unclean_percentage": unclean_percentage,
+        "steps": steps,
+    }
+
+
+def compare(results, baseline):
+    """List the steps slower, or using more memory, than in `baseline`."""
+    baseline_runs = {
+        (run["scale"], run["unclean_percentage"]): run["steps"]
+        for run in baseline["runs"]
+    }
+
+    regressions = []
+    for run in results["runs"]:
+        baseline_steps = baseline_runs.get((run["scale"], run["unclean_percentage"]))
+        if baseline_steps is None:
+            continue
+
+        for name, step in run["steps"].items():
+            baseline_step = baseline_steps.get(name)
+            if baseline_step is None:
+                continue
+
+            for metric, expected, value in [
+                (
+                    "rows_per_second",
+                    baseline_step["rows_per_second"] * (1 - options.tolerance),
+                    step["rows_per_second"],
+                ),
+                (
+                    "peak_rss",
+                    baseline_step["peak_rss"] * (1 + options.tolerance),
+                    step["peak_rss"],
+                ),
+            ]:
+                worse = value < expected if metric == "rows_per_second" else value > expected
+                if worse:
+                    regressions.append(
+                        {
+                            "scale": run["scale"],
+                            "unclean_percentage": run["unclean_percentage"],
+                            "step": name,
+                            "metric": metric,
+                            "baseline": baseline_step[metric],
+                            "value": value,
+                        }
+                    )
+
+    return regressions
+
+
+def write_json(data, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(data, file, indent=2)
+
+
+def run():
+    """Run the benchmark, returns the regressions against the baseline."""
+
+    # only the benchmark's own progress is logged
+    for name in ["fake", "stage", "prep", "report"]:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    cache.options.enabled = False
+
+    results = {"runs": []}
+    for scale in options.scales:
+        for unclean_percentage in options.unclean_percentages:
+            logger.info(
+                f"benchmarking {scale} assessments, "
+                f"unclean_percentage '{unclean_percentage}'..."
+            )
+            results["runs"].append(bench_dataset(scale, unclean_percentage))
+
+    results["regressions"] = []
+    if os.path.exists(options.baseline_file):
+        with open(options.baseline_file) as file:
+            results["regressions"] = compare(results, json.load(file))
+
+    write_json(results, options.results_file)
+    if options.update_baseline:
+        write_json({"runs": results["runs"]}, options.baseline_file)
+
+    for regression in results["regressions"]:
+        logger.warning(
+            f"regression in {regression['step']} at {regression['scale']} "
+            f"assessments, unclean_percentage '{regression['unclean_percentage']}': "
+            f"{regression['metric']} {regression['value']}, "
+            f"baseline {regression['baseline']}"
+        )
+
+    logger.info(f"benchmark results written to '{options.results_file}'")
+    return results["regressions"]
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
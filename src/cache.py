@@ -0,0 +1,115 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+
+# options to configure the stage cache
+class Options:
+    # skip work whose input files, code and options did not change since it last ran
+    enabled = True
+    manifest_file = "out/cache.json"
+
+
+options = Options()
+
+# guards the manifest, entities are staged from several threads
+lock = threading.Lock()
+
+# digests of files already hashed, by path, modification time and size
+file_digests = {}
+
+
+def restart_in_child():
+    # a fork copies the lock as it is, held when another thread had it, a
+    # forked worker gets its own
+    global lock
+    lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_in_child)
+
+
+def file_digest(path):
+    """Digest of a file's content, or of every file in a directory."""
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "*")))
+
+    stats = tuple((p, os.stat(p).st_mtime_ns, os.stat(p).st_size) for p in paths)
+    if stats in file_digests:
+        return file_digests[stats]
+
+    digest = hashlib.sha256()
+    for file_path in paths:
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+
+    file_digests[stats] = digest.hexdigest()
+    return file_digests[stats]
+
+
+def code_version():
+    """Digest of the package source, any code change invalidates every entry."""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    source_paths = sorted(glob.glob(os.path.join(package_dir, "*.py")))
+    digests = [file_digest(path) for path in source_paths]
+
+    return hashlib.sha256("\0".join(digests).encode()).hexdigest()
+
+
+def cache_key(module_options, *input_paths):
+    """Key of work reading `input_paths` with `module_options`."""
+    settings = {
+        name: getattr(module_options, name)
+        for name in dir(module_options)
+        if not name.startswith("_")
+    }
+    parts = [code_version(), repr(sorted(settings.items()))]
+    parts += [file_digest(path) for path in input_paths]
+
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def load_manifest():
+    if not os.path.exists(options.manifest_file):
+        return {}
+
+    with open(options.manifest_file) as file:
+        return json.load(file)
+
+
+def is_fresh(entry, key, output_path):
+    """Whether `entry` last ran with `key` and its output still exists."""
+    if not options.enabled or not os.path.exists(output_path):
+        return False
+
+    with lock:
+        return load_manifest().get(entry) == key
+
+
+def record(entry, key):
+    """Record that `entry` ran with `key`."""
+    with lock:
+        manifest = load_manifest()
+        manifest[entry] = key
+
+        os.makedirs(os.path.dirname(options.manifest_file) or ".", exist_ok=True)
+        with open(options.manifest_file, "w") as file:
+            json.dump(manifest, file, indent=2)
+
+
+def forget(*entries):
+    """Drop `entries`, for outputs rewritten outside of the cache."""
+    with lock:
+        manifest = load_manifest()
+        if not any(entry in manifest for entry in entries):
+            return
+
+        for entry in entries:
+            manifest.pop(entry, None)
+        with open(options.manifest_file, "w") as file:
+            json.dump(manifest, file, indent=2)
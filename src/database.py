@@ -0,0 +1,481 @@
+import os
+import sqlite3
+import pandas as pd
+from . import schema
+from .validators import (
+    parse_booleans,
+    parse_datetimes,
+    parse_numbers,
+    validate_email,
+    validate_id,
+    validate_name,
+)
+
+
+# options to configure the embedded database backend
+class Options:
+    # SQLite database file, tables are bulk-loaded into it and queried from
+    # it, so sorts and joins larger than memory spill to disk
+    path = "out/pipeline.db"
+    # rows bulk-loaded per executemany and fetched per result chunk
+    batch_size = 100_000
+
+
+options = Options()
+
+
+def connect():
+    """Open the database, with the functions the prep rules call registered."""
+    os.makedirs(os.path.dirname(options.path) or ".", exist_ok=True)
+    connection = sqlite3.connect(options.path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA temp_store = FILE")
+
+    # the same validators as the pandas rules, so both backends accept
+    # exactly the same values
+    functions = {
+        "is_id": validate_id,
+        "is_email": validate_email,
+        "is_name": validate_name,
+        # sqlite only lowers ascii letters
+        "lower": lower,
+    }
+    for name, function in functions.items():
+        connection.create_function(name, 1, function, deterministic=True)
+
+    return connection
+
+
+def lower(value):
+    return None if value is None else value.lower()
+
+
+def sql_value(value):
+    """Convert a pandas value to a value sqlite stores, missing values to NULL."""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.value
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def load_table(connection, table, columns, chunks):
+    """Bulk-load `columns` of the DataFrame `chunks` into a new `table`, returns
+    its rows.
+
+    Rows are numbered in the `row` column, in their order in the chunks."""
+    connection.execute(f"DROP TABLE IF EXISTS {table}")
+    column_list = ", ".join(columns)
+    connection.execute(
+        f"CREATE TABLE {table} (row INTEGER PRIMARY KEY, {column_list})"
+    )
+
+    insert = (
+        f"INSERT INTO {table} (row, {column_list}) "
+        f"VALUES ({', '.join(['?'] * (len(columns) + 1))})"
+    )
+    rows = 0
+    for chunk in chunks:
+        for start in range(0, len(chunk), options.batch_size):
+            batch = chunk.iloc[start : start + options.batch_size]
+            values = zip(*(batch[column].tolist() for column in columns))
+            connection.executemany(
+                insert,
+                (
+                    (rows + number, *map(sql_value, record))
+                    for number, record in enumerate(values)
+                ),
+            )
+            rows += len(batch)
+
+    connection.commit()
+    return rows
+
+
+# parsers of the staged text of every non-text prep dtype
+parsers = {
+    schema.DATETIME: parse_datetimes,
+    "int64": parse_numbers,
+    "bool": parse_booleans,
+}
+
+
+def parsed_columns(entity):
+    """Return the prep columns of `entity` parsed when staged rows are loaded."""
+    return [
+        column
+        for column, dtype in schema.prep_dtypes[entity].items()
+        if str(dtype) in parsers
+    ]
+
+
+def load_stage_table(connection, entity, chunks):
+    """Load the stripped staged `chunks` of `entity` into a table, returns its rows.
+
+    Datetimes, numbers and booleans are parsed by the pandas parsers while
+    loading, in a `<column>_value` column, so both backends read every value
+    the same way."""
+
+    def parse(chunk):
+        for column in parsed_columns(entity):
+            parse_values = parsers[str(schema.prep_dtypes[entity][column])]
+            chunk[f"{column}_value"] = parse_values(chunk[column])
+        return chunk
+
+    columns = list(schema.stage_dtypes(entity))
+    columns += [f"{column}_value" for column in parsed_columns(entity)]
+    return load_table(connection, f"stage_{entity}", columns, map(parse, chunks))
+
+
+def create_index(connection, table, *columns):
+    index = f"{table}_{'_'.join(columns)}"
+    connection.execute(
+        f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({', '.join(columns)})"
+    )
+
+
+def query_chunks(connection, query, parameters=(), chunk_size=None):
+    """Run `query`, returns its rows as DataFrames of `chunk_size` rows, or as one
+    DataFrame when it is None."""
+    cursor = connection.execute(query, parameters)
+    columns = [description[0] for description in cursor.description]
+
+    if chunk_size is None:
+        yield pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+        return
+
+    yielded = False
+    while rows := cursor.fetchmany(chunk_size):
+        yield pd.DataFrame.from_records(rows, columns=columns)
+        yielded = True
+
+    if not yielded:
+        yield pd.DataFrame(columns=columns)
+
+
+# The prep rules of every entity, in the order the pandas rules check them, a
+# row is discarded for the first one it matches
+def null_or_empty(required_columns, non_empty_columns):
+    checks = [f"{column} IS NULL" for column in required_columns]
+    checks += [f"{column} = ''" for column in non_empty_columns]
+    return " OR ".join(checks)
+
+
+def is_invalid(condition):
+    # a NULL condition, from a missing value or lookup, is a failed check
+    return f"NOT COALESCE({condition}, 0)"
+
+
+def later(column, earlier_column):
+    return f"{column}_value IS NULL OR {column}_value <= {earlier_column}_value"
+
+
+def one_of(values):
+    return ", ".join(f"'{value}'" for value in values)
+
+
+prep_rules = {
+    "users": {
+        "rules": [
+            (
+                "null or empty values",
+                null_or_empty(
+                    [
+                        "id",
+                        "email",
+                        "first_name",
+                        "middle_name",
+                        "last_name",
+                        "role",
+                        "created_at",
+                        "updated_at",
+                    ],
+                    ["id", "email", "first_name", "middle_name", "last_name", "role"],
+                ),
+            ),
+            ("invalid id", is_invalid("is_id(id)")),
+            ("invalid email", is_invalid("is_email(email)")),
+            ("invalid role", is_invalid(f"lower(role) IN ({one_of(schema.ROLES)})")),
+            ("invalid created_at", "created_at_value IS NULL"),
+            ("invalid updated_at", later("updated_at", "created_at")),
+        ],
+        "outputs": {
+            "id": "lower(id)",
+            "email": "email",
+            "first_name": "lower(first_name)",
+            "middle_name": "lower(middle_name)",
+            "last_name": "lower(last_name)",
+            "role": "lower(role)",
+            "created_at": "created_at_value",
+            "updated_at": "updated_at_value",
+        },
+    },
+    "subjects": {
+        "rules": [
+            (
+                "null or empty values",
+                null_or_empty(
+                    [
+                        "id",
+                        "name",
+                        "min_marks",
+                        "max_marks",
+                        "total_time",
+                        "created_at",
+                        "updated_at",
+                    ],
+                    ["id", "name"],
+                ),
+            ),
+            ("invalid id", is_invalid("is_id(id)")),
+            ("invalid name", is_invalid("is_name(name)")),
+            (
+                "invalid marks or total_time",
+                is_invalid(
+                    "min_marks_value >= 0 AND max_marks_value >= min_marks_value "
+                    "AND total_time_value >= 0"
+                ),
+            ),
+            ("invalid created_at", "created_at_value IS NULL"),
+            ("invalid updated_at", later("updated_at", "created_at")),
+        ],
+        "outputs": {
+            "id": "lower(id)",
+            "name": "name",
+            "min_marks": "CAST(min_marks_value AS INTEGER)",
+            "max_marks": "CAST(max_marks_value AS INTEGER)",
+            "total_time": "CAST(total_time_value AS INTEGER)",
+            "created_at": "created_at_value",
+            "updated_at": "updated_at_value",
+        },
+    },
+    "trainings": {
+        "rules": [
+            (
+                "null or empty values",
+                null_or_empty(
+                    [
+                        "id",
+                        "name",
+                        "mode",
+                        "subject_id",
+                        "started_at",
+                        "ended_at",
+                        "created_at",
+                        "updated_at",
+                    ],
+                    ["id", "name", "mode", "subject_id"],
+                ),
+            ),
+            ("invalid id", is_invalid("is_id(id)")),
+            ("invalid name", is_invalid("is_name(name)")),
+            ("invalid mode", is_invalid(f"lower(mode) IN ({one_of(schema.MODES)})")),
+            (
+                "invalid subject_id",
+                "NOT EXISTS (SELECT 1 FROM prep_subjects s WHERE s.id = subject_id)",
+            ),
+            ("invalid started_at", "started_at_value IS NULL"),
+            ("invalid ended_at", later("ended_at", "started_at")),
+            ("invalid created_at", "created_at_value IS NULL"),
+            ("invalid updated_at", later("updated_at", "created_at")),
+        ],
+        "outputs": {
+            "id": "lower(id)",
+            "name": "name",
+            "mode": "lower(mode)",
+            "subject_id": "subject_id",
+            "started_at": "started_at_value",
+            "ended_at": "ended_at_value",
+            "created_at": "created_at_value",
+            "updated_at": "updated_at_value",
+        },
+    },
+    "assessments": {
+        # the subject of the training, then its max_marks, each looked up once
+        # per row, the last record wins for duplicate ids as in the pandas
+        # lookups
+        "lookups": [
+            (
+                "training_subject_id",
+                "SELECT t.subject_id FROM prep_trainings t "
+                "WHERE t.id = training_id ORDER BY t.row DESC LIMIT 1",
+            ),
+            (
+                "subject_max_marks",
+                "SELECT s.max_marks FROM prep_subjects s "
+                "WHERE s.id = training_subject_id ORDER BY s.row DESC LIMIT 1",
+            ),
+        ],
+        "rules": [
+            (
+                "null or empty values",
+                null_or_empty(
+                    ["user_id", "training_id", "marks", "internet_allowed"],
+                    ["user_id", "training_id", "marks", "internet_allowed"],
+                ),
+            ),
+            (
+                "invalid user_id",
+                "NOT EXISTS (SELECT 1 FROM prep_users u WHERE u.id = user_id)",
+            ),
+            (
+                "invalid training_id",
+                "NOT EXISTS (SELECT 1 FROM prep_trainings t WHERE t.id = training_id)",
+            ),
+            (
+                "missing subject_id for",
+                "training_subject_id IS NULL OR training_subject_id = ''",
+            ),
+            (
+                "invalid marks",
+                is_invalid("marks_value >= 0 AND marks_value < subject_max_marks"),
+            ),
+            ("invalid internet_allowed value", "internet_allowed_value IS NULL"),
+        ],
+        "outputs": {
+            "user_id": "user_id",
+            "training_id": "training_id",
+            "marks": "CAST(marks_value AS INTEGER)",
+            "internet_allowed": "internet_allowed_value",
+        },
+    },
+}
+
+
+def check_table(connection, entity):
+    """Check the rows of `stage_<entity>` against the rules of `entity`.
+
+    Every row goes to `checked_<entity>` with the reason it is discarded for,
+    NULL when it is valid, and the valid rows to `prep_<entity>`, converted to
+    their prep values."""
+    rules = prep_rules[entity]
+
+    # every lookup is materialized, so it runs once per row however many
+    # rules use it
+    table = f"stage_{entity}"
+    lookups = []
+    for name, query in rules.get("lookups", []):
+        lookups.append(
+            f"{name}_lookup AS MATERIALIZED "
+            f"(SELECT *, ({query}) AS {name} FROM {table})"
+        )
+        table = f"{name}_lookup"
+    source = f"WITH {', '.join(lookups)} " if lookups else ""
+
+    reason = " ".join(
+        f"WHEN {condition} THEN '{name}'" for name, condition in rules["rules"]
+    )
+
+    connection.execute(f"DROP TABLE IF EXISTS checked_{entity}")
+    connection.execute(
+        f"CREATE TABLE checked_{entity} AS {source}"
+        f"SELECT *, CASE {reason} END AS reason FROM {table}"
+    )
+
+    outputs = ", ".join(f"{sql} AS {name}" for name, sql in rules["outputs"].items())
+    connection.execute(f"DROP TABLE IF EXISTS prep_{entity}")
+    connection.execute(
+        f"CREATE TABLE prep_{entity} AS SELECT row, {outputs} "
+        f"FROM checked_{entity} WHERE reason IS NULL ORDER BY row"
+    )
+    # foreign keys and lookups of the next entities go through the id index
+    if "id" in rules["outputs"]:
+        create_index(connection, f"prep_{entity}", "id", "row")
+    connection.commit()
+
+
+def prep_chunks(connection, entity, chunk_size=None):
+    """Return the cleaned rows of `entity` as DataFrames with the prep dtypes."""
+    dtypes = schema.prep_dtypes[entity]
+    chunks = query_chunks(
+        connection,
+        f"SELECT {', '.join(dtypes)} FROM prep_{entity} ORDER BY row",
+        chunk_size=chunk_size,
+    )
+    for chunk in chunks:
+        yield chunk.astype(dtypes)
+
+
+def discard_counts(connection, entity):
+    """Return the discarded rows of `entity` per reason, in rule order."""
+    counts = dict(
+        connection.execute(
+            f"SELECT reason, COUNT(*) FROM checked_{entity} "
+            "WHERE reason IS NOT NULL GROUP BY reason"
+        ).fetchall()
+    )
+    return {
+        reason: counts[reason]
+        for reason, _ in prep_rules[entity]["rules"]
+        if reason in counts
+    }
+
+
+def rejected_rows(connection, entity, chunk_size=None):
+    """Yield the discarded staged rows of `entity` by reason, in the order the
+    pandas rules reject them: chunk by chunk of `chunk_size` rows, then by rule.
+
+    The rows are fetched `options.batch_size` at a time, the rows of a reason
+    spanning two fetches are yielded in two parts."""
+    columns = list(schema.stage_dtypes(entity))
+    ranks = " ".join(
+        f"WHEN '{reason}' THEN {rank}"
+        for rank, (reason, _) in enumerate(prep_rules[entity]["rules"])
+    )
+    chunk = f"row / {int(chunk_size)}" if chunk_size else "0"
+    query = (
+        f"SELECT {chunk} AS chunk, CASE reason {ranks} END AS rank, reason, "
+        f"{', '.join(columns)} FROM checked_{entity} "
+        "WHERE reason IS NOT NULL ORDER BY chunk, rank, row"
+    )
+    for rejected in query_chunks(connection, query, chunk_size=options.batch_size):
+        for (_, _, reason), rows in rejected.groupby(
+            ["chunk", "rank", "reason"], sort=False
+        ):
+            yield reason, rows[columns]
+
+
+# Report joins, every assessment looks up its user, training and the subject
+# of the training, the last record wins for duplicate ids
+REPORT_QUERY = """
+SELECT
+    a.user_id AS user_id,
+    u.email AS email,
+    u.first_name AS first_name,
+    u.last_name AS last_name,
+    a.training_id AS training_id,
+    t.name AS name_x,
+    t.subject_id AS subject_id,
+    s.name AS name_y,
+    a.marks AS marks,
+    s.max_marks AS max_marks,
+    COALESCE(a.marks >= s.max_marks, 0) AS is_passed,
+    t.mode AS mode,
+    a.internet_allowed AS internet_allowed
+FROM report_assessments a
+LEFT JOIN report_users u ON u.row = (
+    SELECT MAX(row) FROM report_users WHERE id = a.user_id
+)
+LEFT JOIN report_trainings t ON t.row = (
+    SELECT MAX(row) FROM report_trainings WHERE id = a.training_id
+)
+LEFT JOIN report_subjects s ON s.row = (
+    SELECT MAX(row) FROM report_subjects WHERE id = t.subject_id
+)
+ORDER BY a.row
+"""
+
+
+def report_chunks(connection, chunk_size=None):
+    """Join the `report_*` tables, in the columns and dtypes of `report.join_report`,
+    with the training mode and internet_allowed the aggregates group by."""
+    for chunk in query_chunks(connection, REPORT_QUERY, chunk_size=chunk_size):
+        chunk["marks"] = chunk["marks"].astype("int64")
+        chunk["is_passed"] = chunk["is_passed"].astype(bool)
+        chunk["internet_allowed"] = chunk["internet_allowed"].astype(bool)
+        yield chunk
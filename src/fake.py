@@ -1,7 +1,12 @@
+from concurrent.futures import ProcessPoolExecutor
 from faker import Faker
+import numpy as np
+import pandas as pd
+from itertools import islice
 import random
 import csv
 import os
+import shutil
 from .logger import create_logger
 
 logger = create_logger("fake")
@@ -51,19 +56,39 @@ class Options:
     subject_file = "subjects.csv"
     training_file = "trainings.csv"
     assessment_file = "assessments.csv"
+    # rows generated and written at a time
+    batch_size = 10_000
 
     # Set the unclean ratio here (0 to 1, higher = more unclean data)
     unclean_percentage = 10
 
+    # generate in bulk, sampling whole columns with numpy in worker processes
+    # instead of building rows one by one, for load testing datasets
+    bulk = False
+    workers = 1
+    # rows per shard, every shard is generated and written on its own
+    shard_size = 100_000
+    # distinct names, emails and words the shards sample from
+    pool_size = 10_000
+    # seed of the bulk datasets, None draws one and logs it
+    seed = None
+    # end of the generated time windows, None is the start of the current day
+    reference_time = None
+
 
 options = Options()
 
 
+# ids of the generated parent records, the only records kept in memory since
+# child records sample their foreign keys from them
 class Context:
-    users = []
-    subjects = []
-    trainings = []
-    assessments = []
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.user_ids = []
+        self.subject_ids = []
+        self.training_ids = []
 
 
 context = Context()
@@ -72,15 +97,18 @@ fake = Faker()
 
 
 # utility function to make choice between clean and unclean data
-def make_choice(clean_value, unclean_value):
+def make_choice(clean_value, unclean_value, unclean_percentage=None):
+
+    if unclean_percentage is None:
+        unclean_percentage = options.unclean_percentage
 
     return random.choices(
         [clean_value, unclean_value],
-        weights=[100 - options.unclean_percentage, options.unclean_percentage],
+        weights=[100 - unclean_percentage, unclean_percentage],
     )[0]
 
 
-# generate fake users with unclean data
+# generate fake users with unclean data, one record at a time
 def generate_users():
 
     for _ in range(options.user_count):
@@ -116,10 +144,11 @@ def generate_users():
             ),
         }
 
-        context.users.append(user)
+        context.user_ids.append(user["id"])
+        yield user
 
 
-# generate fake subjects with unclean data
+# generate fake subjects with unclean data, one record at a time
 def generate_subjects():
 
     for _ in range(options.subject_count):
@@ -144,14 +173,15 @@ def generate_subjects():
             ),
         }
 
-        context.subjects.append(subject)
+        context.subject_ids.append(subject["id"])
+        yield subject
 
 
-# generate fake trainings with unclean data
+# generate fake trainings with unclean data, one record at a time
 def generate_trainings():
 
     for _ in range(options.training_count):
-        subject = random.choice(context.subjects)
+        subject_id = random.choice(context.subject_ids)
         training = {
             "id": fake.uuid4(),
             "name": make_choice(fake.job().title(), fake.job().upper()),  # Random case
@@ -159,7 +189,7 @@ def generate_trainings():
                 random.choice(options.training_modes[:2]),
                 random.choice(options.training_modes),
             ),  # Invalid modes
-            "subjectId": make_choice(subject["id"], None),  # Some missing subject IDs
+            "subjectId": make_choice(subject_id, None),  # Some missing subject IDs
             "startedAt": make_choice(
                 fake.date_time_between(start_date="-1y", end_date="now"), "invalid-date"
             ),  # Invalid date
@@ -174,85 +204,427 @@ def generate_trainings():
             ),
         }
 
-        context.trainings.append(training)
+        context.training_ids.append(training["id"])
+        yield training
 
 
-# generate fake assessments with unclean data
+# generate fake assessments with unclean data, one record at a time
 def generate_assessments():
 
-    options.unclean_percentage = 0
+    # assessments are generated clean
+    unclean_percentage = 0
     for _ in range(options.assessment_count):
-        user = random.choice(context.users)
-        training = random.choice(context.trainings)
+        user_id = random.choice(context.user_ids)
+        training_id = random.choice(context.training_ids)
         assessment = {
             "userId": make_choice(
-                user["id"], fake.uuid4()
+                user_id, fake.uuid4(), unclean_percentage
             ),  # Invalid or non-existent user IDs
             "trainingId": make_choice(
-                training["id"], fake.uuid4()
+                training_id, fake.uuid4(), unclean_percentage
             ),  # Invalid or non-existent training IDs
             "marks": make_choice(
-                random.randint(0, 100), random.choice([None, "+50"])
+                random.randint(0, 100), random.choice([None, "+50"]), unclean_percentage
             ),  # Invalid marks
             "internetAllowed": make_choice(
-                random.choice([True, False]), random.choice(["yes", "no", "123"])
+                random.choice([True, False]),
+                random.choice(["yes", "no", "123"]),
+                unclean_percentage,
             ),  # Invalid boolean values
         }
 
-        context.assessments.append(assessment)
+        yield assessment
 
 
-# save data to csv
-def save_to_csv(data, filename, fieldnames):
+# save records to csv as they are generated, one batch at a time, returns the
+# number of records written
+def save_to_csv(records, filename, fieldnames):
 
     if not os.path.exists(options.out_dir):
         os.makedirs(options.out_dir)
+
+    records = iter(records)
+    count = 0
     with open(f"{options.out_dir}/{filename}", mode="w", newline="") as file:
         writer = csv.DictWriter(file, fieldnames=fieldnames)
         writer.writeheader()
-        writer.writerows(data)
+        while batch := list(islice(records, options.batch_size)):
+            writer.writerows(batch)
+            count += len(batch)
+
+    return count
+
+
+# bulk generation: every shard samples its columns from value pools with a
+# numpy generator seeded from the seed, the entity and the shard number, so
+# the datasets only depend on the seed, whatever the number of workers
+ENTITY_NUMBERS = {"users": 0, "subjects": 1, "trainings": 2, "assessments": 3}
+HEX_DIGITS = np.array(list("0123456789abcdef"), dtype="S1")
+DAY = 86_400 * 10**9
+
+# settings, value pools and parent ids of a bulk worker process, set once by
+# its initializer
+bulk_settings = {}
+bulk_pools = {}
+bulk_parents = {}
+
+
+def init_bulk_worker(name, settings, parents):
+    # a Faker instance per worker, seeded alike so every worker has the same pools
+    generator = Faker()
+    generator.seed_instance(settings["seed"])
+
+    bulk_settings.clear()
+    bulk_settings.update(settings)
+    bulk_pools.clear()
+    bulk_pools.update(bulk_pool_builders[name](generator, settings))
+    bulk_parents.clear()
+    bulk_parents.update(parents)
+
+
+def pool(make, size):
+    return np.array([make() for _ in range(size)], dtype=object)
+
+
+def build_user_pools(generator, settings):
+    first_names = pool(generator.first_name, settings["pool_size"])
+    last_names = pool(generator.last_name, settings["pool_size"])
+    emails = pool(generator.email, settings["pool_size"])
+
+    return {
+        "first_names": first_names,
+        "cased_first_names": np.concatenate(
+            [
+                [name.lower() for name in first_names],
+                [name.upper() for name in first_names],
+            ]
+        ),
+        "last_names": last_names,
+        "lettered_last_names": np.array(
+            [name + generator.random_letter() for name in last_names], dtype=object
+        ),
+        "emails": emails,
+        "bad_emails": np.array(
+            [
+                email.replace("@", generator.random_element(["@$", "@-", "@.."]))
+                for email in emails
+            ],
+            dtype=object,
+        ),
+        "roles": np.array(settings["user_roles"], dtype=object),
+    }
+
+
+def build_subject_pools(generator, settings):
+    return {
+        "words": pool(lambda: generator.word().capitalize(), settings["pool_size"])
+    }
+
+
+def build_training_pools(generator, settings):
+    jobs = pool(generator.job, settings["pool_size"])
+
+    return {
+        "titled_jobs": np.array([job.title() for job in jobs], dtype=object),
+        "upper_jobs": np.array([job.upper() for job in jobs], dtype=object),
+        "modes": np.array(settings["training_modes"], dtype=object),
+    }
+
+
+bulk_pool_builders = {
+    "users": build_user_pools,
+    "subjects": build_subject_pools,
+    "trainings": build_training_pools,
+    "assessments": lambda generator, settings: {},
+}
+
+
+def sample(rng, pool, rows):
+    """Draw `rows` values from `pool`, None when the pool is empty."""
+    if len(pool) == 0:
+        return np.full(rows, None, dtype=object)
+    return pool[rng.integers(len(pool), size=rows)]
+
+
+def sample_any(rng, rows, *choices):
+    """Draw every row from one of `choices`, a scalar or a column of `rows` values."""
+    picks = rng.integers(len(choices), size=rows)
+    values = np.empty(rows, dtype=object)
+    for index, choice in enumerate(choices):
+        selected = picks == index
+        values[selected] = choice[selected] if isinstance(choice, np.ndarray) else choice
+    return values
+
+
+def make_choices(rng, clean_values, unclean_values):
+    """Column-wise `make_choice`."""
+    rows = len(clean_values)
+    unclean = rng.random(rows) * 100 < bulk_settings["unclean_percentage"]
+    return np.where(unclean, unclean_values, np.asarray(clean_values, dtype=object))
+
+
+def random_uuids(rng, rows):
+    """Random version 4 UUIDs, formatted like `Faker.uuid4`."""
+    nibbles = rng.integers(16, size=(rows, 32), dtype=np.uint8)
+    nibbles[:, 12] = 4
+    nibbles[:, 16] = 8 | (nibbles[:, 16] & 3)
+    digits = np.insert(HEX_DIGITS[nibbles], [8, 12, 16, 20], b"-", axis=1)
+    return digits.view("S36").ravel().astype(str).astype(object)
+
+
+def random_datetimes(rng, rows, start_days, end_days):
+    """Random datetimes between `start_days` and `end_days` from the reference time."""
+    now = bulk_settings["reference_time"]
+    values = rng.integers(now + start_days * DAY, now + end_days * DAY, size=rows)
+    return np.datetime_as_string(values.astype("datetime64[ns]"), unit="s").astype(
+        object
+    )
 
 
-# main function
-def run():
+def generate_bulk_users(rng, rows):
+    return pd.DataFrame(
+        {
+            "id": make_choices(rng, random_uuids(rng, rows), None),
+            "email": make_choices(
+                rng,
+                sample(rng, bulk_pools["emails"], rows),
+                sample(rng, bulk_pools["bad_emails"], rows),
+            ),
+            "first_name": make_choices(
+                rng,
+                sample(rng, bulk_pools["first_names"], rows),
+                sample(rng, bulk_pools["cased_first_names"], rows),
+            ),
+            "middle_name": make_choices(
+                rng,
+                sample(rng, bulk_pools["first_names"], rows),
+                sample_any(rng, rows, None, "", "123"),
+            ),
+            "last_name": make_choices(
+                rng,
+                sample(rng, bulk_pools["last_names"], rows),
+                sample_any(
+                    rng,
+                    rows,
+                    None,
+                    "",
+                    sample(rng, bulk_pools["lettered_last_names"], rows),
+                ),
+            ),
+            "role": make_choices(
+                rng,
+                sample(rng, bulk_pools["roles"][:2], rows),
+                sample(rng, bulk_pools["roles"], rows),
+            ),
+            "createdAt": make_choices(
+                rng, random_datetimes(rng, rows, -730, 0), "invalid-date"
+            ),
+            "updatedAt": make_choices(
+                rng, random_datetimes(rng, rows, -730, 0), "bad-date"
+            ),
+        }
+    )
 
-    logger.info(
-        f"generating datasets with unclean_percentage '{options.unclean_percentage}'..."
+
+def generate_bulk_subjects(rng, rows):
+    return pd.DataFrame(
+        {
+            "id": random_uuids(rng, rows),
+            "name": sample(rng, bulk_pools["words"], rows),
+            "minMarks": make_choices(
+                rng,
+                rng.integers(0, 31, size=rows),
+                sample_any(rng, rows, rng.integers(-10, 31, size=rows), 10.5),
+            ),
+            "maxMarks": make_choices(
+                rng,
+                rng.integers(60, 101, size=rows),
+                sample_any(rng, rows, None, "+120", "-90"),
+            ),
+            "totalTime": make_choices(rng, rng.integers(60, 181, size=rows), None),
+            "createdBy": make_choices(rng, random_uuids(rng, rows), None),
+            "createdAt": make_choices(
+                rng, random_datetimes(rng, rows, -365, 0), "bad-date"
+            ),
+            "updatedAt": make_choices(
+                rng, random_datetimes(rng, rows, -365, 0), "invalid"
+            ),
+        }
     )
 
-    # generate datasets
-    logger.info("generating users...")
-    generate_users()
-    logger.info(f"generating users done, count: {len(context.users)}")
 
-    logger.info("generating subjects...")
-    generate_subjects()
-    logger.info(f"generating subjects done, count: {len(context.subjects)}")
+def generate_bulk_trainings(rng, rows):
+    return pd.DataFrame(
+        {
+            "id": random_uuids(rng, rows),
+            "name": make_choices(
+                rng,
+                sample(rng, bulk_pools["titled_jobs"], rows),
+                sample(rng, bulk_pools["upper_jobs"], rows),
+            ),
+            "mode": make_choices(
+                rng,
+                sample(rng, bulk_pools["modes"][:2], rows),
+                sample(rng, bulk_pools["modes"], rows),
+            ),
+            "subjectId": make_choices(
+                rng, sample(rng, bulk_parents["subjects"], rows), None
+            ),
+            "startedAt": make_choices(
+                rng, random_datetimes(rng, rows, -365, 0), "invalid-date"
+            ),
+            "endedAt": make_choices(
+                rng, random_datetimes(rng, rows, 0, 30), "wrong-date"
+            ),
+            "createdAt": make_choices(
+                rng, random_datetimes(rng, rows, -365, 0), "invalid"
+            ),
+            "updatedAt": make_choices(
+                rng, random_datetimes(rng, rows, -365, 0), "bad-date"
+            ),
+        }
+    )
+
+
+def generate_bulk_assessments(rng, rows):
+    # assessments are generated clean, as in generate_assessments
+    return pd.DataFrame(
+        {
+            "userId": sample(rng, bulk_parents["users"], rows),
+            "trainingId": sample(rng, bulk_parents["trainings"], rows),
+            "marks": rng.integers(0, 101, size=rows),
+            "internetAllowed": rng.random(rows) < 0.5,
+        }
+    )
 
-    logger.info("generating trainings...")
-    generate_trainings()
-    logger.info(f"generating trainings done, count: {len(context.trainings)}")
 
-    logger.info("generating assessments...")
-    generate_assessments()
-    logger.info(f"generating assessments done, count: {len(context.assessments)}")
+bulk_generators = {
+    "users": generate_bulk_users,
+    "subjects": generate_bulk_subjects,
+    "trainings": generate_bulk_trainings,
+    "assessments": generate_bulk_assessments,
+}
 
-    # save datasets to csv
-    logger.info(f"writing users to csv file '{options.user_file}'...")
-    save_to_csv(context.users, options.user_file, options.user_fields)
-    logger.info(f"writing users to csv file done")
 
-    logger.info(f"writing subjects to csv file '{options.subject_file}'...")
-    save_to_csv(context.subjects, options.subject_file, options.subject_fields)
-    logger.info(f"writing subjects to csv file done")
+def generate_bulk_shard(name, number, rows, part_path):
+    """Generate and write shard `number` of `name`, returns its ids."""
+    rng = np.random.default_rng(
+        [bulk_settings["seed"], ENTITY_NUMBERS[name], number]
+    )
+    records = bulk_generators[name](rng, rows)
+    records.to_csv(part_path, index=False, header=number == 0)
+
+    if name == "assessments":
+        return None
+    return records["id"].to_numpy()
+
+
+def save_bulk_shards(name, count, filename, settings, parents):
+    """Generate `count` records of `name` in shards and write them to `filename`.
+
+    Every shard is written to its own part file, then the parts are appended
+    in order to the single file stage reads. Returns the generated ids."""
+    parts_dir = os.path.join(options.out_dir, f".{name}.parts")
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+
+    starts = range(0, count, options.shard_size)
+    numbers = list(range(max(len(starts), 1)))
+    rows = [min(options.shard_size, count - start) for start in starts] or [0]
+    part_paths = [os.path.join(parts_dir, f"part-{n:05d}.csv") for n in numbers]
+    names = [name] * len(numbers)
+
+    if options.workers > 1 and len(numbers) > 1:
+        with ProcessPoolExecutor(
+            max_workers=options.workers,
+            initializer=init_bulk_worker,
+            initargs=(name, settings, parents),
+        ) as executor:
+            ids = list(
+                executor.map(generate_bulk_shard, names, numbers, rows, part_paths)
+            )
+    else:
+        init_bulk_worker(name, settings, parents)
+        ids = list(map(generate_bulk_shard, names, numbers, rows, part_paths))
+
+    with open(os.path.join(options.out_dir, filename), "wb") as file:
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, file)
+    shutil.rmtree(parts_dir)
+
+    if name == "assessments":
+        return None
+    return np.concatenate(ids)
+
+
+def run_bulk():
+    seed = options.seed
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    reference_time = pd.Timestamp(options.reference_time or pd.Timestamp.now().normalize())
 
-    logger.info(f"writing trainings to csv file '{options.training_file}'...")
-    save_to_csv(context.trainings, options.training_file, options.training_fields)
-    logger.info(f"writing trainings to csv file done")
+    logger.info(
+        f"generating datasets in bulk with unclean_percentage "
+        f"'{options.unclean_percentage}', seed '{seed}'..."
+    )
+
+    settings = {
+        "seed": seed,
+        "pool_size": options.pool_size,
+        "unclean_percentage": options.unclean_percentage,
+        "reference_time": reference_time.value,
+        "user_roles": options.user_roles,
+        "training_modes": options.training_modes,
+    }
+    os.makedirs(options.out_dir, exist_ok=True)
+
+    # parent ids stay in memory, shards of the child entities sample them
+    parents = {}
+    for name, count, filename in [
+        ("users", options.user_count, options.user_file),
+        ("subjects", options.subject_count, options.subject_file),
+        ("trainings", options.training_count, options.training_file),
+        ("assessments", options.assessment_count, options.assessment_file),
+    ]:
+        logger.info(f"generating {name} to csv file '{filename}'...")
+        ids = save_bulk_shards(name, count, filename, settings, parents)
+        if ids is not None:
+            parents[name] = ids
+        logger.info(f"generating {name} done, count: {count}")
+
+
+# main function
+def run():
+
+    if options.bulk:
+        return run_bulk()
+
+    logger.info(
+        f"generating datasets with unclean_percentage '{options.unclean_percentage}'..."
+    )
 
-    logger.info(f"writing assessments to csv file '{options.assessment_file}'...")
-    save_to_csv(context.assessments, options.assessment_file, options.assessment_fields)
-    logger.info(f"writing assessments to csv file done")
+    # generate every dataset straight to its csv file
+    context.reset()
+    for name, generate, filename, fieldnames in [
+        ("users", generate_users, options.user_file, options.user_fields),
+        ("subjects", generate_subjects, options.subject_file, options.subject_fields),
+        (
+            "trainings",
+            generate_trainings,
+            options.training_file,
+            options.training_fields,
+        ),
+        (
+            "assessments",
+            generate_assessments,
+            options.assessment_file,
+            options.assessment_fields,
+        ),
+    ]:
+        logger.info(f"generating {name} to csv file '{filename}'...")
+        count = save_to_csv(generate(), filename, fieldnames)
+        logger.info(f"generating {name} done, count: {count}")
 
 
 if __name__ == "__main__":
@@ -1,23 +1,134 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
+
+
+# options to configure logging, set from the environment by default
+class Options:
+    level = os.environ.get("LOG_LEVEL", "INFO")
+    # "text" or "json", one JSON object per line
+    format = os.environ.get("LOG_FORMAT", "text")
+
+
+options = Options()
+
+# Loggers only put their records on a queue, a listener thread formats them
+# and writes them to stdout, so logging never blocks on the console.
+lock = threading.Lock()
+log_queue = queue.SimpleQueue()
+console = logging.StreamHandler(sys.stdout)
+listener = None
+loggers = {}
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queue records with their message merged, and their traceback formatted
+    into `exc_text` instead of folded into the message, so the console
+    formatter still sees the exception of the record."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            # formatted now, the traceback frames are not kept alive in the queue
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+queue_handler = RecordQueueHandler(log_queue)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry)
+
+
+def formatter():
+    if options.format == "json":
+        return JsonFormatter()
+    return logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+
+def start_listener():
+    global listener
+    console.setFormatter(formatter())
+    listener = logging.handlers.QueueListener(log_queue, console)
+    listener.start()
+
+
+def stop_listener():
+    """Write the queued records and stop the listener thread."""
+    global listener
+    with lock:
+        if listener is not None:
+            listener.stop()
+            listener = None
+
+
+def restart_in_child():
+    # threads do not survive a fork, a forked worker gets its own queue and
+    # listener
+    global lock, log_queue
+    lock = threading.Lock()
+    log_queue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    if listener is not None:
+        start_listener()
+
+
+atexit.register(stop_listener)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_in_child)
 
 
 def create_logger(name):
-    """Set up a logger with the specified name."""
+    """Set up a logger with the specified name, calling it again returns the same logger."""
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
 
-    # Create a console handler
-    console = logging.StreamHandler(sys.stdout)
-    console.setLevel(logging.INFO)
+    with lock:
+        if listener is None:
+            start_listener()
 
-    # Create a formatter and set it for the handler
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
-    console.setFormatter(formatter)
-
-    # Add the handler to the logger
-    logger.addHandler(console)
+        if queue_handler not in logger.handlers:
+            logger.addHandler(queue_handler)
+            logger.setLevel(options.level)
+            logger.propagate = False
+            loggers[name] = logger
 
     return logger
+
+
+def configure(level=None, format=None):
+    """Change the level of every logger created so far, or the output format."""
+    with lock:
+        if level is not None:
+            options.level = level
+            for logger in loggers.values():
+                logger.setLevel(level)
+        if format is not None:
+            options.format = format
+            console.setFormatter(formatter())
@@ -0,0 +1,261 @@
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# options to configure the metrics exports
+class Options:
+    enabled = True
+    summary_file = "out/metrics.json"
+    # Prometheus text exposition of the same metrics, None to skip it
+    prometheus_file = None
+
+
+options = Options()
+
+# guards the records, entities are staged from several threads
+lock = threading.Lock()
+
+# measurements by (stage, entity), and discarded rows by (entity, reason)
+records = {}
+discards = {}
+
+# blocks being measured, the peak RSS is reset when the first of them starts
+active = 0
+
+# stages in the order their measurements are written
+STAGES = ["stage", "prep", "report"]
+
+# counters kept per measurement, summed over every chunk of a stage
+COUNTERS = [
+    "wall_seconds",
+    "cpu_seconds",
+    "rows_in",
+    "rows_out",
+    "bytes_read",
+    "bytes_written",
+]
+
+
+def restart_in_child():
+    # a fork copies the lock as it is, held when another thread had it, and
+    # the blocks measured by other threads, a forked worker gets its own
+    global lock, active
+    lock = threading.Lock()
+    active = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_in_child)
+
+
+def reset():
+    """Drop every measurement, every run starts with it so the summary it
+    writes only has its own."""
+    with lock:
+        records.clear()
+        discards.clear()
+
+
+def record(stage, entity):
+    """Return the measurement of `entity` in `stage`, created empty when missing."""
+    key = (stage, entity)
+    if key not in records:
+        records[key] = {counter: 0 for counter in COUNTERS}
+        records[key]["peak_rss"] = 0
+    return records[key]
+
+
+def add(stage, entity, **counters):
+    """Add `counters` to the measurement of `entity` in `stage`."""
+    with lock:
+        measurement = record(stage, entity)
+        for counter, value in counters.items():
+            measurement[counter] += value
+
+
+def count_discards(entity, reason, count):
+    with lock:
+        discards[(entity, reason)] = discards.get((entity, reason), 0) + count
+
+
+def merge_discards(counts):
+    """Add discard counts taken from `discards` of another process."""
+    for (entity, reason), count in counts.items():
+        count_discards(entity, reason, count)
+
+
+@contextmanager
+def measure(stage, entity):
+    """Measure the wall and CPU time of the block, and the peak RSS of the
+    process while it ran.
+
+    The peak is reset when the block starts, unless other blocks are being
+    measured: blocks run at once, like entities staged concurrently, share the
+    peak since the first of them started. CPU time is the time of the calling
+    thread, work done in worker processes is added by the caller."""
+    global active
+    with lock:
+        if active == 0:
+            reset_peak_rss()
+        active += 1
+
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        add(
+            stage,
+            entity,
+            wall_seconds=time.perf_counter() - wall_start,
+            cpu_seconds=time.thread_time() - cpu_start,
+        )
+        with lock:
+            measurement = record(stage, entity)
+            measurement["peak_rss"] = max(measurement["peak_rss"], peak_rss())
+            active -= 1
+
+
+def path_size(path):
+    """Size in bytes of a file, or of every file under a directory."""
+    if os.path.isdir(path):
+        paths = glob.glob(os.path.join(path, "**"), recursive=True)
+        return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process, where the kernel allows it. Elsewhere
+    the peak is the one since the process started."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak RSS of the process in bytes, since it started or the last `reset_peak_rss`."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def summary():
+    """Return every measurement and discard count as a JSON-serializable dict."""
+    with lock:
+        stages = []
+        for (stage, entity), measurement in records.items():
+            seconds = measurement["wall_seconds"]
+            stages.append(
+                {
+                    "stage": stage,
+                    "entity": entity,
+                    **measurement,
+                    "rows_per_second": (
+                        round(measurement["rows_in"] / seconds, 1) if seconds else 0
+                    ),
+                }
+            )
+
+        return {
+            "stages": stages,
+            "discards": [
+                {"entity": entity, "reason": reason, "count": count}
+                for (entity, reason), count in sorted(discards.items())
+            ],
+        }
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(run_summary):
+    """Format `run_summary` in the Prometheus text exposition format."""
+    lines = []
+    for metric in COUNTERS + ["peak_rss", "rows_per_second"]:
+        name = f"empstat_stage_{metric}"
+        lines.append(f"# TYPE {name} gauge")
+        for measurement in run_summary["stages"]:
+            labels = (
+                f'stage="{label_value(measurement["stage"])}",'
+                f'entity="{label_value(measurement["entity"])}"'
+            )
+            lines.append(f"{name}{{{labels}}} {measurement[metric]}")
+
+    lines.append("# TYPE empstat_discarded_rows_total counter")
+    for discard in run_summary["discards"]:
+        labels = (
+            f'entity="{label_value(discard["entity"])}",'
+            f'reason="{label_value(discard["reason"])}"'
+        )
+        lines.append(f"empstat_discarded_rows_total{{{labels}}} {discard['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def read_summary():
+    """Return the summary written to `options.summary_file`, empty when there is none."""
+    try:
+        with open(options.summary_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {"stages": [], "discards": []}
+
+
+def merge_summary(previous, run_summary):
+    """Replace the measurements of `previous` of every stage measured in
+    `run_summary`, keeping those of the other stages. Discards are counted by
+    prep, they are replaced when it ran."""
+    stages = {measurement["stage"] for measurement in run_summary["stages"]}
+    measurements = [
+        measurement
+        for measurement in previous.get("stages", [])
+        if measurement["stage"] not in stages
+    ] + run_summary["stages"]
+    measurements.sort(
+        key=lambda measurement: (
+            STAGES.index(measurement["stage"])
+            if measurement["stage"] in STAGES
+            else len(STAGES)
+        )
+    )
+
+    discards = previous.get("discards", [])
+    if "prep" in stages or run_summary["discards"]:
+        discards = run_summary["discards"]
+
+    return {"stages": measurements, "discards": discards}
+
+
+def write():
+    """Merge the run summary into `options.summary_file`, and write the merged
+    summary to `options.prometheus_file`, so the runs of every stage are kept."""
+    if not options.enabled:
+        return
+
+    run_summary = merge_summary(read_summary(), summary())
+    write_text(options.summary_file, json.dumps(run_summary, indent=2))
+    if options.prometheus_file is not None:
+        write_text(options.prometheus_file, prometheus_text(run_summary))
+
+
+def write_text(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        file.write(text)
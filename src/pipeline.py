@@ -0,0 +1,196 @@
+import os
+from functools import partial
+from . import cache, metrics, prep, rejects, report, schema, stage
+from .aggregates import Aggregates
+from .logger import create_logger
+from .scheduler import TaskGraph
+
+logger = create_logger("pipeline")
+
+
+# options to configure the in-memory pipeline
+class Options:
+    # stages whose outputs are also written to disk, any of "stage" and "prep"
+    checkpoints = ["stage", "prep"]
+    # write the report to `report.options.report_dir`
+    save_report = True
+    # threads running the tasks of the pipeline, every task runs as soon as
+    # its inputs are done, 1 runs them one after another
+    workers = 4
+
+
+options = Options()
+
+
+# Options of the staged runs the in-memory pipeline cannot follow, with the
+# value it runs with
+UNSUPPORTED_OPTIONS = [
+    (stage.options, "stage", "chunk_size", None),
+    (prep.options, "prep", "chunk_size", None),
+    (prep.options, "prep", "backend", "pandas"),
+    (prep.options, "prep", "incremental", False),
+    (report.options, "report", "chunk_size", None),
+    (report.options, "report", "backend", "pandas"),
+    (report.options, "report", "incremental", False),
+]
+
+
+def check_options():
+    """Raise a ValueError for options set that the pipeline would ignore."""
+    for module_options, module, name, value in UNSUPPORTED_OPTIONS:
+        if getattr(module_options, name) != value:
+            raise ValueError(
+                f"the pipeline does not support {module}.options.{name} "
+                f"{getattr(module_options, name)!r}, use the staged runs instead"
+            )
+
+
+class Pipeline:
+    """Run stage, prep and report in one process, handing the DataFrames of a
+    stage directly to the next one instead of writing and reading them back.
+
+    Only the stages listed in `checkpoints` are persisted, so an ad-hoc report
+    needs no out/stage or out/prep at all. Every table is held in memory, so
+    chunked streaming, the sqlite backend and incremental runs do not apply
+    here and setting any of them raises a ValueError. The outputs it writes
+    are dropped from the cache manifest, so the staged runs never skip
+    rewriting them.
+
+    Every entity of every stage is a task of a `TaskGraph`, run as soon as the
+    tasks it reads from are done: users are cleaned while subjects and
+    trainings are, and assessments are staged while their parents are
+    cleaned."""
+
+    def __init__(self, checkpoints=None, save_report=None, workers=None):
+        check_options()
+
+        self.checkpoints = options.checkpoints if checkpoints is None else checkpoints
+        self.save_report = options.save_report if save_report is None else save_report
+        self.workers = options.workers if workers is None else workers
+
+        self.stage_outputs = None
+        self.prep_outputs = None
+        self.report_data = None
+        self.aggregates = None
+
+        rejects.reset()
+        metrics.reset()
+        self.graph = TaskGraph()
+        for name in schema.ENTITIES:
+            self.graph.add(f"stage/{name}", partial(self.stage_entity, name))
+        prep.add_clean_tasks(self.graph)
+        for name in schema.ENTITIES:
+            self.graph.add(
+                f"save/prep/{name}",
+                partial(self.save_prep_entity, name),
+                [f"prep/{name}"],
+            )
+        self.graph.add(
+            "save/rejects",
+            self.save_rejects,
+            [f"prep/{name}" for name in schema.ENTITIES],
+        )
+        self.graph.add(
+            "report",
+            self.generate_report,
+            [f"prep/{name}" for name in schema.ENTITIES],
+        )
+
+    def stage_entity(self, name):
+        staged = stage.stage_input(name)
+
+        if "stage" in self.checkpoints:
+            # the output is rewritten without going through the cache
+            cache.forget(f"stage/{name}")
+            stage.save_stage_output(name, staged)
+            logger.info(f"staged {name} saved to '{stage.options.stage_dir}'")
+
+        return staged
+
+    def save_prep_entity(self, name, cleaned):
+        cache.forget(f"prep/{name}")
+        prep.save_prep_output(name, cleaned)
+        logger.info(f"prep {name} saved to '{prep.options.output_folder}'")
+
+    def save_rejects(self, *prep_outputs):
+        # every entity is cleaned, so the ledger is complete
+        prep.save_rejects()
+
+    def generate_report(self, users, subjects, trainings, assessments):
+        logger.info("generating report...")
+        with metrics.measure("report", "report"):
+            users, subjects, trainings = report.index_report_tables(
+                users, subjects, trainings
+            )
+            report_data = report.join_report(users, subjects, trainings, assessments)
+            self.aggregates = Aggregates()
+            self.aggregates.add(
+                report.aggregate_rows(report_data, trainings, assessments)
+            )
+
+        rows = len(report_data)
+        metrics.add("report", "report", rows_in=rows, rows_out=rows)
+
+        if self.save_report:
+            os.makedirs(report.options.report_dir, exist_ok=True)
+            cache.forget("report")
+            report.write_report(report_data)
+            # the report no longer follows the incremental state
+            report.remove_state()
+            if report.options.aggregates:
+                report.save_aggregates(self.aggregates)
+            metrics.add(
+                "report",
+                "report",
+                bytes_written=metrics.path_size(report.report_path()),
+            )
+
+        return report_data
+
+    def run_tasks(self, targets):
+        if any(target.startswith("save/prep/") for target in targets):
+            # the prep outputs saved no longer follow the incremental state
+            prep.remove_state()
+        results = self.graph.run(targets, self.workers)
+
+        # keep the outputs of every stage that ran to the end
+        for stage_name in ["stage", "prep"]:
+            names = [f"{stage_name}/{name}" for name in schema.ENTITIES]
+            if all(name in results for name in names):
+                outputs = tuple(results[name] for name in names)
+                setattr(self, f"{stage_name}_outputs", outputs)
+        self.report_data = results.get("report")
+
+    def save_targets(self):
+        if "prep" not in self.checkpoints:
+            return []
+        return [f"save/prep/{name}" for name in schema.ENTITIES] + ["save/rejects"]
+
+    def stage(self):
+        logger.info("staging inputs...")
+        self.run_tasks([f"stage/{name}" for name in schema.ENTITIES])
+        return self.stage_outputs
+
+    def prep(self):
+        logger.info("cleaning staged data...")
+        targets = [f"prep/{name}" for name in schema.ENTITIES]
+        self.run_tasks(targets + self.save_targets())
+        return self.prep_outputs
+
+    def report(self):
+        self.run_tasks(["report"] + self.save_targets())
+        return self.report_data
+
+    def run(self):
+        """Run every stage, returns the report."""
+        return self.report()
+
+
+# Run the pipeline instead of the staged runs of run.py, with `python -m src.pipeline`
+def run():
+    Pipeline().run()
+    metrics.write()
+
+
+if __name__ == "__main__":
+    run()
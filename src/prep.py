@@ -1,14 +1,54 @@
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pandas.api.types import is_string_dtype
+from . import cache, database, metrics, rejects, schema
 from .logger import create_logger
+from .references import ReferenceIndex
+from .scheduler import TaskGraph
+from .validators import (
+    parse_booleans,
+    parse_datetimes,
+    parse_numbers,
+    validate_emails,
+    validate_ids,
+    validate_names,
+)
+from .storage import (
+    DEFAULT_FORMAT,
+    file_name,
+    read_chunks,
+    read_file,
+    write_chunks,
+)
 import pandas as pd
+import json
 import os
-import re
+import shutil
+import time
+import uuid
 
 
 # options to configure preparation stage
 class Options:
     stage_folder = "out/stage"
     output_folder = "out/prep"
+    # rows per chunk to stream staged files with, None loads whole files at once
+    chunk_size = None
+    # format of the staged files read and of the prep files written, "csv" or "parquet"
+    stage_format = DEFAULT_FORMAT
+    output_format = DEFAULT_FORMAT
+    # processes cleaning shards of assessments, 1 cleans them in this process
+    assessment_workers = 1
+    # threads cleaning entities concurrently once their parents are cleaned,
+    # 1 cleans them one after another
+    workers = 4
+    # only clean records updated since the previous incremental run and upsert
+    # them into its prep outputs
+    incremental = False
+    # "pandas", or "sqlite" to run the rules as SQL over tables bulk-loaded into
+    # `database.options.path`, for inputs that do not fit in memory. Incremental
+    # runs always use pandas.
+    backend = "pandas"
 
 
 options = Options()
@@ -16,33 +56,79 @@ options = Options()
 logger = create_logger("prep")
 
 
-# Read the CSV files into pandas DataFrames
+def stage_output_path(name):
+    return os.path.join(options.stage_folder, file_name(name, options.stage_format))
+
+
+def prep_output_path(name):
+    return os.path.join(options.output_folder, file_name(name, options.output_format))
+
+
+def read_stage_output(path, entity):
+    return read_file(path, options.stage_format, schema.stage_dtypes(entity))
+
+
+# Read the staged files into pandas DataFrames
 def load_stage_outputs():
 
-    users_path = os.path.join(options.stage_folder, "users.csv")
-    subjects_path = os.path.join(options.stage_folder, "subjects.csv")
-    trainings_path = os.path.join(options.stage_folder, "trainings.csv")
-    assessments_path = os.path.join(options.stage_folder, "assessments.csv")
+    users_path = stage_output_path("users")
+    subjects_path = stage_output_path("subjects")
+    trainings_path = stage_output_path("trainings")
+    assessments_path = stage_output_path("assessments")
 
-    users = pd.read_csv(users_path)
-    subjects = pd.read_csv(subjects_path)
-    trainings = pd.read_csv(trainings_path)
-    assessments = pd.read_csv(assessments_path)
+    users = read_stage_output(users_path, "users")
+    subjects = read_stage_output(subjects_path, "subjects")
+    trainings = read_stage_output(trainings_path, "trainings")
+    assessments = read_stage_output(assessments_path, "assessments")
 
     return users, subjects, trainings, assessments
 
 
+def state_path():
+    return os.path.join(options.output_folder, "state.json")
+
+
+# The changes of the last incremental run to the prep assessments, read by the
+# report to update itself instead of joining every assessment again
+def changes_path(name):
+    return os.path.join(
+        options.output_folder, "changes", file_name(name, options.output_format)
+    )
+
+
+# Drop the incremental state, for outputs rewritten by a full run
+def remove_state():
+
+    if os.path.exists(state_path()):
+        os.remove(state_path())
+    shutil.rmtree(os.path.join(options.output_folder, "changes"), ignore_errors=True)
+
+
+# Read the prep files of a previous run into pandas DataFrames
+def load_prep_outputs():
+
+    return tuple(
+        read_file(prep_output_path(name), options.output_format, schema.prep_dtypes[name])
+        for name in ["users", "subjects", "trainings", "assessments"]
+    )
+
+
 # Validate and clean user records
 def clean_users(users):
-    cleaned_users = []
-    for _, row in users.iterrows():
-        # Trim spaces
-        row = row.apply(lambda x: x.strip() if isinstance(x, str) else x)
-
-        # Check for null or empty values
-        if any(
-            pd.isnull(
-                row[
+    # Trim spaces
+    users = strip_strings(users)
+
+    created_at = parse_datetimes(users["created_at"])
+    updated_at = parse_datetimes(users["updated_at"])
+
+    users = discard_invalid(
+        users,
+        "users",
+        [
+            (
+                "null or empty values",
+                has_null_or_empty(
+                    users,
                     [
                         "id",
                         "email",
@@ -52,69 +138,57 @@ def clean_users(users):
                         "role",
                         "created_at",
                         "updated_at",
-                    ]
-                ]
-            )
-        ) or any(
-            row[["id", "email", "first_name", "middle_name", "last_name", "role"]] == ""
-        ):
-            logger.debug(f"discarded user due to null or empty values: {row['id']}")
-            continue
-
-        # Clean user.id
-        user_id = row["id"]
-        if not validate_id(user_id):
-            logger.debug(f"discarded user due to invalid id: {user_id}")
-            continue
-        prep_user = {"id": user_id.lower()}
-
-        # Clean user.email
-        email = row["email"]
-        if not validate_email(email):
-            logger.debug(f"discarded user due to invalid email: {user_id}")
-            continue
-        prep_user["email"] = email
-
-        # Clean first_name, middle_name, last_name
-        prep_user["first_name"] = row["first_name"].lower()
-        prep_user["middle_name"] = row["middle_name"].lower()
-        prep_user["last_name"] = row["last_name"].lower()
-
-        # Clean role
-        role = row["role"].lower()
-        if role not in ["admin", "employee"]:
-            logger.debug(f"discarded user due to invalid role: {user_id}")
-            continue
-        prep_user["role"] = role
-
-        # Validate created_at and updated_at
-        created_at = row["created_at"]
-        updated_at = row["updated_at"]
-        if not validate_datetime(created_at):
-            logger.debug(f"discarded user due to invalid created_at: {user_id}")
-            continue
-        prep_user["created_at"] = created_at
-        if not validate_datetime(updated_at) or updated_at <= created_at:
-            logger.debug(f"discarded user due to invalid updated_at: {user_id}")
-            continue
-        prep_user["updated_at"] = updated_at
-
-        cleaned_users.append(prep_user)
-
-    return pd.DataFrame(cleaned_users)
+                    ],
+                    ["id", "email", "first_name", "middle_name", "last_name", "role"],
+                ),
+            ),
+            ("invalid id", ~validate_ids(users["id"])),
+            ("invalid email", ~validate_emails(users["email"])),
+            (
+                "invalid role",
+                ~users["role"].str.lower().isin(schema.ROLES),
+            ),
+            ("invalid created_at", created_at.isna()),
+            (
+                "invalid updated_at",
+                updated_at.isna() | (updated_at <= created_at),
+            ),
+        ],
+    )
+
+    return pd.DataFrame(
+        {
+            "id": users["id"].str.lower(),
+            "email": users["email"],
+            "first_name": users["first_name"].str.lower(),
+            "middle_name": users["middle_name"].str.lower(),
+            "last_name": users["last_name"].str.lower(),
+            "role": users["role"].str.lower(),
+            "created_at": created_at[users.index],
+            "updated_at": updated_at[users.index],
+        }
+    ).reset_index(drop=True).astype(schema.prep_dtypes["users"])
 
 
 # Validate and clean subject records
 def clean_subjects(subjects):
-    cleaned_subjects = []
-    for _, row in subjects.iterrows():
-        # Trim spaces
-        row = row.apply(lambda x: x.strip() if isinstance(x, str) else x)
-
-        # Check for null or empty values
-        if any(
-            pd.isnull(
-                row[
+    # Trim spaces
+    subjects = strip_strings(subjects)
+
+    min_marks = pd.to_numeric(subjects["min_marks"], errors="coerce")
+    max_marks = pd.to_numeric(subjects["max_marks"], errors="coerce")
+    total_time = pd.to_numeric(subjects["total_time"], errors="coerce")
+    created_at = parse_datetimes(subjects["created_at"])
+    updated_at = parse_datetimes(subjects["updated_at"])
+
+    subjects = discard_invalid(
+        subjects,
+        "subjects",
+        [
+            (
+                "null or empty values",
+                has_null_or_empty(
+                    subjects,
                     [
                         "id",
                         "name",
@@ -123,79 +197,56 @@ def clean_subjects(subjects):
                         "total_time",
                         "created_at",
                         "updated_at",
-                    ]
-                ]
-            )
-        ) or any(row[["id", "name"]] == ""):
-            logger.debug(f"discarded subject due to null or empty values: {row["id"]}")
-            continue
-
-        # Clean id
-        subject_id = row["id"]
-        if not validate_id(subject_id):
-            logger.debug(f"discarded subject due to invalid id: {subject_id}")
-            continue
-
-        # Clean name
-        name = row["name"]
-        if not re.match(
-            r"^[A-Za-z\s]+$", name
-        ):  # name should not contain symbols or numbers
-            logger.debug(f"discarded subject due to invalid name: {subject_id}")
-            continue
-
-        # Clean min_marks, max_marks, total_time
-        min_marks = row["min_marks"]
-        max_marks = row["max_marks"]
-        total_time = row["total_time"]
-        if min_marks < 0 or max_marks < min_marks or total_time < 0:
-            logger.debug(
-                f"discarded subject due to invalid marks or total_time: {subject_id}"
-            )
-            continue
-
-        # Validate created_at and updated_at
-        created_at = row["created_at"]
-        updated_at = row["updated_at"]
-        if not validate_datetime(created_at):
-            logger.debug(f"discarded subject due to invalid created_at: {subject_id}")
-            continue
-        if not validate_datetime(updated_at) or updated_at <= created_at:
-            logger.debug(f"discarded subject due to invalid updated_at: {subject_id}")
-            continue
-
-        cleaned_subjects.append(
-            {
-                "id": subject_id.lower(),
-                "name": name.strip(),
-                "min_marks": min_marks,
-                "max_marks": max_marks,
-                "total_time": total_time,
-                "created_at": created_at,
-                "updated_at": updated_at,
-            }
-        )
-
-    df = pd.DataFrame(cleaned_subjects)
-
-    df["min_marks"] = df["min_marks"].astype(int)
-    df["max_marks"] = df["max_marks"].astype(int)
-    df["total_time"] = df["total_time"].astype(int)
+                    ],
+                    ["id", "name"],
+                ),
+            ),
+            ("invalid id", ~validate_ids(subjects["id"])),
+            # name should not contain symbols or numbers
+            ("invalid name", ~validate_names(subjects["name"])),
+            (
+                "invalid marks or total_time",
+                ~((min_marks >= 0) & (max_marks >= min_marks) & (total_time >= 0)),
+            ),
+            ("invalid created_at", created_at.isna()),
+            (
+                "invalid updated_at",
+                updated_at.isna() | (updated_at <= created_at),
+            ),
+        ],
+    )
 
-    return df
+    return pd.DataFrame(
+        {
+            "id": subjects["id"].str.lower(),
+            "name": subjects["name"],
+            "min_marks": min_marks[subjects.index],
+            "max_marks": max_marks[subjects.index],
+            "total_time": total_time[subjects.index],
+            "created_at": created_at[subjects.index],
+            "updated_at": updated_at[subjects.index],
+        }
+    ).reset_index(drop=True).astype(schema.prep_dtypes["subjects"])
 
 
 # Validate and clean training records
-def clean_trainings(trainings, valid_subject_ids):
-    cleaned_trainings = []
-    for _, row in trainings.iterrows():
-        # Trim spaces
-        row = row.apply(lambda x: x.strip() if isinstance(x, str) else x)
-
-        # Check for null or empty values
-        if any(
-            pd.isnull(
-                row[
+def clean_trainings(trainings, references):
+    # Trim spaces
+    trainings = strip_strings(trainings)
+
+    started_at = parse_datetimes(trainings["started_at"])
+    ended_at = parse_datetimes(trainings["ended_at"])
+    created_at = parse_datetimes(trainings["created_at"])
+    updated_at = parse_datetimes(trainings["updated_at"])
+
+    trainings = discard_invalid(
+        trainings,
+        "trainings",
+        [
+            (
+                "null or empty values",
+                has_null_or_empty(
+                    trainings,
                     [
                         "id",
                         "name",
@@ -205,235 +256,733 @@ def clean_trainings(trainings, valid_subject_ids):
                         "ended_at",
                         "created_at",
                         "updated_at",
-                    ]
-                ]
-            )
-        ) or any(row[["id", "name", "mode", "subject_id"]] == ""):
-            logger.debug(f"discarded training due to null or empty values: {row["id"]}")
-            continue
-
-        # Clean id
-        training_id = row["id"]
-        if not validate_id(training_id):
-            logger.debug(f"discarded training due to invalid id: {training_id}")
-            continue
-
-        # Clean name
-        name = row["name"]
-        if not re.match(
-            r"^[A-Za-z\s]+$", name
-        ):  # name should not contain symbols or numbers
-            logger.debug(f"discarded training due to invalid name: {training_id}")
-            continue
-
-        # Clean mode
-        mode = row["mode"].lower()
-        if mode not in ["online", "offline", "onsite"]:
-            logger.debug(f"discarded training due to invalid mode: {training_id}")
-            continue
-
-        # Clean subject_id
-        subject_id = row["subject_id"]
-        if subject_id not in valid_subject_ids:
-            logger.debug(f"discarded training due to invalid subject_id: {training_id}")
-            continue
-
-        # Validate started_at
-        started_at = row["started_at"]
-        if not validate_datetime(started_at):
-            logger.debug(f"discarded training due to invalid started_at: {training_id}")
-            continue
-
-        # Validate ended_at
-        ended_at = row["ended_at"]
-        if not validate_datetime(ended_at) or ended_at <= started_at:
-            logger.debug(f"discarded training due to invalid ended_at: {training_id}")
-            continue
-
-        # Validate created_at and updated_at
-        created_at = row["created_at"]
-        if not validate_datetime(created_at):
-            logger.debug(f"discarded training due to invalid created_at: {training_id}")
-            continue
-
-        # Validate updated_at
-        updated_at = row["updated_at"]
-        if not validate_datetime(updated_at) or updated_at <= created_at:
-            logger.debug(f"discarded training due to invalid updated_at: {training_id}")
-            continue
-
-        cleaned_trainings.append(
-            {
-                "id": training_id.lower(),
-                "name": name.strip(),
-                "mode": mode,
-                "subject_id": subject_id,
-                "started_at": started_at,
-                "ended_at": ended_at,
-                "created_at": created_at,
-                "updated_at": updated_at,
-            }
-        )
+                    ],
+                    ["id", "name", "mode", "subject_id"],
+                ),
+            ),
+            ("invalid id", ~validate_ids(trainings["id"])),
+            # name should not contain symbols or numbers
+            ("invalid name", ~validate_names(trainings["name"])),
+            (
+                "invalid mode",
+                ~trainings["mode"].str.lower().isin(schema.MODES),
+            ),
+            (
+                "invalid subject_id",
+                ~references.contains("subjects", trainings["subject_id"]),
+            ),
+            ("invalid started_at", started_at.isna()),
+            (
+                "invalid ended_at",
+                ended_at.isna() | (ended_at <= started_at),
+            ),
+            ("invalid created_at", created_at.isna()),
+            (
+                "invalid updated_at",
+                updated_at.isna() | (updated_at <= created_at),
+            ),
+        ],
+    )
 
-    return pd.DataFrame(cleaned_trainings)
+    return pd.DataFrame(
+        {
+            "id": trainings["id"].str.lower(),
+            "name": trainings["name"],
+            "mode": trainings["mode"].str.lower(),
+            "subject_id": trainings["subject_id"],
+            "started_at": started_at[trainings.index],
+            "ended_at": ended_at[trainings.index],
+            "created_at": created_at[trainings.index],
+            "updated_at": updated_at[trainings.index],
+        }
+    ).reset_index(drop=True).astype(schema.prep_dtypes["trainings"])
 
 
 # Validate and clean assessment records
-def clean_assessments(
-    assessments,
-    valid_user_ids,
-    valid_training_ids,
-    subject_max_marks,
-    training_subject_map,
-):
-    cleaned_assessments = []
-    for _, row in assessments.iterrows():
-        # Trim spaces
-        row = row.apply(lambda x: x.strip() if isinstance(x, str) else x)
-
-        # Check for null or empty values
-        if any(
-            pd.isnull(row[["user_id", "training_id", "marks", "internet_allowed"]])
-        ) or any(row[["user_id", "training_id", "marks", "internet_allowed"]] == ""):
-            logger.debug(
-                f"discarded assessment due to null or empty values: {row['user_id']}"
-            )
-            continue
-
-        # Clean user_id
-        user_id = row["user_id"]
-        if user_id not in valid_user_ids:
-            logger.debug(f"discarded assessment due to invalid user_id: {user_id}")
-            continue
-
-        # Clean training_id
-        training_id = row["training_id"]
-        if training_id not in valid_training_ids:
-            logger.debug(f"discarded assessment due to invalid training_id: {user_id}")
-            continue
-
-        # Map training_id to subject_id
-        subject_id = training_subject_map.get(training_id)
-        if not subject_id:
-            logger.debug(
-                f"discarded assessment due to missing subject_id for: {user_id}"
+def clean_assessments(assessments, references):
+    # Trim spaces
+    assessments = strip_strings(assessments)
+
+    # Map training_id to subject_id
+    subject_id = references.lookup(
+        "trainings", "subject_id", assessments["training_id"]
+    )
+
+    # marks must be a number within [0, max_marks) of the mapped subject
+    marks = parse_numbers(assessments["marks"])
+    max_marks = references.lookup("subjects", "max_marks", subject_id)
+    internet_allowed = parse_booleans(assessments["internet_allowed"])
+
+    assessments = discard_invalid(
+        assessments,
+        "assessments",
+        [
+            (
+                "null or empty values",
+                has_null_or_empty(
+                    assessments,
+                    ["user_id", "training_id", "marks", "internet_allowed"],
+                    ["user_id", "training_id", "marks", "internet_allowed"],
+                ),
+            ),
+            (
+                "invalid user_id",
+                ~references.contains("users", assessments["user_id"]),
+            ),
+            (
+                "invalid training_id",
+                ~references.contains("trainings", assessments["training_id"]),
+            ),
+            ("missing subject_id for", subject_id.isna() | (subject_id == "")),
+            (
+                "invalid marks",
+                ~((marks >= 0) & (marks < max_marks)),
+            ),
+            ("invalid internet_allowed value", internet_allowed.isna()),
+        ],
+    )
+
+    return pd.DataFrame(
+        {
+            "user_id": assessments["user_id"],
+            "training_id": assessments["training_id"],
+            "marks": marks[assessments.index],
+            "internet_allowed": internet_allowed[assessments.index],
+        }
+    ).reset_index(drop=True).astype(schema.prep_dtypes["assessments"])
+
+
+# reference index of an assessment worker process, set once by its initializer
+worker_references = None
+
+
+def init_assessment_worker(references):
+    global worker_references
+    worker_references = references
+
+
+def clean_assessment_shard(shard):
+    # the rejected rows and discard counts of the shard are sent back with it,
+    # along with the CPU time spent cleaning it, since this process has its own
+    # ledger and metrics
+    metrics.reset()
+    rejects.reset()
+    cpu_start = time.thread_time()
+    cleaned = clean_assessments(shard, worker_references)
+    cpu_seconds = time.thread_time() - cpu_start
+
+    return cleaned, rejects.take(), dict(metrics.discards), cpu_seconds
+
+
+class AssessmentCleaner:
+    """Clean assessments on a pool of `options.assessment_workers` processes.
+
+    Every row is checked on its own against the read-only reference index, so
+    the staged assessments are split into one shard per worker and the cleaned
+    shards are concatenated back in their original order. The index is sent to
+    each worker once, when it starts, instead of with every shard."""
+
+    def __init__(self, references):
+        self.references = references
+        self.workers = options.assessment_workers
+        self.executor = None
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=init_assessment_worker,
+                initargs=(references,),
             )
-            continue
-
-        # Clean marks
-        marks = row["marks"]
-        if not (
-            isinstance(marks, (int, float))
-            and marks >= 0
-            and marks < subject_max_marks[subject_id]
-        ):
-            logger.debug(f"discarded assessment due to invalid marks: {user_id}")
-            continue
-
-        # Clean internet_allowed
-        internet_allowed = row["internet_allowed"]
-        if not isinstance(internet_allowed, bool):
-            logger.debug(
-                f"discarded assessment due to invalid internet_allowed value: {user_id}"
+
+    def __call__(self, assessments):
+        if self.executor is None or len(assessments) < self.workers:
+            return clean_assessments(assessments, self.references)
+
+        shard_size = -(-len(assessments) // self.workers)
+        shards = [
+            assessments.iloc[start : start + shard_size]
+            for start in range(0, len(assessments), shard_size)
+        ]
+
+        results = list(self.executor.map(clean_assessment_shard, shards))
+        for _, _, discards, cpu_seconds in results:
+            metrics.merge_discards(discards)
+            metrics.add("prep", "assessments", cpu_seconds=cpu_seconds)
+
+        # rejected rows are added in the order one process rejects them, rule
+        # by rule, the rows of a rule in the order of the shards
+        reasons = [reason for reason, _ in database.prep_rules["assessments"]["rules"]]
+        rejected = [part for result in results for part in result[1]]
+        rejected.sort(key=lambda part: reasons.index(part["reason"].iat[0]))
+        rejects.extend(rejected)
+
+        return pd.concat([result[0] for result in results], ignore_index=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# Helper Functions
+def strip_strings(df):
+    """Trim spaces from every string value, leaving other values untouched."""
+    df = df.copy()
+    for column in df.columns:
+        if is_string_dtype(df[column].dtype):
+            stripped = df[column].str.strip()
+            df[column] = stripped.where(stripped.notna(), df[column])
+    return df
+
+
+def has_null_or_empty(df, required_columns, non_empty_columns):
+    """Flag rows with a null in `required_columns` or an empty string in `non_empty_columns`."""
+    return df[required_columns].isna().any(axis=1) | (
+        df[non_empty_columns] == ""
+    ).any(axis=1)
+
+
+def discard_invalid(df, entity, rules):
+    """Drop the rows flagged by the ordered `(reason, mask)` rules.
+
+    A row is discarded for the first rule it fails, exactly as the row-by-row
+    checks used to do. Discarded rows go to the reject ledger with their
+    reason, and are counted per reason in the metrics."""
+    discarded = pd.Series(False, index=df.index)
+    for reason, mask in rules:
+        mask = mask & ~discarded
+        count = int(mask.sum())
+        if count:
+            logger.debug(f"discarded {entity}, reason: {reason}, count: {count}")
+            metrics.count_discards(entity, reason, count)
+            rejects.add(entity, reason, df[mask])
+        discarded |= mask
+
+    return df[~discarded]
+
+
+def log_cleaned(name, stage_count, prep_count):
+    discard_count = stage_count - prep_count
+    logger.info(f"cleaned {name}, count: {prep_count}, discarded: {discard_count}")
+
+
+# Clean staged records in memory, recording the prep metrics of `name`
+def clean_records_of(name, clean_records, records, *args):
+
+    with metrics.measure("prep", name):
+        cleaned = clean_records(records, *args)
+
+    metrics.add("prep", name, rows_in=len(records), rows_out=len(cleaned))
+    log_cleaned(name, len(records), len(cleaned))
+    return cleaned
+
+
+# Clean staged trainings against the cleaned subjects
+def clean_trainings_of(stage_trainings, prep_subjects):
+
+    references = ReferenceIndex(subjects=prep_subjects)
+    return clean_records_of("trainings", clean_trainings, stage_trainings, references)
+
+
+# Clean staged assessments against the cleaned users, subjects and trainings
+def clean_assessments_of(stage_assessments, prep_users, prep_subjects, prep_trainings):
+
+    references = ReferenceIndex(prep_users, prep_subjects, prep_trainings)
+    with AssessmentCleaner(references) as clean_sharded:
+        return clean_records_of("assessments", clean_sharded, stage_assessments)
+
+
+# Add a "prep/<entity>" task to `graph` for every entity, cleaning the result of
+# its "stage/<entity>" task once the parents it references are cleaned
+def add_clean_tasks(graph):
+
+    graph.add(
+        "prep/users",
+        partial(clean_records_of, "users", clean_users),
+        ["stage/users"],
+    )
+    graph.add(
+        "prep/subjects",
+        partial(clean_records_of, "subjects", clean_subjects),
+        ["stage/subjects"],
+    )
+    graph.add(
+        "prep/trainings", clean_trainings_of, ["stage/trainings", "prep/subjects"]
+    )
+    graph.add(
+        "prep/assessments",
+        clean_assessments_of,
+        ["stage/assessments", "prep/users", "prep/subjects", "prep/trainings"],
+    )
+
+
+# Clean staged DataFrames in memory, without reading or writing any files
+def clean(stage_users, stage_subjects, stage_trainings, stage_assessments):
+
+    rejects.reset()
+
+    graph = TaskGraph()
+    for name, records in zip(
+        schema.ENTITIES,
+        [stage_users, stage_subjects, stage_trainings, stage_assessments],
+    ):
+        graph.put(f"stage/{name}", records)
+    add_clean_tasks(graph)
+    results = graph.run(workers=options.workers)
+
+    return tuple(results[f"prep/{name}"] for name in schema.ENTITIES)
+
+
+# Write the cleaned DataFrame of `name` to the output folder
+def save_prep_output(name, df, append=False):
+
+    os.makedirs(options.output_folder, exist_ok=True)
+
+    path = prep_output_path(name)
+    size = metrics.path_size(path) if append else 0
+    write_chunks(
+        [df], path, options.output_format, schema.prep_dtypes[name], append=append
+    )
+    metrics.add("prep", name, bytes_written=metrics.path_size(path) - size)
+
+
+# Write cleaned DataFrames to the output folder
+def save_prep_outputs(users, subjects, trainings, assessments):
+
+    for name, df in [
+        ("users", users),
+        ("subjects", subjects),
+        ("trainings", trainings),
+        ("assessments", assessments),
+    ]:
+        save_prep_output(name, df)
+
+    save_rejects()
+
+
+# Empty the reject ledger before a run. In chunked mode, and with the sqlite
+# backend, the rejected rows are appended to the output folder as they are
+# found, and only gathered into the rejects output by `save_rejects`.
+def reset_rejects():
+
+    if options.chunk_size is None and options.backend != "sqlite":
+        rejects.reset()
+        return
+
+    spill_path = os.path.join(options.output_folder, "rejects.parts")
+    chunk_size = options.chunk_size or database.options.batch_size
+    rejects.reset(spill_path, options.output_format, chunk_size)
+
+
+# Write the rows rejected by the cleaning to the output folder
+def save_rejects():
+
+    rejects_path = prep_output_path("rejects")
+    count = rejects.write(rejects_path, options.output_format)
+    logger.info(f"rejected rows saved to '{rejects_path}', count: {count}")
+
+
+# Add the rejected rows of `name` saved by the previous run back to the ledger,
+# for an entity whose cleaning is skipped
+def keep_previous_rejects(name):
+
+    rejects_path = prep_output_path("rejects")
+    if not rejects.options.enabled or not os.path.exists(rejects_path):
+        return
+
+    dtypes = {"entity": schema.TEXT, "reason": schema.TEXT, **schema.stage_dtypes(name)}
+    previous_chunks = read_chunks(
+        rejects_path, options.chunk_size, options.output_format, dtypes
+    )
+    for previous in previous_chunks:
+        previous = previous[previous["entity"] == name]
+        columns = [column for column in dtypes if column in previous.columns]
+        # consecutive rows of a reason are added together, keeping their order
+        runs = (previous["reason"] != previous["reason"].shift()).cumsum()
+        for _, rows in previous[columns].groupby(runs, sort=False):
+            rejects.add(
+                name, rows["reason"].iat[0], rows.drop(columns=["entity", "reason"])
             )
-            continue
-
-        cleaned_assessments.append(
-            {
-                "user_id": user_id,
-                "training_id": training_id,
-                "marks": marks,
-                "internet_allowed": internet_allowed,
-            }
+
+
+# Clean a staged file chunk by chunk, appending every cleaned chunk to the prep
+# output, returns the `lookup_columns` of the cleaned records. The cleaning is
+# skipped when neither the staged file nor the prep outputs of `dependencies`
+# changed since it last ran.
+def clean_stage_output(
+    name, clean_records, *args, lookup_columns=(), dependencies=()
+):
+
+    stage_path = stage_output_path(name)
+    prep_path = prep_output_path(name)
+
+    dependency_paths = [prep_output_path(dependency) for dependency in dependencies]
+    key = cache.cache_key(options, stage_path, *dependency_paths)
+    if cache.is_fresh(f"prep/{name}", key, prep_path):
+        logger.info(f"cleaning {name} skipped, inputs unchanged.")
+        keep_previous_rejects(name)
+        prep_chunks = read_chunks(
+            prep_path,
+            options.chunk_size,
+            options.output_format,
+            schema.prep_dtypes[name],
+            list(lookup_columns),
         )
+        return pd.concat(prep_chunks, ignore_index=True)
 
-    df = pd.DataFrame(cleaned_assessments)
-    df["marks"] = df["marks"].astype(int)
+    counts = {"stage": 0, "prep": 0}
+    lookups = []
 
-    return df
+    def clean_chunks():
+        stage_chunks = read_chunks(
+            stage_path, options.chunk_size, options.stage_format, schema.stage_dtypes(name)
+        )
+        for stage_chunk in stage_chunks:
+            prep_chunk = clean_records(stage_chunk, *args)
+            counts["stage"] += len(stage_chunk)
+            counts["prep"] += len(prep_chunk)
+            lookups.append(prep_chunk[list(lookup_columns)])
+            yield prep_chunk
+
+    with metrics.measure("prep", name):
+        write_chunks(
+            clean_chunks(), prep_path, options.output_format, schema.prep_dtypes[name]
+        )
+    metrics.add(
+        "prep",
+        name,
+        rows_in=counts["stage"],
+        rows_out=counts["prep"],
+        bytes_read=metrics.path_size(stage_path),
+        bytes_written=metrics.path_size(prep_path),
+    )
+    cache.record(f"prep/{name}", key)
+    log_cleaned(name, counts["stage"], counts["prep"])
 
+    return pd.concat(lookups, ignore_index=True)
 
-# Helper Functions
-def validate_id(value):
-    """Validate the ID to ensure it does not contain any symbols or spaces except '-' or '_'."""
-    return bool(re.match(r"^[\w-]+$", value))
 
+# Flag the records updated after `watermark`, every record when it is None
+def updated_since(records, watermark):
 
-def validate_email(email):
-    """Validate the email format."""
-    return bool(re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email))
+    if watermark is None:
+        return pd.Series(True, index=records.index)
 
+    updated_at = strip_strings(records[["updated_at"]])["updated_at"]
+    return parse_datetimes(updated_at) > pd.Timestamp(watermark)
 
-def validate_datetime(date_string):
-    """Validate datetime format."""
-    try:
-        datetime.fromisoformat(date_string)
-        return True
-    except ValueError:
-        return False
 
+# Latest valid updated_at of the records, or `watermark` when there is none later
+def next_watermark(records, watermark):
+
+    updated_at = strip_strings(records[["updated_at"]])["updated_at"]
+    latest = parse_datetimes(updated_at).max()
+    if pd.isnull(latest):
+        return watermark
+    if watermark is not None and latest <= pd.Timestamp(watermark):
+        return watermark
+
+    return latest.isoformat()
+
+
+# Replace the previous records of every id in `rows` with their cleaned version,
+# returns the upserted records and the ids that changed
+def upsert(name, previous, rows, cleaned):
+
+    changed_ids = set(strip_strings(rows[["id"]])["id"].str.lower().dropna())
+    if previous is not None:
+        previous = previous[~previous["id"].isin(changed_ids)]
+        cleaned = pd.concat([previous, cleaned], ignore_index=True)
+
+    logger.info(f"upserted {name}, rechecked: {len(rows)}, count: {len(cleaned)}")
+
+    return cleaned, changed_ids
+
+
+# Clean only the records changed since the previous incremental run.
+#
+# Users, subjects and trainings newer than their `updated_at` watermark are
+# cleaned and upserted by id. Trainings are also rechecked when their subject
+# changed. Assessments have neither id nor updated_at, the staged file is
+# expected to only grow: rows past the previous row count are new, and earlier
+# rows are rechecked only when the user or training they reference changed.
+# Records removed from the inputs are not removed from the prep outputs.
+#
+# The staged files are still read whole, stage rewrites them on every run, but
+# the prep outputs are only written for what changed.
+#
+# The assessments removed and added are saved to `changes_path`, and the ids
+# they changed for to the state, so the report is updated the same way.
+def run_incremental():
+
+    rejects.reset()
+
+    state = {}
+    if os.path.exists(state_path()):
+        with open(state_path()) as file:
+            state = json.load(file)
 
-def run():
     stage_users, stage_subjects, stage_trainings, stage_assessments = (
         load_stage_outputs()
     )
+    prep_users, prep_subjects, prep_trainings, prep_assessments = (
+        load_prep_outputs() if state else (None, None, None, None)
+    )
 
-    # clean users
-    prep_users = clean_users(stage_users)
-    user_discard_count = stage_users.size - prep_users.size
-    logger.info(
-        f"cleaned users, count: {prep_users.size}, discarded: {user_discard_count}"
+    def watermark(name):
+        return state.get(name, {}).get("watermark")
+
+    # upsert users
+    rows = stage_users[updated_since(stage_users, watermark("users"))]
+    prep_users, changed_user_ids = upsert(
+        "users", prep_users, rows, clean_users(rows)
     )
 
-    # clean subjects
-    prep_subjects = clean_subjects(stage_subjects)
-    subject_discard_count = stage_subjects.size - prep_subjects.size
-    logger.info(
-        f"cleaned subjects, count: {prep_subjects.size}, discarded: {subject_discard_count}"
+    # upsert subjects
+    rows = stage_subjects[updated_since(stage_subjects, watermark("subjects"))]
+    prep_subjects, changed_subject_ids = upsert(
+        "subjects", prep_subjects, rows, clean_subjects(rows)
     )
 
-    valid_subject_ids = prep_subjects["id"].tolist()
+    references = ReferenceIndex(users=prep_users, subjects=prep_subjects)
 
-    # clean trainings
-    prep_trainings = clean_trainings(stage_trainings, valid_subject_ids)
-    training_discard_count = stage_trainings.size - prep_trainings.size
-    logger.info(
-        f"cleaned trainings, count: {prep_trainings.size}, discarded: {training_discard_count}"
+    # upsert trainings, rechecking the ones of changed subjects
+    subject_ids = strip_strings(stage_trainings[["subject_id"]])["subject_id"]
+    rows = stage_trainings[
+        updated_since(stage_trainings, watermark("trainings"))
+        | subject_ids.isin(changed_subject_ids)
+    ]
+    prep_trainings, changed_training_ids = upsert(
+        "trainings", prep_trainings, rows, clean_trainings(rows, references)
     )
 
-    valid_user_ids = prep_users["id"].tolist()
-    valid_training_ids = prep_trainings["id"].tolist()
-    subject_max_marks = prep_subjects.set_index("id")["max_marks"].to_dict()
-    training_subject_map = prep_trainings.set_index("id")["subject_id"].to_dict()
-
-    # clean assessments
-    prep_assessments = clean_assessments(
-        stage_assessments,
-        valid_user_ids,
-        valid_training_ids,
-        subject_max_marks,
-        training_subject_map,
+    references.add("trainings", prep_trainings)
+
+    # clean new assessments and recheck the ones of changed users or trainings
+    seen_rows = state.get("assessments", {}).get("rows", 0)
+    if seen_rows > len(stage_assessments):
+        seen_rows, prep_assessments = 0, None
+
+    selected = pd.Series(
+        pd.RangeIndex(len(stage_assessments)) >= seen_rows,
+        index=stage_assessments.index,
     )
-    assessment_discard_count = stage_assessments.size - prep_assessments.size
+    if changed_user_ids or changed_training_ids:
+        keys = strip_strings(stage_assessments[["user_id", "training_id"]])
+        selected |= keys["user_id"].isin(changed_user_ids)
+        selected |= keys["training_id"].isin(changed_training_ids)
+    rows = stage_assessments[selected]
+    with AssessmentCleaner(references) as clean_sharded:
+        cleaned = clean_sharded(rows)
+
+    # the previous assessments of changed users and trainings are replaced by
+    # the rechecked ones, appended after the kept ones
+    removed = cleaned.iloc[:0]
+    added = cleaned
+    append = prep_assessments is not None
+    if prep_assessments is not None:
+        changed = prep_assessments["user_id"].isin(changed_user_ids)
+        changed |= prep_assessments["training_id"].isin(changed_training_ids)
+        removed = prep_assessments[changed]
+        cleaned = pd.concat([prep_assessments[~changed], cleaned], ignore_index=True)
+    kept = len(cleaned) - len(added)
+    prep_assessments = cleaned
     logger.info(
-        f"cleaned assessments, count: {prep_assessments.size}, discarded: {assessment_discard_count}"
+        f"upserted assessments, rechecked: {len(rows)}, count: {len(prep_assessments)}"
+    )
+
+    # only the outputs with changed records are rewritten, and the new
+    # assessments are appended to the previous ones when none was removed
+    saved = []
+    for name, df, changed_ids in [
+        ("users", prep_users, changed_user_ids),
+        ("subjects", prep_subjects, changed_subject_ids),
+        ("trainings", prep_trainings, changed_training_ids),
+    ]:
+        if changed_ids or not state:
+            save_prep_output(name, df)
+            saved.append(name)
+    if append and removed.empty:
+        if not added.empty:
+            save_prep_output("assessments", added, append=True)
+            saved.append("assessments")
+    else:
+        save_prep_output("assessments", prep_assessments)
+        saved.append("assessments")
+    save_rejects()
+    cache.forget(*(f"prep/{name}" for name in saved))
+
+    # every run that saved outputs has its own id, the changes apply to the
+    # outputs of the run they are based on. A run that saved nothing keeps the
+    # id and changes of the previous one, they still describe the outputs.
+    run, changes = state.get("run"), state.get("changes")
+    if saved:
+        os.makedirs(os.path.dirname(changes_path("added_assessments")), exist_ok=True)
+        for name, df in [
+            ("removed_assessments", removed),
+            ("added_assessments", added),
+        ]:
+            write_chunks(
+                [df],
+                changes_path(name),
+                options.output_format,
+                schema.prep_dtypes["assessments"],
+            )
+        run = uuid.uuid4().hex
+        changes = {
+            "base_run": state.get("run"),
+            "users": sorted(changed_user_ids),
+            "trainings": sorted(changed_training_ids),
+            "kept_assessments": kept,
+        }
+
+    state = {
+        "users": {"watermark": next_watermark(stage_users, watermark("users"))},
+        "subjects": {
+            "watermark": next_watermark(stage_subjects, watermark("subjects"))
+        },
+        "trainings": {
+            "watermark": next_watermark(stage_trainings, watermark("trainings"))
+        },
+        "assessments": {"rows": len(stage_assessments)},
+        "run": run,
+        "changes": changes,
+    }
+    with open(state_path(), "w") as file:
+        json.dump(state, file, indent=2)
+
+    metrics.write()
+    logger.info("incremental data cleaning completed and saved to output folder.")
+
+
+# Clean a staged file in the database, writing the prep output from it
+def clean_stage_table(connection, name):
+
+    stage_path = stage_output_path(name)
+    prep_path = prep_output_path(name)
+
+    with metrics.measure("prep", name):
+        stage_chunks = read_chunks(
+            stage_path, options.chunk_size, options.stage_format, schema.stage_dtypes(name)
+        )
+        stage_count = database.load_stage_table(
+            connection,
+            name,
+            (strip_strings(stage_chunk) for stage_chunk in stage_chunks),
+        )
+        database.check_table(connection, name)
+        prep_count = write_chunks(
+            database.prep_chunks(connection, name, options.chunk_size),
+            prep_path,
+            options.output_format,
+            schema.prep_dtypes[name],
+        )
+
+        for reason, count in database.discard_counts(connection, name).items():
+            metrics.count_discards(name, reason, count)
+        if rejects.options.enabled:
+            rejected = database.rejected_rows(connection, name, options.chunk_size)
+            for reason, rows in rejected:
+                rejects.add(name, reason, rows)
+
+    metrics.add(
+        "prep",
+        name,
+        rows_in=stage_count,
+        rows_out=prep_count,
+        bytes_read=metrics.path_size(stage_path),
+        bytes_written=metrics.path_size(prep_path),
     )
+    log_cleaned(name, stage_count, prep_count)
+
 
-    if not os.path.exists(options.output_folder):
-        os.makedirs(options.output_folder)
+# Clean every staged file with the SQL rules of `database`, producing the same
+# prep outputs and rejects as the pandas rules. Trainings and assessments are
+# checked against the prep tables already in the database, through their id
+# indexes, so no entity is ever held in memory at once.
+def run_database():
 
-    # csv file paths
-    prep_users_path = os.path.join(options.output_folder, "users.csv")
-    prep_subjects_path = os.path.join(options.output_folder, "subjects.csv")
-    prep_trainings_path = os.path.join(options.output_folder, "trainings.csv")
-    prep_assessments_path = os.path.join(options.output_folder, "assessments.csv")
+    os.makedirs(options.output_folder, exist_ok=True)
+    remove_state()
 
-    # save cleaned data to csv files
-    prep_users.to_csv(prep_users_path, index=False)
-    prep_subjects.to_csv(prep_subjects_path, index=False)
-    prep_trainings.to_csv(prep_trainings_path, index=False)
-    prep_assessments.to_csv(prep_assessments_path, index=False)
+    reset_rejects()
+
+    connection = database.connect()
+    try:
+        for name in ["users", "subjects", "trainings", "assessments"]:
+            clean_stage_table(connection, name)
+    finally:
+        connection.close()
+
+    # the outputs are rewritten without going through the cache
+    cache.forget("prep/users", "prep/subjects", "prep/trainings", "prep/assessments")
+
+    save_rejects()
+    metrics.write()
+    logger.info("data cleaning completed and saved to output folder.")
+
+
+def run():
+    metrics.reset()
+
+    if options.incremental:
+        run_incremental()
+        return
+
+    if options.backend == "sqlite":
+        run_database()
+        return
+
+    os.makedirs(options.output_folder, exist_ok=True)
+
+    # a full run replaces the outputs the incremental state describes
+    remove_state()
+
+    reset_rejects()
+
+    # every entity is cleaned as soon as the entities it references are, users
+    # concurrently with subjects and trainings
+    def clean_trainings_output(prep_subjects):
+        return clean_stage_output(
+            "trainings",
+            clean_trainings,
+            ReferenceIndex(subjects=prep_subjects),
+            lookup_columns=["id", "subject_id"],
+            dependencies=["subjects"],
+        )
+
+    def clean_assessments_output(prep_users, prep_subjects, prep_trainings):
+        references = ReferenceIndex(prep_users, prep_subjects, prep_trainings)
+        with AssessmentCleaner(references) as clean_sharded:
+            return clean_stage_output(
+                "assessments",
+                clean_sharded,
+                dependencies=["users", "subjects", "trainings"],
+            )
+
+    graph = TaskGraph()
+    graph.add(
+        "users",
+        partial(clean_stage_output, "users", clean_users, lookup_columns=["id"]),
+    )
+    graph.add(
+        "subjects",
+        partial(
+            clean_stage_output,
+            "subjects",
+            clean_subjects,
+            lookup_columns=["id", "max_marks"],
+        ),
+    )
+    graph.add("trainings", clean_trainings_output, ["subjects"])
+    graph.add(
+        "assessments", clean_assessments_output, ["users", "subjects", "trainings"]
+    )
+    graph.run(workers=options.workers)
 
+    save_rejects()
+    metrics.write()
     logger.info("data cleaning completed and saved to output folder.")
 
 
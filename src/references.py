@@ -0,0 +1,45 @@
+import pandas as pd
+
+
+class ReferenceIndex:
+    """Cleaned parent records indexed by id, for foreign-key checks and
+    id -> attribute lookups.
+
+    Each entity is indexed once when added. Checks and lookups then go through
+    the cached hash table of its `pd.Index`, so a column of ids is answered in
+    one vectorized pass, whatever the number of parent records."""
+
+    # attributes kept per entity, besides the id
+    attributes = {
+        "users": [],
+        "subjects": ["max_marks"],
+        "trainings": ["subject_id"],
+    }
+
+    def __init__(self, users=None, subjects=None, trainings=None):
+        self.tables = {}
+        for entity, records in [
+            ("users", users),
+            ("subjects", subjects),
+            ("trainings", trainings),
+        ]:
+            if records is not None:
+                self.add(entity, records)
+
+    def add(self, entity, records):
+        """Index the `records` of `entity` by id, the last record wins for duplicate ids."""
+        table = records.drop_duplicates(subset="id", keep="last").set_index("id")
+        self.tables[entity] = table[self.attributes[entity]]
+
+    def contains(self, entity, ids):
+        """Flag the `ids` that are records of `entity`."""
+        positions = self.tables[entity].index.get_indexer(ids)
+        return pd.Series(positions != -1, index=ids.index)
+
+    def lookup(self, entity, attribute, ids):
+        """Map `ids` to the `attribute` of the `entity` records, NaN where not found."""
+        return ids.map(self.tables[entity][attribute])
+
+    def ids(self, entity):
+        """Return the ids of the `entity` records."""
+        return self.tables[entity].index
@@ -0,0 +1,161 @@
+import os
+import shutil
+import threading
+import pandas as pd
+from . import schema
+from .storage import read_text_chunks, write_chunks
+
+
+# options to configure the reject ledger
+class Options:
+    # keep the rejected rows, their counts per reason are kept by metrics anyway
+    enabled = True
+
+
+options = Options()
+
+# guards the ledger, rows can be rejected from several threads
+lock = threading.Lock()
+
+# rejected rows, one DataFrame per entity and reason and cleaned chunk, with
+# the entity and reason as their first columns
+ledger = []
+
+# where rejected rows are appended as they are added instead of being kept in
+# the ledger, set by `reset`, with the dataset of every entity spilled so far
+spill = None
+spilled = {}
+
+LEDGER_COLUMNS = ["entity", "reason"]
+
+
+def restart_in_child():
+    # a fork copies the lock as it is, held when another thread had it, a
+    # forked worker gets its own
+    global lock
+    lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_in_child)
+
+
+def reset(spill_path=None, file_format="csv", chunk_size=None):
+    """Empty the ledger. With `spill_path`, rows added afterwards are appended to
+    one dataset per entity in that directory, and copied from there by `write`
+    `chunk_size` rows at a time, so they are never all held in memory."""
+    global spill
+    with lock:
+        ledger.clear()
+        spilled.clear()
+        spill = None
+        if spill_path is not None:
+            if os.path.isdir(spill_path):
+                shutil.rmtree(spill_path)
+            os.makedirs(spill_path)
+            spill = {
+                "path": spill_path,
+                "file_format": file_format,
+                "chunk_size": chunk_size,
+            }
+
+
+def add(entity, reason, rows):
+    """Add the `rows` of `entity` rejected for `reason`."""
+    if not options.enabled or len(rows) == 0:
+        return
+
+    rows = rows.copy()
+    rows.insert(0, "reason", reason)
+    rows.insert(0, "entity", entity)
+    with lock:
+        keep(rows)
+
+
+# Append rejected rows to the ledger, or to the spilled dataset of their entity.
+# Called with the lock held.
+def keep(rows):
+
+    if spill is None:
+        ledger.append(rows)
+        return
+
+    entity = rows["entity"].iat[0]
+    if entity not in spilled:
+        spilled[entity] = os.path.join(
+            spill["path"], f"{entity}.{spill['file_format']}"
+        )
+    write_chunks([rows], spilled[entity], spill["file_format"], append=True)
+
+
+def take():
+    """Remove and return every rejected row, to send them to another process."""
+    with lock:
+        rows = list(ledger)
+        ledger.clear()
+    return rows
+
+
+def extend(rows):
+    """Add rejected rows returned by `take` in another process."""
+    with lock:
+        for part in rows:
+            keep(part)
+
+
+def rejected_rows():
+    """Return the rows kept in the ledger as one DataFrame, columns missing for an
+    entity are NaN.
+
+    Entities are in schema order, whichever order they were cleaned in."""
+    with lock:
+        if not ledger:
+            return pd.DataFrame(columns=LEDGER_COLUMNS)
+        rows = sorted(ledger, key=lambda part: entity_order(part["entity"].iat[0]))
+        return pd.concat(rows, ignore_index=True)
+
+
+def entity_order(entity):
+    if entity in schema.ENTITIES:
+        return schema.ENTITIES.index(entity)
+    return len(schema.ENTITIES)
+
+
+def write(file_path, file_format="csv"):
+    """Write the ledger to `file_path`, returns the rows written. Spilled rows are
+    written as `rejected_rows` would return them, then their datasets removed,
+    rows added afterwards are kept in memory."""
+    global spill
+    if spill is None:
+        return write_chunks([rejected_rows()], file_path, file_format)
+
+    with lock:
+        paths = [spilled[entity] for entity in sorted(spilled, key=entity_order)]
+        file_format = spill["file_format"]
+        chunk_size = spill["chunk_size"]
+
+        # the columns of every entity, in the order concatenating them gives
+        columns = list(LEDGER_COLUMNS)
+        for path in paths:
+            header = next(read_text_chunks(path, 1, file_format)).columns
+            columns += [column for column in header if column not in columns]
+
+        chunks = (
+            chunk.reindex(columns=columns)
+            for path in paths
+            for chunk in read_text_chunks(path, chunk_size, file_format)
+        )
+        if not paths:
+            chunks = [pd.DataFrame(columns=LEDGER_COLUMNS)]
+        rows = write_chunks(
+            chunks,
+            file_path,
+            file_format,
+            {column: schema.TEXT for column in columns},
+        )
+
+        shutil.rmtree(spill["path"])
+        spilled.clear()
+        spill = None
+
+    return rows
@@ -1,6 +1,23 @@
 import pandas as pd
+import json
 import os
+import shutil
+from . import cache, database, metrics, schema
+from .aggregates import DTYPES, TABLES, Aggregates
 from .logger import create_logger
+from .storage import (
+    DEFAULT_FORMAT,
+    MANIFEST_FILE,
+    copy_dataset,
+    file_name,
+    filter_chunks,
+    filter_partitioned,
+    read_chunks,
+    read_file,
+    read_manifest,
+    write_chunks,
+    write_partitioned,
+)
 
 logger = create_logger("report")
 
@@ -8,90 +25,474 @@ logger = create_logger("report")
 class Options:
     prep_dir = "out/prep"
     report_dir = "out/report"
+    # rows of assessments per chunk to stream the report with, None loads the
+    # whole file at once
+    chunk_size = None
+    # format of the prep files read, "csv" or "parquet"
+    prep_format = DEFAULT_FORMAT
+    # "pandas", or "sqlite" to join the prep files as tables bulk-loaded into
+    # `database.options.path`
+    backend = "pandas"
+    # format of the report files, "csv" or "parquet", and their compression,
+    # None, "gzip" or "zstd"
+    report_format = "csv"
+    compression = None
+    # column to partition the report by in the Hive layout, "subject_id" or
+    # "training_id", None writes a single file
+    partition_by = None
+    # hash the partition values into this many directories, None writes one
+    # directory per value
+    partition_buckets = None
+    # threads writing the partition files concurrently
+    writers = 4
+    # also write the aggregate tables of the report, in `report_format`
+    aggregates = True
+    # update the report and its aggregates from the changes of the last
+    # incremental prep run instead of joining every assessment again, changes
+    # are joined with pandas whatever the backend. The report is rebuilt when
+    # the changes do not follow the prep run it was last generated from.
+    incremental = False
 
 
 options = Options()
 
+# entities the assessments of the report are joined with
+PARENTS = ["users", "subjects", "trainings"]
+
+# prep columns the report reads from every entity
+report_columns = {
+    "users": ["id", "email", "first_name", "last_name"],
+    "subjects": ["id", "name", "max_marks"],
+    "trainings": ["id", "name", "subject_id", "mode"],
+    "assessments": ["user_id", "training_id", "marks", "internet_allowed"],
+}
+
 
 def generate_report(users, subjects, trainings, assessments):
-    """Generate the performance report by merging users, subjects, trainings, and assessments."""
+    """Generate the performance report by looking up the training, subject and user of every assessment."""
+    return join_report(*index_report_tables(users, subjects, trainings), assessments)
 
-    # Merge assessments with trainings on 'training_id'
-    assessments_trainings = pd.merge(
-        assessments, trainings, left_on="training_id", right_on="id", how="left"
-    )
 
-    # Merge the above result with subjects on 'subject_id'
-    assessments_trainings_subjects = pd.merge(
-        assessments_trainings, subjects, left_on="subject_id", right_on="id", how="left"
-    )
+def index_report_tables(users, subjects, trainings):
+    """Project users, subjects and trainings down to the report columns, indexed by id."""
+    users = index_by_id(users, ["email", "first_name", "last_name"])
+    subjects = index_by_id(subjects, ["name", "max_marks"])
+    trainings = index_by_id(trainings, ["name", "subject_id", "mode"])
+
+    return users, subjects, trainings
+
 
-    # Merge the result with users on 'user_id'
-    report_data = pd.merge(
-        assessments_trainings_subjects,
-        users,
-        left_on="user_id",
-        right_on="id",
-        how="left",
+def index_by_id(records, columns):
+    # the last record wins for duplicate ids, as in prep lookups
+    return records.drop_duplicates(subset="id", keep="last").set_index("id")[columns]
+
+
+def join_report(users, subjects, trainings, assessments):
+    """Join assessments with tables from `index_report_tables` in one indexed lookup per table."""
+
+    # Look up the training of every assessment, then its subject, and its user
+    training = trainings.reindex(assessments["training_id"].to_numpy())
+    subject = subjects.reindex(training["subject_id"].to_numpy())
+    user = users.reindex(assessments["user_id"].to_numpy())
+
+    report_data = pd.DataFrame(
+        {
+            "user_id": assessments["user_id"].to_numpy(),
+            "email": user["email"].to_numpy(),
+            "first_name": user["first_name"].to_numpy(),
+            "last_name": user["last_name"].to_numpy(),
+            "training_id": assessments["training_id"].to_numpy(),
+            "name_x": training["name"].to_numpy(),  # Training name
+            "subject_id": training["subject_id"].to_numpy(),
+            "name_y": subject["name"].to_numpy(),  # Subject name
+            "marks": assessments["marks"].to_numpy(),
+            "max_marks": subject["max_marks"].to_numpy(),
+        }
     )
 
     # Create 'is_passed' column: True if 'marks' >= 'max_marks'
     report_data["is_passed"] = report_data["marks"] >= report_data["max_marks"]
 
-    # Select relevant columns for the report
-    report_data = report_data[
-        [
-            "user_id",
-            "email",
-            "first_name",
-            "last_name",
-            "training_id",
-            "name_x",  # Training name
-            "subject_id",
-            "name_y",  # Subject name
-            "marks",
-            "max_marks",
-            "is_passed",  # True if 'marks' >= 'max_marks', else False
-        ]
-    ]
-
     return report_data
 
 
+def aggregate_rows(report_data, trainings, assessments):
+    """Return the report rows with the columns the aggregates group them by, from
+    the trainings of `index_report_tables` and the assessments of the rows."""
+    rows = report_data[["user_id", "training_id", "subject_id", "marks", "is_passed"]]
+    training = trainings.reindex(report_data["training_id"].to_numpy())
+    rows = rows.assign(
+        mode=training["mode"].to_numpy(),
+        internet_allowed=assessments["internet_allowed"].to_numpy(),
+    )
+    return rows
+
+
+def join_report_chunks(users, subjects, trainings, assessments_path, aggregates):
+    """Join the assessments of `assessments_path`, in chunks of
+    `options.chunk_size` rows, with tables from `index_report_tables`.
+
+    The rows of every chunk are counted in `aggregates`."""
+    for assessments in read_chunks(
+        assessments_path,
+        options.chunk_size,
+        options.prep_format,
+        schema.prep_dtypes["assessments"],
+        report_columns["assessments"],
+    ):
+        report_chunk = join_report(users, subjects, trainings, assessments)
+        aggregates.add(aggregate_rows(report_chunk, trainings, assessments))
+        yield report_chunk
+
+
+def database_report(prep_paths, aggregates):
+    """Load the report columns of the prep files into the database and join
+    them there, returns the report in chunks of `options.chunk_size` rows.
+
+    The rows of every chunk are counted in `aggregates`."""
+    connection = database.connect()
+
+    for entity, path in prep_paths.items():
+        chunks = read_chunks(
+            path,
+            options.chunk_size,
+            options.prep_format,
+            schema.prep_dtypes[entity],
+            report_columns[entity],
+        )
+        database.load_table(
+            connection, f"report_{entity}", report_columns[entity], chunks
+        )
+
+    for entity in ["users", "subjects", "trainings"]:
+        database.create_index(connection, f"report_{entity}", "id", "row")
+    database.create_index(connection, "report_assessments", "user_id")
+    database.create_index(connection, "report_assessments", "training_id")
+
+    try:
+        for chunk in database.report_chunks(connection, options.chunk_size):
+            aggregates.add(chunk)
+            yield chunk.drop(columns=["mode", "internet_allowed"])
+    finally:
+        connection.close()
+
+
+def report_path():
+    """Path of the report, a directory with a manifest when it is partitioned."""
+    if options.partition_by is not None:
+        return os.path.join(options.report_dir, "report")
+
+    name = file_name("report", options.report_format, options.compression)
+    return os.path.join(options.report_dir, name)
+
+
+def write_report(report_data, append=False):
+    """Write the report, a DataFrame or an iterable of DataFrame chunks, to
+    `report_path()` in the format the options set, returns the rows written.
+
+    With `append` the rows are added to the existing report."""
+    if isinstance(report_data, pd.DataFrame):
+        report_data = [report_data]
+
+    path = report_path()
+    if options.partition_by is None:
+        rows = write_chunks(
+            report_data,
+            path,
+            options.report_format,
+            compression=options.compression,
+            append=append,
+        )
+    else:
+        previous_rows = 0
+        if append and os.path.exists(os.path.join(path, MANIFEST_FILE)):
+            previous_rows = read_manifest(path)["rows"]
+        manifest = write_partitioned(
+            report_data,
+            path,
+            options.partition_by,
+            options.report_format,
+            compression=options.compression,
+            buckets=options.partition_buckets,
+            workers=options.writers,
+            append=append,
+        )
+        rows = manifest["rows"] - previous_rows
+
+    logger.info(f"Report saved to {path}")
+    return rows
+
+
+def remove_report_rows(keep):
+    """Rewrite the report with only the rows flagged by `keep`."""
+    path = report_path()
+    if options.partition_by is None:
+        filter_chunks(
+            path,
+            keep,
+            options.report_format,
+            options.compression,
+            options.chunk_size,
+        )
+    else:
+        filter_partitioned(path, keep, options.writers)
+
+
+def aggregates_dir():
+    return os.path.join(options.report_dir, "aggregates")
+
+
+def save_aggregates(aggregates):
+    """Write every aggregate table to `aggregates_dir()`."""
+    os.makedirs(aggregates_dir(), exist_ok=True)
+
+    for table, df in aggregates.tables().items():
+        table_path = os.path.join(
+            aggregates_dir(), file_name(table, options.report_format)
+        )
+        write_chunks([df], table_path, options.report_format)
+
+    logger.info(f"Aggregates saved to {aggregates_dir()}")
+
+
 def save_report(report_data, report_file_path):
-    """Save the final report to CSV."""
-    report_data.to_csv(report_file_path, index=False)
+    """Save the final report, a DataFrame or an iterable of DataFrame chunks, to CSV."""
+    if isinstance(report_data, pd.DataFrame):
+        report_data = [report_data]
+
+    rows = write_chunks(report_data, report_file_path)
     logger.info(f"Report saved to {report_file_path}")
+    return rows
+
+
+def read_prep_output(path, entity):
+    return read_file(
+        path, options.prep_format, schema.prep_dtypes[entity], report_columns[entity]
+    )
+
+
+def read_parents(path_of):
+    """Read the parents of the report from the prep file `path_of` every entity,
+    indexed by `index_report_tables`."""
+    return index_report_tables(
+        *(read_prep_output(path_of(entity), entity) for entity in PARENTS)
+    )
+
+
+def prep_path(name):
+    return os.path.join(options.prep_dir, file_name(name, options.prep_format))
+
+
+# changes of the last incremental prep run, and its state
+def changes_path(name):
+    return os.path.join(
+        options.prep_dir, "changes", file_name(name, options.prep_format)
+    )
+
+
+def prep_state_path():
+    return os.path.join(options.prep_dir, "state.json")
+
+
+# The state of an incremental report: the parents its assessments were joined
+# with, the counts of its aggregates, its rows and the prep run it reflects.
+def state_dir():
+    return os.path.join(options.report_dir, "state")
+
+
+def state_path():
+    return os.path.join(state_dir(), "state.json")
+
+
+def parent_path(entity):
+    return os.path.join(state_dir(), file_name(entity, options.prep_format))
+
+
+def counts_path(table):
+    return os.path.join(state_dir(), "counts", file_name(table, options.prep_format))
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file:
+        return json.load(file)
+
+
+# options the report files are written with, the state only applies to a
+# report written with the same ones
+def report_settings():
+    names = ["prep_format", "report_format", "compression"]
+    names += ["partition_by", "partition_buckets"]
+    return {name: getattr(options, name) for name in names}
+
+
+def save_state(aggregates, rows, prep_paths):
+    """Save the state the next incremental run updates the report from."""
+    remove_state()
+    os.makedirs(os.path.dirname(counts_path("users")))
+
+    for entity in PARENTS:
+        copy_dataset(prep_paths[entity], parent_path(entity))
+    for table, counts in aggregates.counts.items():
+        if counts is not None:
+            counts = counts.reset_index()
+            write_chunks([counts], counts_path(table), options.prep_format)
+
+    state = {
+        "prep_run": (load_json(prep_state_path()) or {}).get("run"),
+        "rows": rows,
+        "settings": report_settings(),
+    }
+    with open(state_path(), "w") as file:
+        json.dump(state, file, indent=2)
+
+
+def remove_state():
+    """Drop the incremental state, for a report rewritten by a full run."""
+    shutil.rmtree(state_dir(), ignore_errors=True)
+
+
+def load_counts():
+    """Return the aggregates saved with the state."""
+    aggregates = Aggregates()
+    for table, keys in TABLES.items():
+        if not os.path.exists(counts_path(table)):
+            continue
+
+        columns = keys + ["marks", "count", "passed"]
+        counts = read_file(
+            counts_path(table),
+            options.prep_format,
+            {column: DTYPES[column] for column in columns},
+        )
+        aggregates.counts[table] = counts.set_index(keys + ["marks"])
+
+    return aggregates
+
+
+# Update the report with the changes of the last incremental prep run instead
+# of joining every assessment again. The rows of the assessments it removed are
+# removed from the report, and uncounted from the aggregates with the parents
+# they were joined with. The assessments it added are joined with the indexed
+# parents and appended. Returns the aggregates, the rows joined and the rows of
+# the report, or None when the changes do not follow the prep run of the state.
+def update_report(prep_paths):
+
+    state = load_json(state_path())
+    changes = (load_json(prep_state_path()) or {}).get("changes")
+    if (
+        state is None
+        or changes is None
+        or changes["base_run"] is None
+        or changes["base_run"] != state["prep_run"]
+        or state["settings"] != report_settings()
+        or not os.path.exists(report_path())
+    ):
+        return None
+
+    # every prep assessment is one report row, so the report rows kept are
+    # the prep assessments kept
+    removed = read_prep_output(changes_path("removed_assessments"), "assessments")
+    if state["rows"] - len(removed) != changes["kept_assessments"]:
+        return None
+
+    aggregates = load_counts()
+    if len(removed):
+        users, subjects, trainings = read_parents(parent_path)
+        report_data = join_report(users, subjects, trainings, removed)
+        aggregates.remove(aggregate_rows(report_data, trainings, removed))
+
+        changed_users = set(changes["users"])
+        changed_trainings = set(changes["trainings"])
+        remove_report_rows(
+            lambda rows: ~rows["user_id"].isin(changed_users)
+            & ~rows["training_id"].isin(changed_trainings)
+        )
+
+    users, subjects, trainings = read_parents(prep_paths.get)
+    rows = write_report(
+        join_report_chunks(
+            users,
+            subjects,
+            trainings,
+            changes_path("added_assessments"),
+            aggregates,
+        ),
+        append=True,
+    )
+    logger.info(f"Report updated, rows removed: {len(removed)}, added: {rows}")
+
+    return aggregates, rows, changes["kept_assessments"] + rows
 
 
 def run():
 
+    metrics.reset()
+
     # Create report dir if it doesn't exist
     os.makedirs(options.report_dir, exist_ok=True)
 
     logger.info("Loading staged data...")
 
     # Load all staged data
-    prep_users_path = os.path.join(options.prep_dir, "users.csv")
-    prep_subjects_path = os.path.join(options.prep_dir, "subjects.csv")
-    prep_trainings_path = os.path.join(options.prep_dir, "trainings.csv")
-    prep_assessments_path = os.path.join(options.prep_dir, "assessments.csv")
+    prep_paths = {entity: prep_path(entity) for entity in schema.ENTITIES}
+
+    # Define the report file path
+    report_file_path = report_path()
 
-    users = pd.read_csv(prep_users_path)
-    subjects = pd.read_csv(prep_subjects_path)
-    trainings = pd.read_csv(prep_trainings_path)
-    assessments = pd.read_csv(prep_assessments_path)
+    # Skip the report when none of the prep data changed since it was generated
+    key = cache.cache_key(options, *prep_paths.values())
+    if cache.is_fresh("report", key, report_file_path):
+        logger.info("Report generation skipped, prep data unchanged.")
+        return
 
-    logger.info("Generating report...")
+    with metrics.measure("report", "report"):
+        logger.info("Generating report...")
 
-    # Generate the performance report
-    report_data = generate_report(users, subjects, trainings, assessments)
+        updated = update_report(prep_paths) if options.incremental else None
+        if updated is not None:
+            aggregates, rows_in, rows = updated
+        else:
+            if options.incremental:
+                logger.info("Report state does not match prep changes, rebuilding.")
 
-    # Define the report file path
-    report_file_path = os.path.join(options.report_dir, "report.csv")
+            # aggregates are counted in the same pass over the report chunks
+            aggregates = Aggregates()
+
+            if options.backend == "sqlite":
+                report_data = database_report(prep_paths, aggregates)
+            else:
+                users, subjects, trainings = read_parents(prep_paths.get)
 
-    # Save the report
-    save_report(report_data, report_file_path)
+                # Generate the performance report, streaming assessments in chunks
+                report_data = join_report_chunks(
+                    users, subjects, trainings, prep_paths["assessments"], aggregates
+                )
+
+            # Save the report
+            rows = rows_in = write_report(report_data)
+
+        if options.aggregates:
+            save_aggregates(aggregates)
+
+    if options.incremental:
+        save_state(aggregates, rows, prep_paths)
+    else:
+        remove_state()
+
+    # every assessment joined is one report row
+    metrics.add(
+        "report",
+        "report",
+        rows_in=rows_in,
+        rows_out=rows,
+        bytes_read=sum(metrics.path_size(path) for path in prep_paths.values()),
+        bytes_written=metrics.path_size(report_file_path),
+    )
+    cache.record("report", key)
+    metrics.write()
 
     logger.info("Report generation completed.")
 
@@ -0,0 +1,127 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .logger import create_logger
+
+logger = create_logger("scheduler")
+
+
+class TaskError(Exception):
+    """Raised once every task that could run has run, with the error of each
+    task that failed in `errors`, and the tasks not run because one of their
+    inputs failed in `skipped`."""
+
+    def __init__(self, errors, skipped):
+        self.errors = errors
+        self.skipped = skipped
+        super().__init__(f"tasks failed: {', '.join(errors)}")
+
+
+class TaskGraph:
+    """Named tasks with declared inputs, run on a thread pool as soon as their
+    inputs are done.
+
+    A task is called with the results of its inputs, in the order they were
+    declared, and its inputs must be added before it, so the graph has no
+    cycles. Independent tasks run concurrently, the runtime of the graph is
+    then the one of its critical path, the longest chain of dependent tasks,
+    which is logged after every run."""
+
+    def __init__(self):
+        self.tasks = {}
+        self.results = {}
+        self.seconds = {}
+
+    def add(self, name, function, inputs=()):
+        for input_name in inputs:
+            if input_name not in self.tasks:
+                raise ValueError(f"input '{input_name}' of task '{name}' is not a task")
+        self.tasks[name] = (function, list(inputs))
+
+    def put(self, name, result):
+        """Add a task that is already done, with its `result`."""
+        self.tasks[name] = (None, [])
+        self.results[name] = result
+
+    def required(self, targets):
+        """Return the names of `targets` and of every task they depend on."""
+        names = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in names:
+                names.add(name)
+                pending.extend(self.tasks[name][1])
+        return names
+
+    def call(self, name):
+        function, inputs = self.tasks[name]
+        start = time.perf_counter()
+        result = function(*(self.results[input_name] for input_name in inputs))
+        self.seconds[name] = time.perf_counter() - start
+        return result
+
+    def run(self, targets=None, workers=4):
+        """Run `targets` and the tasks they depend on, every task when None.
+
+        Tasks that already ran are not run again. Returns the results of every
+        task run so far, by name."""
+        pending = self.required(self.tasks if targets is None else targets)
+        pending -= set(self.results)
+        errors = {}
+        skipped = []
+        running = {}
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                # tasks are added after their inputs, so in one pass over them
+                # every task a failure propagates to is skipped
+                for name in [name for name in self.tasks if name in pending]:
+                    inputs = self.tasks[name][1]
+                    if any(
+                        input_name in errors or input_name in skipped
+                        for input_name in inputs
+                    ):
+                        pending.discard(name)
+                        skipped.append(name)
+                    elif all(input_name in self.results for input_name in inputs):
+                        pending.discard(name)
+                        running[executor.submit(self.call, name)] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        errors[name] = future.exception()
+                        logger.error(f"task {name} failed, error: {errors[name]}.")
+                    else:
+                        self.results[name] = future.result()
+
+        if errors:
+            raise TaskError(errors, skipped)
+
+        path, seconds = self.critical_path()
+        logger.info(
+            f"tasks done in {time.perf_counter() - start:.3f}s, critical path: "
+            f"{' > '.join(path)} ({seconds:.3f}s)"
+        )
+        return self.results
+
+    def critical_path(self):
+        """Return the chain of dependent tasks that took the longest, with its
+        seconds."""
+        longest = {}
+        for name, (_, inputs) in self.tasks.items():
+            if name not in self.seconds:
+                continue
+            path, seconds = max(
+                (longest[input_name] for input_name in inputs if input_name in longest),
+                key=lambda chain: chain[1],
+                default=([], 0.0),
+            )
+            longest[name] = (path + [name], seconds + self.seconds[name])
+
+        return max(longest.values(), key=lambda chain: chain[1], default=([], 0.0))
@@ -0,0 +1,104 @@
+import pandas as pd
+
+TEXT = "object"
+DATETIME = "datetime64[ns]"
+
+# entities in the order of their foreign keys, parents first
+ENTITIES = ["users", "subjects", "trainings", "assessments"]
+
+ROLES = ["admin", "employee"]
+MODES = ["online", "offline", "onsite"]
+
+# Columns stage keeps from every input file, mapped to their staged name
+input_columns = {
+    "users": {
+        "id": "id",
+        "email": "email",
+        "first_name": "first_name",
+        "middle_name": "middle_name",
+        "last_name": "last_name",
+        "role": "role",
+        "createdAt": "created_at",
+        "updatedAt": "updated_at",
+    },
+    "subjects": {
+        "id": "id",
+        "name": "name",
+        "minMarks": "min_marks",
+        "maxMarks": "max_marks",
+        "totalTime": "total_time",
+        "createdBy": "created_by",
+        "createdAt": "created_at",
+        "updatedAt": "updated_at",
+    },
+    "trainings": {
+        "id": "id",
+        "name": "name",
+        "mode": "mode",
+        "subjectId": "subject_id",
+        "startedAt": "started_at",
+        "endedAt": "ended_at",
+        "createdAt": "created_at",
+        "updatedAt": "updated_at",
+    },
+    "assessments": {
+        "userId": "user_id",
+        "trainingId": "training_id",
+        "marks": "marks",
+        "internetAllowed": "internet_allowed",
+    },
+}
+
+# Dtypes of the cleaned records, prep validates every staged value and
+# converts it to these
+prep_dtypes = {
+    "users": {
+        "id": TEXT,
+        "email": TEXT,
+        "first_name": TEXT,
+        "middle_name": TEXT,
+        "last_name": TEXT,
+        "role": pd.CategoricalDtype(ROLES),
+        "created_at": DATETIME,
+        "updated_at": DATETIME,
+    },
+    "subjects": {
+        "id": TEXT,
+        "name": TEXT,
+        "min_marks": "int64",
+        "max_marks": "int64",
+        "total_time": "int64",
+        "created_at": DATETIME,
+        "updated_at": DATETIME,
+    },
+    "trainings": {
+        "id": TEXT,
+        "name": TEXT,
+        "mode": pd.CategoricalDtype(MODES),
+        "subject_id": TEXT,
+        "started_at": DATETIME,
+        "ended_at": DATETIME,
+        "created_at": DATETIME,
+        "updated_at": DATETIME,
+    },
+    "assessments": {
+        "user_id": TEXT,
+        "training_id": TEXT,
+        "marks": "int64",
+        "internet_allowed": "bool",
+    },
+}
+
+
+def input_dtypes(entity):
+    """Dtypes of the input columns, read as text since inputs are not validated yet."""
+    return {column: TEXT for column in input_columns[entity]}
+
+
+def stage_dtypes(entity):
+    """Dtypes of the staged columns, text like the inputs they are renamed from."""
+    return {column: TEXT for column in input_columns[entity].values()}
+
+
+def datetime_columns(dtypes):
+    return [column for column, dtype in dtypes.items() if dtype == DATETIME]
@@ -0,0 +1,310 @@
+import glob
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+import numpy as np
+from . import report
+from .aggregates import PERCENTILES
+from .logger import create_logger
+from .schema import TEXT
+from .storage import read_file, read_partitioned
+
+logger = create_logger("service")
+
+
+# options to configure the query service, the report and prep files it reads
+# are the ones `report.options` sets
+class Options:
+    # the service only listens on the local host
+    host = "127.0.0.1"
+    port = 8080
+    # results kept per query, the least recently used are dropped first
+    cache_size = 4096
+    # seconds between checks for a new report, queries in between are
+    # answered from the one loaded
+    check_seconds = 1.0
+
+
+options = Options()
+
+# text columns of the report, read as text whatever their values look like
+report_dtypes = {
+    column: TEXT
+    for column in [
+        "user_id",
+        "email",
+        "first_name",
+        "last_name",
+        "training_id",
+        "name_x",
+        "subject_id",
+        "name_y",
+    ]
+}
+
+# queries by the path of their resource, /<resource>/<id>/scores
+QUERIES = {
+    "users": "user_scores",
+    "subjects": "subject_scores",
+    "trainings": "training_scores",
+}
+
+
+def report_version():
+    """Sizes and modification times of the report files, they change whenever
+    the pipeline publishes a new report."""
+    path = report.report_path()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "**", "*"), recursive=True))
+
+    return tuple(
+        (file_path, os.stat(file_path).st_mtime_ns, os.stat(file_path).st_size)
+        for file_path in paths
+        if os.path.isfile(file_path)
+    )
+
+
+def read_report():
+    path = report.report_path()
+    if report.options.partition_by is not None:
+        return read_partitioned(path, report_dtypes, report.options.writers)
+    return read_file(path, report.options.report_format, report_dtypes)
+
+
+def summary(marks, is_passed):
+    """Count, passes, mean and nearest-rank percentiles of `marks`, as in the
+    aggregate tables."""
+    count = len(marks)
+    result = {"count": count, "passed": int(is_passed.sum())}
+    result["pass_rate"] = result["passed"] / count if count else None
+    result["mean_marks"] = float(marks.mean()) if count else None
+    for percentile in PERCENTILES:
+        result[f"p{percentile}_marks"] = (
+            int(np.percentile(marks, percentile, method="inverted_cdf"))
+            if count
+            else None
+        )
+
+    return result
+
+
+def records(df):
+    """Rows of `df` as dicts of plain values, missing ones as None."""
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+class ReportIndex:
+    """The report and the prep users, subjects and trainings held in memory,
+    with the positions of the report rows of every user, training and subject.
+
+    Every query of an id is answered from the rows at its positions, and its
+    result is kept in an LRU cache of the index. A new report is loaded into a
+    new index, so the results of the previous one are never served again."""
+
+    def __init__(self, report_data, users, subjects, trainings, version=None):
+        self.report = report_data.reset_index(drop=True)
+        self.users = users
+        self.subjects = subjects
+        self.trainings = trainings
+        self.version = version
+
+        self.positions = {
+            column: self.report.groupby(column, sort=False).indices
+            for column in ["user_id", "training_id", "subject_id"]
+        }
+
+        self.user_scores = lru_cache(maxsize=options.cache_size)(self.query_user)
+        self.subject_scores = lru_cache(maxsize=options.cache_size)(
+            self.query_subject
+        )
+        self.training_scores = lru_cache(maxsize=options.cache_size)(
+            self.query_training
+        )
+
+    def rows(self, column, value, columns):
+        positions = self.positions[column].get(value, np.array([], dtype=int))
+        return self.report.iloc[positions][columns]
+
+    def scores(self, column, value, columns):
+        rows = self.rows(column, value, columns + ["marks", "is_passed"])
+        return {
+            "summary": summary(rows["marks"], rows["is_passed"]),
+            "scores": records(rows),
+        }
+
+    def query_user(self, user_id):
+        """The user with the scores of their assessments, None for an unknown id."""
+        if user_id not in self.users.index:
+            return None
+
+        user = self.users.loc[user_id]
+        result = {
+            "user_id": user_id,
+            "email": user["email"],
+            "first_name": user["first_name"],
+            "last_name": user["last_name"],
+        }
+        columns = ["training_id", "name_x", "subject_id", "name_y", "max_marks"]
+        result.update(self.scores("user_id", user_id, columns))
+        return result
+
+    def query_subject(self, subject_id):
+        """The subject with the scores of every assessment of its trainings."""
+        if subject_id not in self.subjects.index:
+            return None
+
+        subject = self.subjects.loc[subject_id]
+        result = {
+            "subject_id": subject_id,
+            "name": subject["name"],
+            "max_marks": int(subject["max_marks"]),
+        }
+        columns = ["user_id", "training_id"]
+        result.update(self.scores("subject_id", subject_id, columns))
+        return result
+
+    def query_training(self, training_id):
+        """The training with the scores of its assessments."""
+        if training_id not in self.trainings.index:
+            return None
+
+        training = self.trainings.loc[training_id]
+        result = {
+            "training_id": training_id,
+            "name": training["name"],
+            "mode": training["mode"],
+            "subject_id": training["subject_id"],
+        }
+        result.update(self.scores("training_id", training_id, ["user_id"]))
+        return result
+
+    def cache_info(self):
+        return {
+            name: getattr(self, name).cache_info()._asdict()
+            for name in QUERIES.values()
+        }
+
+
+def load_index():
+    """Read the prep parents and the report into a `ReportIndex`."""
+    start = time.perf_counter()
+    # the version is taken first, a report written while it is read is loaded
+    # again at the next check
+    version = report_version()
+    users, subjects, trainings = report.read_parents(report.prep_path)
+    index = ReportIndex(read_report(), users, subjects, trainings, version)
+
+    logger.info(
+        f"report loaded, rows: {len(index.report)}, "
+        f"in {time.perf_counter() - start:.3f}s"
+    )
+    return index
+
+
+class QueryService:
+    """Score queries over the prep data and the report, loaded once and held in
+    memory until the pipeline publishes a new report.
+
+    Ids are matched as prep stores them, trimmed and lowercase. Results are
+    shared between the calls that hit the cache, they should not be changed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.checked_at = None
+
+    def current(self):
+        """Return the index of the published report, loading it again when the
+        report changed since the last check."""
+        now = time.monotonic()
+        if self.index is not None and now - self.checked_at < options.check_seconds:
+            return self.index
+
+        with self.lock:
+            if self.index is None or report_version() != self.index.version:
+                self.index = load_index()
+            self.checked_at = time.monotonic()
+
+        return self.index
+
+    def user_scores(self, user_id):
+        return self.current().user_scores(normalize_id(user_id))
+
+    def subject_scores(self, subject_id):
+        return self.current().subject_scores(normalize_id(subject_id))
+
+    def training_scores(self, training_id):
+        return self.current().training_scores(normalize_id(training_id))
+
+    def health(self):
+        index = self.current()
+        return {"rows": len(index.report), "cache": index.cache_info()}
+
+
+def normalize_id(value):
+    return str(value).strip().lower()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answer GET /<users|subjects|trainings>/<id>/scores and GET /health with
+    JSON, from the `service` of the server."""
+
+    def do_GET(self):
+        service = self.server.service
+        parts = [unquote(part) for part in urlparse(self.path).path.split("/") if part]
+
+        if parts == ["health"]:
+            self.send_json(200, service.health())
+        elif len(parts) == 3 and parts[0] in QUERIES and parts[2] == "scores":
+            result = getattr(service, QUERIES[parts[0]])(parts[1])
+            if result is None:
+                self.send_json(404, {"error": f"unknown {parts[0]} id '{parts[1]}'"})
+            else:
+                self.send_json(200, result)
+        else:
+            self.send_json(404, {"error": f"unknown path '{self.path}'"})
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(service=None, host=None, port=None):
+    """Return an HTTP server answering the queries of `service`, one thread per
+    request, to start with `serve_forever`."""
+    host = options.host if host is None else host
+    port = options.port if port is None else port
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.service = QueryService() if service is None else service
+    return server
+
+
+def run():
+    server = serve()
+    # load the report before the first query
+    server.service.current()
+
+    host, port = server.server_address[:2]
+    logger.info(f"serving queries on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,11 +1,29 @@
 import os
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from . import cache, metrics, schema
 from .logger import create_logger
+from .storage import (
+    DEFAULT_FORMAT,
+    file_name,
+    read_chunks,
+    read_file,
+    write_chunks,
+)
 
 
 class Options:
     input_dir = "out/input"
     stage_dir = "out/stage"
+    # rows per chunk to stream files with, None loads whole files at once
+    chunk_size = None
+    # format of the staged files, "csv" or "parquet"
+    stage_format = DEFAULT_FORMAT
+    # threads staging entities concurrently, 1 stages them one after another
+    workers = 4
+    # csv parser of the input files, "c" or "pyarrow" to parse on several
+    # threads, and whether the c parser reads them through a memory map
+    csv_engine = "c"
+    memory_map = True
 
 
 options = Options()
@@ -14,176 +32,198 @@ logger = create_logger("stage")
 
 
 def load_users(input_file_path, stage_file_path):
+    load("users", input_file_path, stage_file_path)
 
-    df = pd.read_csv(input_file_path)
-
-    # Select the relevant columns
-    df = df.filter(
-        items=[
-            "id",
-            "email",
-            "first_name",
-            "middle_name",
-            "last_name",
-            "role",
-            "createdAt",
-            "updatedAt",
-        ]
-    )
 
-    # Rename headers to snake_case
-    df.rename(
-        columns={
-            "userId": "user_id",
-            "firstName": "first_name",
-            "middleName": "middle_name",
-            "lastName": "last_name",
-            "createdAt": "created_at",
-            "updatedAt": "updated_at",
-        },
-        inplace=True,
-    )
+def load_subjects(input_file_path, stage_file_path):
+    load("subjects", input_file_path, stage_file_path)
 
-    df.to_csv(stage_file_path, index=False)
 
+def load_trainings(input_file_path, stage_file_path):
+    load("trainings", input_file_path, stage_file_path)
 
-def load_subjects(input_file_path, stage_file_path):
 
-    df = pd.read_csv(input_file_path)
-
-    # Select the relevant columns
-    df = df.filter(
-        items=[
-            "id",
-            "name",
-            "minMarks",
-            "maxMarks",
-            "totalTime",
-            "createdBy",
-            "createdAt",
-            "updatedAt",
-        ]
+def load_assessments(input_file_path, stage_file_path):
+    load("assessments", input_file_path, stage_file_path)
+
+
+# Stream the input file of `entity` to the stage, reading only the columns the
+# schema keeps, as text
+def load(entity, input_file_path, stage_file_path):
+
+    chunks = read_chunks(
+        input_file_path,
+        options.chunk_size,
+        dtypes=schema.input_dtypes(entity),
+        columns=list(schema.input_columns[entity]),
+        engine=options.csv_engine,
+        memory_map=options.memory_map,
     )
 
-    # Rename headers to snake_case
-    df.rename(
-        columns={
-            "minMarks": "min_marks",
-            "maxMarks": "max_marks",
-            "totalTime": "total_time",
-            "createdBy": "created_by",
-            "createdAt": "created_at",
-            "updatedAt": "updated_at",
-        },
-        inplace=True,
+    def transform_chunks():
+        for chunk in chunks:
+            metrics.add("stage", entity, rows_in=len(chunk))
+            yield transform(entity, chunk)
+
+    rows = write_chunks(
+        transform_chunks(),
+        stage_file_path,
+        options.stage_format,
+        schema.stage_dtypes(entity),
+    )
+    metrics.add(
+        "stage",
+        entity,
+        rows_out=rows,
+        bytes_read=metrics.path_size(input_file_path),
+        bytes_written=metrics.path_size(stage_file_path),
     )
 
-    df.to_csv(stage_file_path, index=False)
 
+def transform(entity, df):
 
-def load_trainings(input_file_path, stage_file_path):
+    # Rename headers to snake_case in place, only the relevant columns were
+    # read, so the values are not copied
+    columns = schema.input_columns[entity]
+    df.columns = [columns[column] for column in df.columns]
+
+    # Put the columns in schema order when the file has them in another one
+    ordered = [column for column in columns.values() if column in df.columns]
+    if list(df.columns) != ordered:
+        df = df[ordered]
+
+    return df
+
+
+class StageError(Exception):
+    """Raised once every entity has been attempted, with the error of each
+    entity that failed to stage in `errors`."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"staging failed for: {', '.join(errors)}")
 
-    df = pd.read_csv(input_file_path)
-
-    # Select the relevant columns
-    df = df.filter(
-        items=[
-            "id",
-            "name",
-            "mode",
-            "subjectId",
-            "startedAt",
-            "endedAt",
-            "createdAt",
-            "updatedAt",
-        ]
-    )
 
-    # Rename headers to snake_case
-    df.rename(
-        columns={
-            "subjectId": "subject_id",
-            "startedAt": "started_at",
-            "endedAt": "ended_at",
-            "createdAt": "created_at",
-            "updatedAt": "updated_at",
-        },
-        inplace=True,
+# Run `stage_entity(name)` for every entity on a thread pool of `options.workers`,
+# returns the results keyed by entity name
+def stage_entities(stage_entity):
+
+    with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        futures = {
+            name: executor.submit(stage_entity, name)
+            for name in ["users", "subjects", "trainings", "assessments"]
+        }
+
+    errors = {}
+    for name, future in futures.items():
+        if future.exception() is not None:
+            errors[name] = future.exception()
+            logger.error(f"loading {name} failed, error: {errors[name]}.")
+
+    if errors:
+        raise StageError(errors)
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+# Read and transform the input file of `name` in memory
+def stage_input(name):
+
+    input_file_path = os.path.join(options.input_dir, f"{name}.csv")
+    with metrics.measure("stage", name):
+        df = read_file(
+            input_file_path,
+            dtypes=schema.input_dtypes(name),
+            columns=list(schema.input_columns[name]),
+            engine=options.csv_engine,
+            memory_map=options.memory_map,
+        )
+        staged = transform(name, df)
+
+    metrics.add(
+        "stage",
+        name,
+        rows_in=len(df),
+        rows_out=len(staged),
+        bytes_read=metrics.path_size(input_file_path),
     )
+    return staged
 
-    df.to_csv(stage_file_path, index=False)
 
+# Read and transform every input file in memory, without writing staged files
+def stage_inputs():
 
-def load_assessments(input_file_path, stage_file_path):
+    outputs = stage_entities(stage_input)
+
+    return (
+        outputs["users"],
+        outputs["subjects"],
+        outputs["trainings"],
+        outputs["assessments"],
+    )
 
-    df = pd.read_csv(input_file_path)
 
-    # Select the relevant columns
-    df = df.filter(items=["userId", "trainingId", "marks", "internetAllowed"])
+# Write the staged DataFrame of `name` to the stage dir
+def save_stage_output(name, df):
+
+    os.makedirs(options.stage_dir, exist_ok=True)
 
-    # Rename headers to snake_case
-    df.rename(
-        columns={
-            "userId": "user_id",
-            "trainingId": "training_id",
-            "internetAllowed": "internet_allowed",
-        },
-        inplace=True,
+    stage_file_path = os.path.join(
+        options.stage_dir, file_name(name, options.stage_format)
     )
+    write_chunks(
+        [df], stage_file_path, options.stage_format, schema.stage_dtypes(name)
+    )
+    metrics.add("stage", name, bytes_written=metrics.path_size(stage_file_path))
+
 
-    df.to_csv(stage_file_path, index=False)
+# Write staged DataFrames to the stage dir
+def save_stage_outputs(users, subjects, trainings, assessments):
+
+    for name, df in [
+        ("users", users),
+        ("subjects", subjects),
+        ("trainings", trainings),
+        ("assessments", assessments),
+    ]:
+        save_stage_output(name, df)
 
 
 def run():
 
+    metrics.reset()
+
     # create stage dir if does not exist already
     os.makedirs(options.stage_dir, exist_ok=True)
 
-    # loading users
-    logger.info("loading users...")
-    input_users_path = os.path.join(options.input_dir, "users.csv")
-    stage_users_path = os.path.join(options.stage_dir, "users.csv")
-    try:
-        load_users(input_users_path, stage_users_path)
-    except Exception as ex:
-        logger.info(f"loading users failed, error: {ex}.")
-        raise ex
-
-    logger.info("loading users done.")
-
-    # loading subjects
-    logger.info("loading subjects...")
-    input_subjects_path = os.path.join(options.input_dir, "subjects.csv")
-    stage_subjects_path = os.path.join(options.stage_dir, "subjects.csv")
-    try:
-        load_subjects(input_subjects_path, stage_subjects_path)
-    except Exception as ex:
-        logger.info(f"loading subjects failed, error: {ex}.")
-        raise ex
-
-    logger.info("loading subjects done.")
-
-    # loading trainings
-    logger.info("loading trainings...")
-    input_trainings_path = os.path.join(options.input_dir, "trainings.csv")
-    stage_trainings_path = os.path.join(options.stage_dir, "trainings.csv")
-    try:
-        load_trainings(input_trainings_path, stage_trainings_path)
-    except Exception as ex:
-        logger.info(f"loading trainings failed, error: {ex}.")
-
-    logger.info("loading trainings done.")
-
-    # loading assessments
-    logger.info("loading assessments...")
-    input_assessments_path = os.path.join(options.input_dir, "assessments.csv")
-    stage_assessments_path = os.path.join(options.stage_dir, "assessments.csv")
-    try:
-        load_assessments(input_assessments_path, stage_assessments_path)
-    except Exception as ex:
-        logger.info(f"loading assessments failed, error: {ex}.")
-
-    logger.info("loading assessments done.")
+    # stream every input file to the stage dir, entities are independent so
+    # they are loaded concurrently
+    loaders = {
+        "users": load_users,
+        "subjects": load_subjects,
+        "trainings": load_trainings,
+        "assessments": load_assessments,
+    }
+
+    def stage_entity(name):
+        logger.info(f"loading {name}...")
+        input_file_path = os.path.join(options.input_dir, f"{name}.csv")
+        stage_file_path = os.path.join(
+            options.stage_dir, file_name(name, options.stage_format)
+        )
+
+        key = cache.cache_key(options, input_file_path)
+        if cache.is_fresh(f"stage/{name}", key, stage_file_path):
+            logger.info(f"loading {name} skipped, input unchanged.")
+            return
+
+        with metrics.measure("stage", name):
+            loaders[name](input_file_path, stage_file_path)
+        cache.record(f"stage/{name}", key)
+        logger.info(f"loading {name} done.")
+
+    stage_entities(stage_entity)
+    metrics.write()
 
 
 if __name__ == "__main__":
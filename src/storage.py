@@ -0,0 +1,508 @@
+import csv
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import pandas as pd
+from .schema import DATETIME, TEXT, datetime_columns
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pacsv = pq = None
+
+# intermediate outputs are columnar when pyarrow is available, so types survive
+# between stages instead of being printed and parsed again as text
+DEFAULT_FORMAT = "csv" if pq is None else "parquet"
+
+FORMATS = ["csv", "parquet"]
+
+# compressions of written files, with the suffix of compressed csv files,
+# parquet compresses inside the file
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# csv parsers, "pyarrow" parses on several threads
+CSV_ENGINES = ["c", "pyarrow"]
+
+# values read as missing by the pyarrow parser, the defaults of the c parser
+NULL_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+
+
+def file_name(name, file_format, compression=None):
+    """Return the file name for dataset `name` stored as `file_format`."""
+    if file_format not in FORMATS:
+        raise ValueError(f"unsupported file format '{file_format}'")
+    if file_format == "parquet" and pq is None:
+        raise ValueError("file format 'parquet' requires pyarrow to be installed")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unsupported compression '{compression}'")
+    if (
+        file_format == "csv"
+        and compression == "zstd"
+        and importlib.util.find_spec("zstandard") is None
+    ):
+        raise ValueError("zstd compressed csv requires zstandard to be installed")
+
+    if file_format == "csv":
+        return f"{name}.csv{COMPRESSIONS[compression]}"
+    return f"{name}.{file_format}"
+
+
+def read_chunks(
+    file_path,
+    chunk_size=None,
+    file_format="csv",
+    dtypes=None,
+    columns=None,
+    engine="c",
+    memory_map=False,
+):
+    """Read a file as DataFrames of `chunk_size` rows, or as one DataFrame when it is None.
+
+    `dtypes` pins the dtype of the columns it declares instead of inferring
+    them, and only `columns` are read when given. csv files are parsed with
+    the `engine` parser, the c parser reads them through a memory map when
+    `memory_map` is set."""
+    if file_format == "parquet":
+        chunks = read_parquet_chunks(file_path, chunk_size, columns)
+    elif engine == "pyarrow":
+        chunks = read_arrow_csv_chunks(file_path, chunk_size, dtypes, columns)
+    else:
+        chunks = read_csv_chunks(file_path, chunk_size, dtypes, columns, memory_map)
+
+    for chunk in chunks:
+        yield conform(chunk, dtypes)
+
+
+def read_file(file_path, file_format="csv", dtypes=None, columns=None, **csv_options):
+    """Read a whole file as one DataFrame."""
+    return next(
+        read_chunks(file_path, None, file_format, dtypes, columns, **csv_options)
+    )
+
+
+def write_chunks(
+    chunks, file_path, file_format="csv", dtypes=None, compression=None, append=False
+):
+    """Write DataFrames one after another to a single dataset, returns the rows written.
+
+    `dtypes` casts the columns it declares before writing, so every chunk is
+    written with the same types. With `append` the chunks are added after the
+    rows of an existing dataset."""
+    chunks = (conform(chunk, dtypes) for chunk in chunks)
+    if file_format == "parquet":
+        return write_parquet_chunks(chunks, file_path, compression, append)
+
+    append = append and os.path.exists(file_path)
+    rows = 0
+    for index, chunk in enumerate(chunks):
+        chunk.to_csv(
+            file_path,
+            mode="w" if index == 0 and not append else "a",
+            header=index == 0 and not append,
+            index=False,
+            compression=compression,
+        )
+        rows += len(chunk)
+
+    return rows
+
+
+def conform(df, dtypes):
+    """Cast the columns of `df` declared in `dtypes` that have another dtype."""
+    dtypes = {
+        column: dtype
+        for column, dtype in (dtypes or {}).items()
+        if column in df.columns and df[column].dtype != dtype
+    }
+
+    return df.astype(dtypes) if dtypes else df
+
+
+def read_csv_chunks(
+    file_path, chunk_size=None, dtypes=None, columns=None, memory_map=False
+):
+
+    kwargs = {"memory_map": memory_map}
+    if dtypes is not None:
+        dates = datetime_columns(dtypes)
+        kwargs["dtype"] = {c: t for c, t in dtypes.items() if c not in dates}
+        kwargs["parse_dates"] = [c for c in dates if columns is None or c in columns]
+        kwargs["date_format"] = "ISO8601"
+    if columns is not None:
+        kwargs["usecols"] = lambda column: column in columns
+
+    if chunk_size is None:
+        yield pd.read_csv(file_path, **kwargs)
+    else:
+        yield from pd.read_csv(file_path, chunksize=chunk_size, **kwargs)
+
+
+# The pyarrow parser reads blocks of the file on several threads, streamed
+# chunks are sliced from its record batches.
+def read_arrow_csv_chunks(file_path, chunk_size=None, dtypes=None, columns=None):
+
+    if pacsv is None:
+        raise ValueError("csv engine 'pyarrow' requires pyarrow to be installed")
+
+    # like the c parser, `columns` missing from the file are not read
+    if columns is not None:
+        with open(file_path, newline="") as file:
+            header = next(csv.reader(file), [])
+        columns = [column for column in columns if column in header]
+
+    arrow_types = {TEXT: pa.string(), "int64": pa.int64(), "bool": pa.bool_()}
+    arrow_types[DATETIME] = pa.timestamp("ns")
+    convert_options = pacsv.ConvertOptions(
+        include_columns=columns,
+        column_types={
+            column: arrow_types[dtype]
+            for column, dtype in (dtypes or {}).items()
+            if isinstance(dtype, str) and dtype in arrow_types
+        },
+        null_values=NULL_VALUES,
+        strings_can_be_null=True,
+    )
+
+    if chunk_size is None:
+        yield pacsv.read_csv(file_path, convert_options=convert_options).to_pandas()
+        return
+
+    reader = pacsv.open_csv(file_path, convert_options=convert_options)
+    pending = reader.schema.empty_table()
+    yielded = False
+    for batch in reader:
+        pending = pa.concat_tables([pending, pa.Table.from_batches([batch])])
+        while pending.num_rows >= chunk_size:
+            yield pending.slice(0, chunk_size).to_pandas()
+            pending = pending.slice(chunk_size)
+            yielded = True
+
+    if pending.num_rows or not yielded:
+        yield pending.to_pandas()
+
+
+# A parquet dataset is a directory with one part file per written chunk, so
+# every chunk keeps its own schema and parquet dictionary-encodes the repeated
+# id strings of each part.
+def read_parquet_chunks(file_path, chunk_size=None, columns=None):
+
+    part_paths = sorted(glob.glob(os.path.join(file_path, "part-*.parquet")))
+    if chunk_size is None:
+        parts = [pd.read_parquet(part_path, columns=columns) for part_path in part_paths]
+        # empty parts carry no values, only keep one for the columns
+        parts = [part for part in parts if len(part)] or parts[:1]
+        yield pd.concat(parts, ignore_index=True)
+        return
+
+    for part_path in part_paths:
+        part = pq.ParquetFile(part_path)
+        if part.metadata.num_rows == 0:
+            yield part.read(columns=columns).to_pandas()
+            continue
+
+        for batch in part.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+
+
+def write_parquet_chunks(chunks, file_path, compression=None, append=False):
+
+    first = 0
+    if append and os.path.isdir(file_path):
+        first = len(glob.glob(os.path.join(file_path, "part-*.parquet")))
+    else:
+        if os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+        os.makedirs(file_path)
+
+    rows = 0
+    for index, chunk in enumerate(chunks, start=first):
+        part_path = os.path.join(file_path, f"part-{index:05d}.parquet")
+        write_file(chunk, part_path, "parquet", compression)
+        rows += len(chunk)
+
+    return rows
+
+
+def read_text_chunks(file_path, chunk_size=None, file_format="csv"):
+    """Read a dataset to write it back, csv values are read as the text in the
+    file, so they are written back unchanged."""
+    if file_format == "parquet" and os.path.isdir(file_path):
+        yield from read_parquet_chunks(file_path, chunk_size)
+    elif file_format == "parquet":
+        yield pd.read_parquet(file_path)
+    elif chunk_size is None:
+        yield pd.read_csv(file_path, dtype=TEXT, na_filter=False)
+    else:
+        yield from pd.read_csv(
+            file_path, chunksize=chunk_size, dtype=TEXT, na_filter=False
+        )
+
+
+def filter_chunks(
+    file_path, keep, file_format="csv", compression=None, chunk_size=None
+):
+    """Rewrite a dataset with only the rows flagged by `keep`, called with
+    every chunk of `chunk_size` rows, returns the rows kept."""
+    temp_path = f"{file_path}.tmp"
+    chunks = (
+        chunk[keep(chunk)]
+        for chunk in read_text_chunks(file_path, chunk_size, file_format)
+    )
+    rows = write_chunks(chunks, temp_path, file_format, compression=compression)
+
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    os.replace(temp_path, file_path)
+
+    return rows
+
+
+def copy_dataset(source_path, file_path):
+    """Copy a dataset, a file or a directory of part files, replacing `file_path`."""
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    if os.path.isdir(source_path):
+        shutil.copytree(source_path, file_path)
+    else:
+        shutil.copyfile(source_path, file_path)
+
+
+def write_file(df, file_path, file_format="csv", compression=None):
+    """Write a DataFrame to one file, parquet files use their default
+    compression when `compression` is None."""
+    if file_format == "parquet":
+        options = {} if compression is None else {"compression": compression}
+        df.to_parquet(file_path, index=False, **options)
+    else:
+        df.to_csv(file_path, index=False, compression=compression)
+
+
+# A partitioned dataset is a directory in the Hive layout: one directory per
+# value of the partition column, `<column>=<value>`, or per bucket of its
+# values, `<column>_bucket=<bucket>`, each with one part file per written
+# chunk. Its manifest.json lists every file with its partition and rows, so
+# readers can read files in parallel and skip the partitions they do not need.
+MANIFEST_FILE = "manifest.json"
+
+# directory of the rows with a missing partition value, as Hive names it
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def bucket_of(value, buckets):
+    """Return the bucket of a partition value, the crc32 of its text modulo
+    `buckets`."""
+    return zlib.crc32(str(value).encode()) % buckets
+
+
+def partition_keys(values, buckets=None):
+    """Return the partition of every value, the value itself or its bucket."""
+    if buckets is None:
+        return values
+
+    # every distinct value is hashed once
+    codes, distinct = pd.factorize(values)
+    distinct_buckets = [bucket_of(value, buckets) for value in distinct]
+    # missing values have code -1, they are hashed as their text
+    distinct_buckets.append(bucket_of(None, buckets))
+    return pd.Series([distinct_buckets[code] for code in codes], index=values.index)
+
+
+def part_index(path):
+    """Return the index of the chunk a part file was written from."""
+    return int(os.path.basename(path).split(".")[0].split("-")[1])
+
+
+def read_manifest(dir_path):
+    with open(os.path.join(dir_path, MANIFEST_FILE)) as file:
+        return json.load(file)
+
+
+def write_manifest(dir_path, manifest):
+    manifest["rows"] = sum(file["rows"] for file in manifest["files"])
+    manifest["files"] = sorted(manifest["files"], key=lambda file: file["path"])
+    with open(os.path.join(dir_path, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def partition_dir(column, key, buckets=None):
+    if buckets is not None:
+        return f"{column}_bucket={key}"
+    if pd.isna(key):
+        return f"{column}={DEFAULT_PARTITION}"
+    return f"{column}={quote(str(key), safe='')}"
+
+
+def write_partitioned(
+    chunks,
+    dir_path,
+    partition_by,
+    file_format="csv",
+    dtypes=None,
+    compression=None,
+    buckets=None,
+    workers=4,
+    append=False,
+):
+    """Write DataFrames as a dataset partitioned by the `partition_by` column,
+    returns its manifest.
+
+    Every chunk is split by partition and its part files are written on
+    `workers` threads while the next chunk is produced. Partition directories
+    by value leave the column out of their files, as in Hive, bucket
+    directories keep it since they hold several values. With `append` the
+    part files are added to the ones of an existing dataset, written with the
+    same options."""
+    columns = None
+    files = []
+    first = 0
+    if append and os.path.exists(os.path.join(dir_path, MANIFEST_FILE)):
+        manifest = read_manifest(dir_path)
+        columns = manifest["columns"] or None
+        files = manifest["files"]
+        first = max((part_index(file["path"]) for file in files), default=-1) + 1
+    else:
+        if os.path.isdir(dir_path):
+            shutil.rmtree(dir_path)
+        os.makedirs(dir_path)
+
+    def write_part(relative_path, part, key):
+        part_path = os.path.join(dir_path, relative_path)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        write_file(part, part_path, file_format, compression)
+        return {
+            "path": relative_path,
+            "partition": key,
+            "rows": len(part),
+            "bytes": os.path.getsize(part_path),
+        }
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        writing = []
+        for index, chunk in enumerate(chunks, start=first):
+            chunk = conform(chunk, dtypes)
+            columns = list(chunk.columns) if columns is None else columns
+            keys = partition_keys(chunk[partition_by], buckets)
+
+            parts = []
+            for key, part in chunk.groupby(keys, sort=True, dropna=False):
+                if pd.isna(key):
+                    key = None
+                elif buckets is not None:
+                    key = int(key)
+                if buckets is None:
+                    part = part.drop(columns=partition_by)
+                relative_path = os.path.join(
+                    partition_dir(partition_by, key, buckets),
+                    file_name(f"part-{index:05d}", file_format, compression),
+                )
+                parts.append(executor.submit(write_part, relative_path, part, key))
+
+            # the parts of the previous chunk are written by now, so at most
+            # two chunks are held in memory
+            files += [future.result() for future in writing]
+            writing = parts
+
+        files += [future.result() for future in writing]
+
+    manifest = {
+        "format": file_format,
+        "compression": compression,
+        "partition_by": partition_by,
+        "buckets": buckets,
+        "columns": columns or [],
+        "files": files,
+    }
+    write_manifest(dir_path, manifest)
+
+    return manifest
+
+
+def read_partitioned(dir_path, dtypes=None, workers=4):
+    """Read every part file of a partitioned dataset as one DataFrame, on
+    `workers` threads, with the partition column of value directories put back."""
+    manifest = read_manifest(dir_path)
+    partition_by = manifest["partition_by"]
+
+    def read_part(file):
+        part_path = os.path.join(dir_path, file["path"])
+        if manifest["format"] == "parquet":
+            part = pd.read_parquet(part_path)
+        else:
+            part = read_file(part_path, manifest["format"], dtypes)
+        if manifest["buckets"] is None:
+            part[partition_by] = file["partition"]
+        return part
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(read_part, manifest["files"]))
+
+    # empty parts carry no values, only keep one for the columns
+    parts = [part for part in parts if len(part)] or parts[:1]
+    if not parts:
+        return pd.DataFrame(columns=manifest["columns"])
+    df = pd.concat(parts, ignore_index=True)[manifest["columns"]]
+    return conform(df, dtypes)
+
+
+def filter_partitioned(dir_path, keep, workers=4):
+    """Rewrite the part files of a partitioned dataset with only the rows
+    flagged by `keep`, called with every part, its partition column included,
+    returns the manifest.
+
+    Parts whose rows are all kept are left as they are, parts with no rows
+    left are removed."""
+    manifest = read_manifest(dir_path)
+    partition_by = manifest["partition_by"]
+    by_value = manifest["buckets"] is None
+
+    def filter_part(file):
+        part_path = os.path.join(dir_path, file["path"])
+        part = next(read_text_chunks(part_path, file_format=manifest["format"]))
+        if by_value:
+            part[partition_by] = file["partition"]
+
+        kept = part[keep(part)]
+        if len(kept) == len(part):
+            return file
+        if len(kept) == 0:
+            os.remove(part_path)
+            return None
+
+        if by_value:
+            kept = kept.drop(columns=partition_by)
+        write_file(kept, part_path, manifest["format"], manifest["compression"])
+        return {**file, "rows": len(kept), "bytes": os.path.getsize(part_path)}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        files = list(executor.map(filter_part, manifest["files"]))
+    manifest["files"] = [file for file in files if file is not None]
+    write_manifest(dir_path, manifest)
+
+    return manifest
@@ -0,0 +1,123 @@
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+ID_PATTERN = re.compile(r"^[\w-]+$")
+EMAIL_PATTERN = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w+$")
+NAME_PATTERN = re.compile(r"^[A-Za-z\s]+$")
+BOOLEANS = {
+    True: True,
+    False: False,
+    "True": True,
+    "true": True,
+    "TRUE": True,
+    "False": False,
+    "false": False,
+    "FALSE": False,
+}
+
+# results kept per distinct value, emails, names and timestamps repeat a lot
+CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def validate_id(value):
+    """Validate the ID to ensure it does not contain any symbols or spaces except '-' or '_'."""
+    return isinstance(value, str) and ID_PATTERN.match(value) is not None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def validate_email(email):
+    """Validate the email format."""
+    return isinstance(email, str) and EMAIL_PATTERN.match(email) is not None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def validate_name(name):
+    """Validate the name contains only letters and spaces."""
+    return isinstance(name, str) and NAME_PATTERN.match(name) is not None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_datetime(date_string):
+    """Parse an ISO 8601 datetime, None when it is not one."""
+    try:
+        return datetime.fromisoformat(date_string)
+    except (TypeError, ValueError):
+        return None
+
+
+def validate_datetime(date_string):
+    """Validate datetime format."""
+    return parse_datetime(date_string) is not None
+
+
+def map_distinct(values, function):
+    """Apply `function` once per distinct value of `values`, missing values map to False."""
+    codes, distinct = pd.factorize(values)
+    results = np.fromiter(
+        (function(value) for value in distinct), dtype=bool, count=len(distinct)
+    )
+    # missing values have code -1, which takes the trailing False
+    return pd.Series(np.append(results, False)[codes], index=values.index)
+
+
+def validate_ids(values):
+    """Column-wise `validate_id`, missing values are invalid."""
+    return map_distinct(values, validate_id)
+
+
+def validate_emails(values):
+    """Column-wise `validate_email`, missing values are invalid."""
+    return map_distinct(values, validate_email)
+
+
+def validate_names(values):
+    """Column-wise `validate_name`, missing values are invalid."""
+    return map_distinct(values, validate_name)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_timestamp(date_string):
+    """Parse an ISO 8601 datetime as `parse_datetime` does, to naive UTC when it
+    has an offset. None when it is not one, or out of the datetime64[ns] range."""
+    parsed = parse_datetime(date_string)
+    if parsed is None:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if not pd.Timestamp.min <= parsed <= pd.Timestamp.max:
+        return None
+    return parsed
+
+
+def parse_datetimes(values):
+    """Parse ISO 8601 datetimes column-wise, NaT where missing or invalid.
+
+    Values are accepted as `datetime.fromisoformat` accepts them, those with an
+    offset are converted to naive UTC. Every distinct string is parsed once and
+    the result is spread back over the rows holding it."""
+    if values.dtype.kind == "M":
+        return values
+
+    codes, distinct = pd.factorize(values)
+    parsed = [parse_timestamp(value) for value in distinct]
+    parsed = pd.DatetimeIndex(parsed + [None], dtype="datetime64[ns]").to_numpy()
+    # missing values have code -1, which takes the trailing NaT
+    return pd.Series(parsed[codes], index=values.index)
+
+
+def parse_numbers(values):
+    """Parse numbers column-wise, NaN where missing or invalid."""
+    if values.dtype.kind in "iuf":
+        return values
+    return pd.to_numeric(values, errors="coerce")
+
+
+def parse_booleans(values):
+    """Parse booleans, or their text as pandas writes it, NaN when neither."""
+    if values.dtype.kind == "b":
+        return values
+    return values.map(BOOLEANS)
@@ -0,0 +1,44 @@
+import pytest
+from src import cache, database, fake, metrics, prep, rejects, report, stage
+
+
+@pytest.fixture(scope="session")
+def input_dir(tmp_path_factory):
+    """A small generated dataset with unclean rows of every entity."""
+    path = tmp_path_factory.mktemp("input")
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in {
+            "bulk": True,
+            "seed": 1,
+            "reference_time": "2025-01-01",
+            "unclean_percentage": 10,
+            "user_count": 50,
+            "subject_count": 50,
+            "training_count": 50,
+            "assessment_count": 1000,
+            "pool_size": 100,
+            "out_dir": str(path),
+        }.items():
+            patch.setattr(fake.options, name, value)
+        fake.run()
+    return path
+
+
+@pytest.fixture
+def staged(input_dir, tmp_path, monkeypatch):
+    """Stage the generated dataset, every output of the run under `tmp_path`."""
+    monkeypatch.setattr(stage.options, "input_dir", str(input_dir))
+    monkeypatch.setattr(stage.options, "stage_dir", str(tmp_path / "stage"))
+    monkeypatch.setattr(prep.options, "stage_folder", str(tmp_path / "stage"))
+    monkeypatch.setattr(prep.options, "output_folder", str(tmp_path / "prep"))
+    monkeypatch.setattr(report.options, "prep_dir", str(tmp_path / "prep"))
+    monkeypatch.setattr(report.options, "report_dir", str(tmp_path / "report"))
+    monkeypatch.setattr(cache.options, "manifest_file", str(tmp_path / "cache.json"))
+    monkeypatch.setattr(metrics.options, "summary_file", str(tmp_path / "metrics.json"))
+    monkeypatch.setattr(database.options, "path", str(tmp_path / "pipeline.db"))
+    rejects.reset()
+    metrics.reset()
+    stage.run()
+    yield tmp_path
+    rejects.reset()
+    metrics.reset()
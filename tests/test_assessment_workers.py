@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+from src import metrics, prep, schema
+from src.storage import read_text_chunks
+
+
+def run_prep(output_folder, monkeypatch, workers):
+    monkeypatch.setattr(prep.options, "output_folder", str(output_folder))
+    monkeypatch.setattr(prep.options, "assessment_workers", workers)
+    prep.run()
+
+    outputs = {
+        name: next(
+            read_text_chunks(
+                prep.prep_output_path(name), None, prep.options.output_format
+            )
+        )
+        for name in schema.ENTITIES + ["rejects"]
+    }
+    return outputs, dict(metrics.discards)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 30])
+def test_worker_processes_clean_as_one_process_does(staged, monkeypatch, chunk_size):
+    monkeypatch.setattr(prep.options, "chunk_size", chunk_size)
+
+    expected, expected_discards = run_prep(staged / "one", monkeypatch, 1)
+    outputs, discards = run_prep(staged / "three", monkeypatch, 3)
+
+    assert any(entity == "assessments" for entity, _ in expected_discards)
+    assert discards == expected_discards
+    for name, df in outputs.items():
+        pd.testing.assert_frame_equal(df, expected[name], obj=name)
@@ -0,0 +1,62 @@
+import os
+import pandas as pd
+import pytest
+from src import database, prep, report, schema
+from src.aggregates import TABLES
+from src.storage import file_name, read_text_chunks
+
+
+def run_prep(output_folder, monkeypatch, backend):
+    monkeypatch.setattr(prep.options, "output_folder", str(output_folder))
+    monkeypatch.setattr(prep.options, "backend", backend)
+    prep.run()
+
+    return {
+        name: next(
+            read_text_chunks(
+                prep.prep_output_path(name), None, prep.options.output_format
+            )
+        )
+        for name in schema.ENTITIES + ["rejects"]
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [None, 30])
+def test_sqlite_backend_writes_the_pandas_outputs(staged, monkeypatch, chunk_size):
+    monkeypatch.setattr(prep.options, "chunk_size", chunk_size)
+    # rejects of a reason are fetched across several batches
+    monkeypatch.setattr(database.options, "batch_size", 5)
+
+    expected = run_prep(staged / "pandas", monkeypatch, "pandas")
+    outputs = run_prep(staged / "sqlite", monkeypatch, "sqlite")
+
+    assert expected["rejects"]["reason"].nunique() > 1
+    for name, df in outputs.items():
+        pd.testing.assert_frame_equal(df, expected[name], obj=name)
+
+
+def run_report(report_dir, monkeypatch, backend):
+    monkeypatch.setattr(report.options, "report_dir", str(report_dir))
+    monkeypatch.setattr(report.options, "backend", backend)
+    report.run()
+
+    outputs = {"report": read_text_chunks(report.report_path())}
+    for table in TABLES:
+        path = os.path.join(
+            report.aggregates_dir(), file_name(table, report.options.report_format)
+        )
+        outputs[table] = read_text_chunks(path)
+    return {name: next(chunks) for name, chunks in outputs.items()}
+
+
+@pytest.mark.parametrize("chunk_size", [None, 70])
+def test_sqlite_report_joins_as_pandas_does(staged, monkeypatch, chunk_size):
+    monkeypatch.setattr(report.options, "chunk_size", chunk_size)
+    prep.run()
+
+    expected = run_report(staged / "pandas", monkeypatch, "pandas")
+    outputs = run_report(staged / "sqlite", monkeypatch, "sqlite")
+
+    assert len(expected["report"]) > 0
+    for name, df in outputs.items():
+        pd.testing.assert_frame_equal(df, expected[name], obj=name)
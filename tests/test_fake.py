@@ -0,0 +1,31 @@
+from src import fake
+
+
+def generate(out_dir, monkeypatch, seed, workers):
+    for name, value in {
+        "bulk": True,
+        "seed": seed,
+        "reference_time": "2025-01-01",
+        "workers": workers,
+        # several shards of every entity
+        "shard_size": 20,
+        "pool_size": 100,
+        "user_count": 50,
+        "subject_count": 50,
+        "training_count": 50,
+        "assessment_count": 200,
+        "out_dir": str(out_dir),
+    }.items():
+        monkeypatch.setattr(fake.options, name, value)
+    fake.run()
+    return {path.name: path.read_bytes() for path in out_dir.iterdir()}
+
+
+def test_bulk_files_depend_on_the_seed_only(tmp_path, monkeypatch):
+    one_worker = generate(tmp_path / "one", monkeypatch, 7, 1)
+    three_workers = generate(tmp_path / "three", monkeypatch, 7, 3)
+    other_seed = generate(tmp_path / "other", monkeypatch, 8, 3)
+
+    assert len(one_worker) == 4
+    assert three_workers == one_worker
+    assert other_seed != one_worker
@@ -0,0 +1,49 @@
+import io
+import json
+import pytest
+from src import logger
+
+
+@pytest.fixture
+def console_output(monkeypatch):
+    """Return a function stopping the listener and returning what it wrote."""
+    stream = io.StringIO()
+    monkeypatch.setattr(logger.console, "stream", stream)
+    previous_format = logger.options.format
+
+    def output():
+        logger.stop_listener()
+        return stream.getvalue()
+
+    yield output
+    logger.stop_listener()
+    logger.configure(format=previous_format)
+    logger.start_listener()
+
+
+def raise_and_log(log):
+    try:
+        raise ValueError("bad value")
+    except ValueError:
+        log.exception("cleaning %s failed", "users")
+
+
+def test_json_records_keep_the_exception(console_output):
+    logger.configure(format="json")
+    raise_and_log(logger.create_logger("test_logger"))
+
+    entry = json.loads(console_output())
+    assert entry["message"] == "cleaning users failed"
+    assert entry["level"] == "ERROR"
+    assert "ValueError: bad value" in entry["exception"]
+    assert "Traceback" not in entry["message"]
+
+
+def test_text_records_end_with_the_traceback(console_output):
+    logger.configure(format="text")
+    raise_and_log(logger.create_logger("test_logger"))
+
+    lines = console_output().splitlines()
+    assert lines[0].endswith("ERROR - cleaning users failed")
+    assert lines[1] == "Traceback (most recent call last):"
+    assert lines[-1] == "ValueError: bad value"
@@ -0,0 +1,53 @@
+import json
+from src import cache, metrics, prep, report, stage
+
+
+def read_summary():
+    with open(metrics.options.summary_file) as file:
+        return json.load(file)
+
+
+def measurements(summary, stage_name):
+    return {
+        measurement["entity"]: measurement
+        for measurement in summary["stages"]
+        if measurement["stage"] == stage_name
+    }
+
+
+def test_every_run_is_merged_into_the_summary_file(staged):
+    prep.run()
+    report.run()
+
+    summary = read_summary()
+    assert [m["stage"] for m in summary["stages"]] == ["stage"] * 4 + ["prep"] * 4 + [
+        "report"
+    ]
+    assert summary["discards"]
+
+
+def test_counters_are_reset_every_run(staged, monkeypatch):
+    monkeypatch.setattr(cache.options, "enabled", False)
+    first = measurements(read_summary(), "stage")
+
+    stage.run()
+    second = measurements(read_summary(), "stage")
+
+    assert second.keys() == first.keys()
+    for entity, measurement in second.items():
+        assert measurement["rows_in"] == first[entity]["rows_in"]
+
+
+def test_peak_rss_is_reset_when_no_block_is_measured(monkeypatch):
+    resets = []
+    monkeypatch.setattr(metrics, "reset_peak_rss", lambda: resets.append(True))
+
+    with metrics.measure("stage", "users"):
+        # blocks run at once share the peak of the first
+        with metrics.measure("stage", "subjects"):
+            pass
+    with metrics.measure("stage", "trainings"):
+        pass
+    metrics.reset()
+
+    assert len(resets) == 2
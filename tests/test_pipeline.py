@@ -0,0 +1,50 @@
+import shutil
+import pandas as pd
+import pytest
+from src import pipeline, prep, report, stage
+from src.storage import read_text_chunks
+
+
+def outputs():
+    """The staged and cleaned users and the report, as written."""
+    return {
+        path: next(read_text_chunks(path, None, file_format))
+        for path, file_format in [
+            (prep.stage_output_path("users"), stage.options.stage_format),
+            (prep.prep_output_path("users"), prep.options.output_format),
+            (report.report_path(), report.options.report_format),
+        ]
+    }
+
+
+def run_stages():
+    stage.run()
+    prep.run()
+    report.run()
+
+
+def test_stages_rerun_after_the_pipeline_rewrote_their_outputs(staged, monkeypatch):
+    input_dir = staged / "input"
+    shutil.copytree(stage.options.input_dir, input_dir)
+    monkeypatch.setattr(stage.options, "input_dir", str(input_dir))
+
+    run_stages()
+    expected = outputs()
+
+    # the pipeline runs on other inputs, then the original ones are back
+    users_path = input_dir / "users.csv"
+    original = users_path.read_bytes()
+    lines = original.splitlines(keepends=True)
+    users_path.write_bytes(b"".join(lines[: len(lines) // 2]))
+    pipeline.Pipeline().run()
+    users_path.write_bytes(original)
+
+    run_stages()
+    for path, df in outputs().items():
+        pd.testing.assert_frame_equal(df, expected[path])
+
+
+def test_pipeline_refuses_options_it_would_ignore(monkeypatch):
+    monkeypatch.setattr(prep.options, "chunk_size", 1000)
+    with pytest.raises(ValueError, match="prep.options.chunk_size"):
+        pipeline.Pipeline()
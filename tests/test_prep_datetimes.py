@@ -0,0 +1,100 @@
+import pandas as pd
+import pytest
+from src import prep, rejects, schema
+from src.references import ReferenceIndex
+
+# the same instants written without offset, with a UTC offset, with "Z" and
+# with another offset
+CREATED_AT = [
+    "2024-01-01T10:00:00",
+    "2024-01-01T10:00:00+00:00",
+    "2024-01-01T10:00:00Z",
+    "2024-01-01T15:00:00+05:00",
+]
+UPDATED_AT = "2024-02-01T10:00:00+00:00"
+
+
+@pytest.fixture(autouse=True)
+def empty_ledger():
+    rejects.reset()
+    yield
+    rejects.reset()
+
+
+def text_frame(records):
+    return pd.DataFrame(records).astype(schema.TEXT)
+
+
+def test_users_with_offsets_are_kept_as_naive_utc():
+    users = text_frame(
+        [
+            {
+                "id": f"user{index}",
+                "email": "user@example.com",
+                "first_name": "first",
+                "middle_name": "middle",
+                "last_name": "last",
+                "role": "employee",
+                "created_at": created_at,
+                "updated_at": UPDATED_AT,
+            }
+            for index, created_at in enumerate(CREATED_AT)
+        ]
+    )
+
+    cleaned = prep.clean_users(users)
+
+    assert len(cleaned) == len(CREATED_AT)
+    assert cleaned["created_at"].dtype == schema.DATETIME
+    assert (cleaned["created_at"] == pd.Timestamp("2024-01-01T10:00:00")).all()
+    assert (cleaned["updated_at"] == pd.Timestamp("2024-02-01T10:00:00")).all()
+
+
+def test_subjects_and_trainings_with_offsets_are_kept():
+    subjects = text_frame(
+        [
+            {
+                "id": f"subject{index}",
+                "name": "Subject",
+                "min_marks": "10",
+                "max_marks": "100",
+                "total_time": "60",
+                "created_at": created_at,
+                "updated_at": UPDATED_AT,
+            }
+            for index, created_at in enumerate(CREATED_AT)
+        ]
+    )
+    cleaned_subjects = prep.clean_subjects(subjects)
+    assert len(cleaned_subjects) == len(CREATED_AT)
+    assert cleaned_subjects["created_at"].dtype == schema.DATETIME
+
+    trainings = text_frame(
+        [
+            {
+                "id": f"training{index}",
+                "name": "Training",
+                "mode": "online",
+                "subject_id": "subject0",
+                "started_at": created_at,
+                # earlier than started_at as text, later as an instant
+                "ended_at": "2024-01-01T06:00:00-05:00",
+                "created_at": created_at,
+                "updated_at": UPDATED_AT,
+            }
+            for index, created_at in enumerate(CREATED_AT)
+        ]
+    )
+    cleaned_trainings = prep.clean_trainings(
+        trainings, ReferenceIndex(subjects=cleaned_subjects)
+    )
+    assert len(cleaned_trainings) == len(CREATED_AT)
+    assert (cleaned_trainings["ended_at"] == pd.Timestamp("2024-01-01T11:00")).all()
+
+
+def test_watermarks_compare_offsets_as_instants():
+    records = text_frame({"updated_at": CREATED_AT[1:] + ["2024-01-01T12:00:00"]})
+
+    assert prep.next_watermark(records, None) == "2024-01-01T12:00:00"
+    updated = prep.updated_since(records, "2024-01-01T11:00:00")
+    assert updated.tolist() == [False, False, False, True]
@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import pandas as pd
+import pytest
+from src import pipeline, prep, schema, stage
+from src.storage import read_file
+
+# later than every generated updated_at
+LATER = "2025-06-01T00:00:00"
+
+
+def sorted_outputs():
+    """The prep outputs, in an order that does not depend on how they were built."""
+    return {
+        name: df.sort_values(list(df.columns)).reset_index(drop=True)
+        for name, df in zip(schema.ENTITIES, prep.load_prep_outputs())
+    }
+
+
+def full_outputs(output_folder):
+    """The prep outputs of a full run over the same staged files."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(prep.options, "incremental", False)
+        patch.setattr(prep.options, "output_folder", str(output_folder))
+        prep.run()
+        return sorted_outputs()
+
+
+def update_staged(name, change):
+    """Save the staged `name` as changed by `change`, as if stage read new inputs."""
+    staged = dict(zip(schema.ENTITIES, prep.load_stage_outputs()))[name]
+    stage.save_stage_output(name, change(staged.copy()))
+
+
+def rows_of(df, record_id):
+    return df["id"].str.strip().str.lower() == record_id
+
+
+def assert_same_outputs(expected):
+    for name, df in sorted_outputs().items():
+        pd.testing.assert_frame_equal(df, expected[name], obj=name)
+
+
+def test_incremental_run_after_the_pipeline_matches_a_full_run(staged, monkeypatch):
+    input_dir = staged / "input"
+    shutil.copytree(stage.options.input_dir, input_dir)
+    monkeypatch.setattr(stage.options, "input_dir", str(input_dir))
+    monkeypatch.setattr(prep.options, "incremental", True)
+    prep.run()
+
+    # the pipeline stages and cleans more assessments than the state has seen
+    assessments_path = input_dir / "assessments.csv"
+    lines = assessments_path.read_bytes().splitlines(keepends=True)
+    assessments_path.write_bytes(b"".join(lines + lines[1:101]))
+    monkeypatch.setattr(prep.options, "incremental", False)
+    pipeline.Pipeline().run()
+    monkeypatch.setattr(prep.options, "incremental", True)
+
+    prep.run()
+    assert_same_outputs(full_outputs(staged / "full"))
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "csv"])
+def test_incremental_runs_over_deltas_match_full_runs(
+    staged, monkeypatch, output_format
+):
+    monkeypatch.setattr(prep.options, "output_format", output_format)
+    monkeypatch.setattr(prep.options, "incremental", True)
+    prep.run()
+    assert_same_outputs(full_outputs(staged / "full"))
+    outputs = sorted_outputs()
+
+    # assessments are added, and appended to the prep assessments
+    update_staged("assessments", lambda df: pd.concat([df, df.iloc[:100]]))
+    prep.run()
+    assert_same_outputs(full_outputs(staged / "full"))
+    if output_format == "parquet":
+        parts = os.listdir(prep.prep_output_path("assessments"))
+        assert len(parts) == 2
+
+    # a user is updated, their assessments are rechecked
+    user_id = outputs["assessments"]["user_id"].iloc[0]
+
+    def rename(users):
+        users.loc[rows_of(users, user_id), ["first_name", "updated_at"]] = [
+            "Renamed",
+            LATER,
+        ]
+        return users
+
+    update_staged("users", rename)
+    prep.run()
+    assert_same_outputs(full_outputs(staged / "full"))
+    users = sorted_outputs()["users"]
+    assert users.loc[users["id"] == user_id, "first_name"].tolist() == ["renamed"]
+
+    # a subject turns invalid, its trainings and their assessments are dropped
+    training_id = outputs["assessments"]["training_id"].iloc[0]
+    trainings = outputs["trainings"].set_index("id")
+    subject_id = trainings.loc[training_id, "subject_id"]
+
+    def invalidate(subjects):
+        subjects.loc[rows_of(subjects, subject_id), ["min_marks", "updated_at"]] = [
+            "-1",
+            LATER.replace("06", "07", 1),
+        ]
+        return subjects
+
+    update_staged("subjects", invalidate)
+    prep.run()
+    assert_same_outputs(full_outputs(staged / "full"))
+    removed = read_file(
+        prep.changes_path("removed_assessments"),
+        output_format,
+        schema.prep_dtypes["assessments"],
+    )
+    assert (removed["training_id"] == training_id).any()
+    assert training_id not in sorted_outputs()["trainings"]["id"].tolist()
+
+    # the staged assessments shrink, they are all cleaned again
+    update_staged("assessments", lambda df: df.iloc[:500])
+    prep.run()
+    assert_same_outputs(full_outputs(staged / "full"))
+
+
+def test_incremental_run_skips_records_older_than_the_watermark(staged, monkeypatch):
+    monkeypatch.setattr(prep.options, "incremental", True)
+    prep.run()
+    user_id = sorted_outputs()["users"]["id"].iloc[0]
+
+    def rename(users):
+        users.loc[rows_of(users, user_id), "first_name"] = "Renamed"
+        return users
+
+    update_staged("users", rename)
+    prep.run()
+    users = sorted_outputs()["users"]
+    assert users.loc[users["id"] == user_id, "first_name"].tolist() != ["renamed"]
+
+    users = full_outputs(staged / "full")["users"]
+    assert users.loc[users["id"] == user_id, "first_name"].tolist() == ["renamed"]
+
+
+def test_incremental_run_without_changes_keeps_the_previous_run(staged, monkeypatch):
+    monkeypatch.setattr(prep.options, "incremental", True)
+    prep.run()
+    update_staged("assessments", lambda df: pd.concat([df, df.iloc[:100]]))
+    prep.run()
+    with open(prep.state_path()) as file:
+        expected = json.load(file)
+
+    prep.run()
+    with open(prep.state_path()) as file:
+        state = json.load(file)
+    assert state["run"] == expected["run"]
+    assert state["changes"] == expected["changes"]
@@ -0,0 +1,510 @@
+import re
+from datetime import datetime
+import pandas as pd
+import pytest
+from src import prep, rejects, schema
+from src.references import ReferenceIndex
+
+# The row-by-row cleaners the vectorized rules replaced, as they were, without
+# their logging. Each returns its cleaned records, and the reason every row was
+# discarded for, None for the rows kept. Kept here as the reference the rules
+# must agree with.
+
+
+def loop_validate_id(value):
+    return bool(re.match(r"^[\w-]+$", value))
+
+
+def loop_validate_email(email):
+    return bool(re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email))
+
+
+def loop_validate_datetime(date_string):
+    try:
+        datetime.fromisoformat(date_string)
+        return True
+    except ValueError:
+        return False
+
+
+def strip_row(row):
+    return row.apply(lambda x: x.strip() if isinstance(x, str) else x)
+
+
+def loop_reason_of_user(row):
+    required = ["id", "email", "first_name", "middle_name", "last_name", "role"]
+    if any(pd.isnull(row[required + ["created_at", "updated_at"]])) or any(
+        row[required] == ""
+    ):
+        return "null or empty values"
+    if not loop_validate_id(row["id"]):
+        return "invalid id"
+    if not loop_validate_email(row["email"]):
+        return "invalid email"
+    if row["role"].lower() not in ["admin", "employee"]:
+        return "invalid role"
+    created_at = row["created_at"]
+    updated_at = row["updated_at"]
+    if not loop_validate_datetime(created_at):
+        return "invalid created_at"
+    if not loop_validate_datetime(updated_at) or updated_at <= created_at:
+        return "invalid updated_at"
+    return None
+
+
+def loop_clean_users(users):
+    cleaned, reasons = [], []
+    for _, row in users.iterrows():
+        row = strip_row(row)
+        reasons.append(loop_reason_of_user(row))
+        if reasons[-1] is None:
+            cleaned.append({"id": row["id"].lower()})
+
+    return pd.DataFrame(cleaned, columns=["id"]), reasons
+
+
+def loop_reason_of_subject(row):
+    required = ["id", "name", "min_marks", "max_marks", "total_time"]
+    if any(pd.isnull(row[required + ["created_at", "updated_at"]])) or any(
+        row[["id", "name"]] == ""
+    ):
+        return "null or empty values"
+    if not loop_validate_id(row["id"]):
+        return "invalid id"
+    if not re.match(r"^[A-Za-z\s]+$", row["name"]):
+        return "invalid name"
+    min_marks = row["min_marks"]
+    max_marks = row["max_marks"]
+    total_time = row["total_time"]
+    if min_marks < 0 or max_marks < min_marks or total_time < 0:
+        return "invalid marks or total_time"
+    created_at = row["created_at"]
+    updated_at = row["updated_at"]
+    if not loop_validate_datetime(created_at):
+        return "invalid created_at"
+    if not loop_validate_datetime(updated_at) or updated_at <= created_at:
+        return "invalid updated_at"
+    return None
+
+
+def loop_clean_subjects(subjects):
+    columns = ["id", "name", "min_marks", "max_marks", "total_time"]
+    cleaned, reasons = [], []
+    for _, row in subjects.iterrows():
+        row = strip_row(row)
+        reasons.append(loop_reason_of_subject(row))
+        if reasons[-1] is None:
+            cleaned.append({**row[columns], "id": row["id"].lower()})
+
+    df = pd.DataFrame(cleaned, columns=columns)
+    for column in ["min_marks", "max_marks", "total_time"]:
+        df[column] = df[column].astype(int)
+    return df, reasons
+
+
+def loop_reason_of_training(row, valid_subject_ids):
+    required = ["id", "name", "mode", "subject_id"]
+    dates = ["started_at", "ended_at", "created_at", "updated_at"]
+    if any(pd.isnull(row[required + dates])) or any(row[required] == ""):
+        return "null or empty values"
+    if not loop_validate_id(row["id"]):
+        return "invalid id"
+    if not re.match(r"^[A-Za-z\s]+$", row["name"]):
+        return "invalid name"
+    if row["mode"].lower() not in ["online", "offline", "onsite"]:
+        return "invalid mode"
+    if row["subject_id"] not in valid_subject_ids:
+        return "invalid subject_id"
+    if not loop_validate_datetime(row["started_at"]):
+        return "invalid started_at"
+    if (
+        not loop_validate_datetime(row["ended_at"])
+        or row["ended_at"] <= row["started_at"]
+    ):
+        return "invalid ended_at"
+    if not loop_validate_datetime(row["created_at"]):
+        return "invalid created_at"
+    if (
+        not loop_validate_datetime(row["updated_at"])
+        or row["updated_at"] <= row["created_at"]
+    ):
+        return "invalid updated_at"
+    return None
+
+
+def loop_clean_trainings(trainings, valid_subject_ids):
+    cleaned, reasons = [], []
+    for _, row in trainings.iterrows():
+        row = strip_row(row)
+        reasons.append(loop_reason_of_training(row, valid_subject_ids))
+        if reasons[-1] is None:
+            cleaned.append({"id": row["id"].lower()})
+
+    return pd.DataFrame(cleaned, columns=["id"]), reasons
+
+
+def loop_reason_of_assessment(
+    row, valid_user_ids, valid_training_ids, subject_max_marks, training_subject_map
+):
+    required = ["user_id", "training_id", "marks", "internet_allowed"]
+    if any(pd.isnull(row[required])) or any(row[required] == ""):
+        return "null or empty values"
+    if row["user_id"] not in valid_user_ids:
+        return "invalid user_id"
+    if row["training_id"] not in valid_training_ids:
+        return "invalid training_id"
+    subject_id = training_subject_map.get(row["training_id"])
+    if not subject_id:
+        return "missing subject_id for"
+    marks = row["marks"]
+    if not (
+        isinstance(marks, (int, float))
+        and marks >= 0
+        and marks < subject_max_marks[subject_id]
+    ):
+        return "invalid marks"
+    if not isinstance(row["internet_allowed"], bool):
+        return "invalid internet_allowed value"
+    return None
+
+
+def loop_clean_assessments(assessments, *references):
+    columns = ["user_id", "training_id", "marks", "internet_allowed"]
+    cleaned, reasons = [], []
+    for _, row in assessments.iterrows():
+        row = strip_row(row)
+        reasons.append(loop_reason_of_assessment(row, *references))
+        if reasons[-1] is None:
+            cleaned.append(row[columns].to_dict())
+
+    df = pd.DataFrame(cleaned, columns=columns)
+    df["marks"] = df["marks"].astype(int)
+    return df, reasons
+
+
+# datetimes the loop and the rules are both checked on: formats fromisoformat
+# accepts or rejects, each later than the ones before it as text too, so the
+# loop's text comparisons agree with the parsed ones
+DATETIMES = [
+    "2024",
+    "2024-01",
+    "2024-1-1",
+    "2024-13-01",
+    "2024-02-30",
+    "not a date",
+    "0001-01-01",
+    "0001-01-01T00:00:00",
+    "20240101",
+    "2024-01-01",
+    "2024-01-01 10:00:00",
+    "2024-01-01T10:00:00.000001",
+    "2024-01-01T10:00:00,5",
+    "2024-W01-1",
+    "2024-001",
+    " 2024-06-01T00:00:00 ",
+    "9999-12-31",
+    "9999-12-31T23:59:59.999999",
+]
+
+# later than every datetime above within the datetime64[ns] range, as text too
+LATEST = "2262-01-01T00:00:00"
+
+
+def out_of_range(date_string):
+    """Valid to fromisoformat but outside datetime64[ns], the documented
+    deviation of the rules from the loop."""
+    try:
+        parsed = datetime.fromisoformat(date_string.strip())
+    except ValueError:
+        return False
+    return not pd.Timestamp.min <= parsed <= pd.Timestamp.max
+
+
+def user_rows():
+    base = {
+        "id": "user",
+        "email": "user@example.com",
+        "first_name": "first",
+        "middle_name": "middle",
+        "last_name": "last",
+        "role": "employee",
+        "created_at": "2020-01-01T00:00:00",
+        "updated_at": "2021-01-01T00:00:00",
+    }
+    variations = [
+        ("id", ["UPPER-id", "with space", "sym$bol", " padded ", "", " "]),
+        ("email", ["no-at-sign", "a@b", "a@b.c", " a@b.co "]),
+        ("first_name", ["", "  "]),
+        ("role", ["ADMIN", " Employee ", "manager", ""]),
+        ("created_at", DATETIMES + [""]),
+        ("updated_at", ["2019-01-01T00:00:00", "2020-01-01T00:00:00", ""]),
+    ]
+    rows = [dict(base)]
+    for column, values in variations:
+        for value in values:
+            rows.append({**base, column: value})
+    # edge datetimes as updated_at too, after the earliest created_at
+    for value in DATETIMES:
+        rows.append({**base, "created_at": "1970-01-01T00:00:00", "updated_at": value})
+    # created_at edge values against the latest updated_at
+    for value in DATETIMES:
+        rows.append({**base, "created_at": value, "updated_at": LATEST})
+
+    for index, row in enumerate(rows):
+        if row["id"] == base["id"]:
+            row["id"] = f"user{index}"
+        elif row["id"].strip():
+            stripped = row["id"].strip()
+            row["id"] = row["id"].replace(stripped, f"{stripped}{index}")
+    return rows
+
+
+def training_rows():
+    base = {
+        "id": "training",
+        "name": "Training",
+        "mode": "online",
+        "subject_id": "subject",
+        "started_at": "2020-01-01T00:00:00",
+        "ended_at": "2020-06-01T00:00:00",
+        "created_at": "2019-01-01T00:00:00",
+        "updated_at": "2019-06-01T00:00:00",
+    }
+    variations = [
+        ("name", ["Name 2", "", " Spaced Name "]),
+        ("mode", [" ONLINE ", "Onsite", "remote", ""]),
+        ("subject_id", ["unknown", "SUBJECT", " subject "]),
+        ("started_at", DATETIMES),
+        ("ended_at", DATETIMES + ["2020-01-01T00:00:00"]),
+        ("created_at", DATETIMES),
+    ]
+    rows = [dict(base)]
+    for column, values in variations:
+        for value in values:
+            row = {**base, column: value}
+            if column in ["started_at", "created_at"]:
+                later = {"started_at": "ended_at", "created_at": "updated_at"}[column]
+                row[later] = LATEST
+            if column == "ended_at":
+                row["started_at"] = "1970-01-01T00:00:00"
+            rows.append(row)
+
+    for index, row in enumerate(rows):
+        row["id"] = f"training{index}"
+    return rows
+
+
+def subject_rows():
+    base = {
+        "id": "subject",
+        "name": "Subject",
+        "min_marks": "10",
+        "max_marks": "100",
+        "total_time": "60",
+        "created_at": "2019-01-01T00:00:00",
+        "updated_at": "2019-06-01T00:00:00",
+    }
+    variations = [
+        ("id", ["sym$bol", " padded ", ""]),
+        ("name", ["Name 2", "", " Spaced Name "]),
+        ("min_marks", ["-1", "0", "100", "101", "1.5", "1e1", ""]),
+        ("max_marks", ["9", "10", "10.5", ""]),
+        ("total_time", ["-1", "0", "2.5", ""]),
+        ("updated_at", ["2019-01-01T00:00:00", "2018-01-01T00:00:00", ""]),
+    ]
+    rows = [dict(base)]
+    for column, values in variations:
+        for value in values:
+            rows.append({**base, column: value})
+    for value in DATETIMES:
+        rows.append({**base, "created_at": value, "updated_at": LATEST})
+
+    for index, row in enumerate(rows):
+        if row["id"].strip():
+            stripped = row["id"].strip()
+            row["id"] = row["id"].replace(stripped, f"{stripped}{index}")
+    return rows
+
+
+# parents the assessments are checked against, an orphan training has no subject
+USER_IDS = ["user"]
+TRAINING_SUBJECTS = {"training": "subject", "orphan": ""}
+SUBJECT_MAX_MARKS = {"subject": 50}
+
+
+def assessment_rows():
+    base = {
+        "user_id": "user",
+        "training_id": "training",
+        "marks": "10",
+        "internet_allowed": "True",
+    }
+    variations = [
+        ("user_id", ["unknown", "USER", " user ", ""]),
+        ("training_id", ["unknown", "orphan", " training ", ""]),
+        ("marks", ["-1", "0", "49", "49.5", "50", "50.5", "1e1", ""]),
+        ("internet_allowed", ["False", "true", "FALSE", ""]),
+    ]
+    rows = [dict(base)]
+    for column, values in variations:
+        for value in values:
+            rows.append({**base, column: value})
+    return rows
+
+
+def read_both(tmp_path, name, rows):
+    """Read `rows` as the loop read staged files, and as prep reads them."""
+    path = tmp_path / f"{name}.csv"
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return pd.read_csv(path), prep.read_stage_output(path, name)
+
+
+def deviating_rows(rows, columns):
+    """Positions of the rows with a datetime outside datetime64[ns]."""
+    return {
+        position
+        for position, row in enumerate(rows)
+        if any(out_of_range(row[column]) for column in columns)
+    }
+
+
+def rule_reasons(entity, count):
+    """The reason each of `count` staged rows was rejected for by the rules,
+    None for the rows kept."""
+    reasons = [None] * count
+    for part in rejects.ledger:
+        if part["entity"].iat[0] == entity:
+            for position, reason in zip(part.index, part["reason"]):
+                reasons[position] = reason
+    return reasons
+
+
+def assert_same_outcome(entity, cleaned, loop_cleaned, loop_reasons, deviating=()):
+    """The rules keep the rows the loop kept and reject every other row for the
+    reason the loop did, but for `deviating` rows they reject for a datetime."""
+    reasons = rule_reasons(entity, len(loop_reasons))
+    expected = list(loop_reasons)
+    for position in deviating:
+        assert re.fullmatch(r"invalid \w+_at", reasons[position]), position
+        expected[position] = reasons[position]
+    assert reasons == expected
+
+    kept_positions = [position for position, r in enumerate(loop_reasons) if r is None]
+    kept = [position not in deviating for position in kept_positions]
+    pd.testing.assert_frame_equal(
+        cleaned[loop_cleaned.columns].reset_index(drop=True),
+        loop_cleaned[kept].reset_index(drop=True),
+        check_dtype=False,
+    )
+
+
+@pytest.fixture(autouse=True)
+def csv_stage_files(monkeypatch):
+    monkeypatch.setattr(prep.options, "stage_format", "csv")
+    rejects.reset()
+    yield
+    rejects.reset()
+
+
+def test_users_are_cleaned_as_the_loop_did(tmp_path):
+    rows = user_rows()
+    loop_users, stage_users = read_both(tmp_path, "users", rows)
+
+    deviating = deviating_rows(rows, ["created_at", "updated_at"])
+    assert deviating, "the fixture covers out-of-range datetimes"
+    assert_same_outcome(
+        "users", prep.clean_users(stage_users), *loop_clean_users(loop_users), deviating
+    )
+
+
+def test_subjects_are_cleaned_as_the_loop_did(tmp_path):
+    rows = subject_rows()
+    loop_subjects, stage_subjects = read_both(tmp_path, "subjects", rows)
+
+    assert_same_outcome(
+        "subjects",
+        prep.clean_subjects(stage_subjects),
+        *loop_clean_subjects(loop_subjects),
+        deviating_rows(rows, ["created_at", "updated_at"]),
+    )
+
+
+def test_trainings_are_cleaned_as_the_loop_did(tmp_path):
+    rows = training_rows()
+    loop_trainings, stage_trainings = read_both(tmp_path, "trainings", rows)
+    subjects = pd.DataFrame({"id": ["subject"], "max_marks": [100]})
+
+    columns = ["started_at", "ended_at", "created_at", "updated_at"]
+    assert_same_outcome(
+        "trainings",
+        prep.clean_trainings(stage_trainings, ReferenceIndex(subjects=subjects)),
+        *loop_clean_trainings(loop_trainings, ["subject"]),
+        deviating_rows(rows, columns),
+    )
+
+
+def test_assessments_are_cleaned_as_the_loop_did(tmp_path):
+    rows = assessment_rows()
+    loop_assessments, stage_assessments = read_both(tmp_path, "assessments", rows)
+    references = ReferenceIndex(
+        users=pd.DataFrame({"id": USER_IDS}),
+        subjects=pd.DataFrame(
+            {
+                "id": list(SUBJECT_MAX_MARKS),
+                "max_marks": list(SUBJECT_MAX_MARKS.values()),
+            }
+        ),
+        trainings=pd.DataFrame(
+            {
+                "id": list(TRAINING_SUBJECTS),
+                "subject_id": list(TRAINING_SUBJECTS.values()),
+            }
+        ),
+    )
+
+    assert_same_outcome(
+        "assessments",
+        prep.clean_assessments(stage_assessments, references),
+        *loop_clean_assessments(
+            loop_assessments,
+            USER_IDS,
+            list(TRAINING_SUBJECTS),
+            SUBJECT_MAX_MARKS,
+            TRAINING_SUBJECTS,
+        ),
+    )
+
+
+def test_numbers_and_booleans_are_checked_value_by_value(tmp_path):
+    # the loop checked the types read_csv inferred for the whole column, one
+    # text value made every row of the file invalid, the rules only reject it
+    base = assessment_rows()[0]
+    rows = [
+        {**base, "marks": marks, "internet_allowed": allowed}
+        for marks, allowed in [("10", "True"), ("ten", "True"), ("10", "yes")]
+    ]
+    loop_assessments, stage_assessments = read_both(tmp_path, "assessments", rows)
+    references = ReferenceIndex(
+        users=pd.DataFrame({"id": USER_IDS}),
+        subjects=pd.DataFrame({"id": ["subject"], "max_marks": [50]}),
+        trainings=pd.DataFrame({"id": ["training"], "subject_id": ["subject"]}),
+    )
+
+    _, loop_reasons = loop_clean_assessments(
+        loop_assessments, USER_IDS, ["training"], {"subject": 50}, {"training": "subject"}
+    )
+    prep.clean_assessments(stage_assessments, references)
+
+    assert loop_reasons == ["invalid marks"] * 3
+    assert rule_reasons("assessments", 3) == [
+        None,
+        "invalid marks",
+        "invalid internet_allowed value",
+    ]
+
+
+@pytest.mark.parametrize("value", DATETIMES)
+def test_datetimes_are_valid_as_fromisoformat_reads_them(value):
+    parsed = prep.parse_datetimes(pd.Series([value.strip()], dtype=schema.TEXT))
+    expected = loop_validate_datetime(value.strip()) and not out_of_range(value)
+    assert parsed.notna().iat[0] == expected
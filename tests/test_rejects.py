@@ -0,0 +1,53 @@
+import os
+import pandas as pd
+import pytest
+from src import prep, rejects
+from src.storage import read_text_chunks
+
+
+def read_rejects():
+    path = prep.prep_output_path("rejects")
+    return next(read_text_chunks(path, None, prep.options.output_format))
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_chunked_rejects_are_spilled_and_written_as_kept_in_memory(
+    staged, monkeypatch, file_format
+):
+    monkeypatch.setattr(prep.options, "output_format", file_format)
+    monkeypatch.setattr(prep.options, "chunk_size", 30)
+
+    prep.run()
+    spilled = read_rejects()
+    assert not os.path.exists(os.path.join(prep.options.output_folder, "rejects.parts"))
+
+    # cached entities add back the rejects of the previous run
+    prep.run()
+    cached = read_rejects()
+
+    monkeypatch.setattr(prep.options, "output_folder", str(staged / "in_memory"))
+    monkeypatch.setattr(prep, "reset_rejects", rejects.reset)
+    prep.run()
+    kept = read_rejects()
+
+    assert set(kept["entity"]) == {"users", "subjects", "trainings", "assessments"}
+    pd.testing.assert_frame_equal(spilled, kept)
+    pd.testing.assert_frame_equal(cached, kept)
+
+
+def test_spilled_rows_are_not_kept_in_memory(tmp_path):
+    rejects.reset(str(tmp_path / "parts"), "csv", 2)
+    try:
+        rejects.add("users", "invalid email", pd.DataFrame({"id": ["a", "b", "c"]}))
+        rejects.extend([pd.DataFrame({"entity": ["subjects"], "reason": ["x"]})])
+        assert rejects.ledger == []
+
+        count = rejects.write(str(tmp_path / "rejects.csv"))
+    finally:
+        rejects.reset()
+
+    assert count == 4
+    written = pd.read_csv(tmp_path / "rejects.csv", dtype=str, keep_default_na=False)
+    assert written.columns.tolist() == ["entity", "reason", "id"]
+    assert written["entity"].tolist() == ["users"] * 3 + ["subjects"]
+    assert not (tmp_path / "parts").exists()
@@ -0,0 +1,111 @@
+import os
+import pandas as pd
+import pytest
+from src import cache, prep, report, schema, stage
+from src.aggregates import TABLES
+from src.storage import file_name, read_partitioned, read_text_chunks
+
+
+def update_staged(name, change):
+    """Save the staged `name` as changed by `change`, as if stage read new inputs."""
+    staged = dict(zip(schema.ENTITIES, prep.load_stage_outputs()))[name]
+    stage.save_stage_output(name, change(staged.copy()))
+
+
+def in_order(df):
+    """`df` in an order that does not depend on how it was written."""
+    df = df[sorted(df.columns)]
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def report_outputs():
+    """The report rows and every aggregate table, as written."""
+    if report.options.partition_by is None:
+        rows = pd.concat(read_text_chunks(report.report_path()))
+    else:
+        rows = read_partitioned(report.report_path())
+    outputs = {"report": rows}
+    for table in TABLES:
+        path = os.path.join(
+            report.aggregates_dir(), file_name(table, report.options.report_format)
+        )
+        outputs[table] = next(read_text_chunks(path))
+    return {name: in_order(df) for name, df in outputs.items()}
+
+
+def full_outputs(tmp_path):
+    """The report outputs of a full run over the same prep outputs."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(report.options, "incremental", False)
+        patch.setattr(report.options, "report_dir", str(tmp_path / "full"))
+        patch.setattr(cache.options, "manifest_file", str(tmp_path / "full.json"))
+        report.run()
+        return report_outputs()
+
+
+def update(staged, caplog):
+    """Run prep and report again, checking the report was updated in place."""
+    caplog.clear()
+    prep.run()
+    report.run()
+    assert "Report updated" in caplog.text
+    assert_same_outputs(full_outputs(staged))
+
+
+def assert_same_outputs(expected):
+    outputs = report_outputs()
+    assert len(outputs["report"]) > 0
+    for name, df in outputs.items():
+        pd.testing.assert_frame_equal(df, expected[name], obj=name)
+
+
+@pytest.mark.parametrize("partition_by", [None, "subject_id"])
+def test_incremental_reports_over_deltas_match_full_runs(
+    staged, monkeypatch, caplog, partition_by
+):
+    monkeypatch.setattr(prep.options, "incremental", True)
+    monkeypatch.setattr(report.options, "incremental", True)
+    monkeypatch.setattr(report.options, "partition_by", partition_by)
+    prep.run()
+    report.run()
+    assert_same_outputs(full_outputs(staged))
+
+    # nothing changed, the next changes still follow the report
+    prep.run()
+    report.run()
+
+    # assessments are added
+    update_staged("assessments", lambda df: pd.concat([df, df.iloc[:100]]))
+    update(staged, caplog)
+
+    # a user is updated, the rows of their assessments are replaced
+    user_id = prep.load_prep_outputs()[3]["user_id"].iloc[0]
+
+    def rename(users):
+        rows = users["id"].str.strip().str.lower() == user_id
+        users.loc[rows, ["first_name", "updated_at"]] = ["Renamed", "2025-06-01"]
+        return users
+
+    update_staged("users", rename)
+    update(staged, caplog)
+
+    # a subject turns invalid, the rows of its trainings are removed
+    _, _, trainings, assessments = prep.load_prep_outputs()
+    training_id = assessments["training_id"].iloc[0]
+    subject_id = trainings.set_index("id").loc[training_id, "subject_id"]
+
+    def invalidate(subjects):
+        rows = subjects["id"].str.strip().str.lower() == subject_id
+        subjects.loc[rows, ["min_marks", "updated_at"]] = ["-1", "2025-07-01"]
+        return subjects
+
+    update_staged("subjects", invalidate)
+    rows = len(report_outputs()["report"])
+    update(staged, caplog)
+    assert len(report_outputs()["report"]) < rows
+
+    # the staged assessments shrink, the report is rebuilt
+    update_staged("assessments", lambda df: df.iloc[:500])
+    prep.run()
+    report.run()
+    assert_same_outputs(full_outputs(staged))
@@ -0,0 +1,92 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from src import prep, report, service
+
+
+@pytest.fixture
+def server(staged, monkeypatch):
+    """Serve the report of the generated dataset on an ephemeral port."""
+    monkeypatch.setattr(service.options, "check_seconds", 0)
+    prep.run()
+    report.run()
+
+    server = service.serve(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path):
+    host, port = server.server_address[:2]
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}{path}") as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as error:
+        return error.code, json.load(error)
+
+
+def test_scores_are_the_report_rows_of_the_id(server):
+    report_data = service.read_report()
+    user_id = report_data["user_id"].iat[0]
+    training_id = report_data["training_id"].iat[0]
+    subject_id = report_data["subject_id"].iat[0]
+
+    status, user = get(server, f"/users/{user_id.upper()}/scores")
+    assert status == 200
+    rows = report_data[report_data["user_id"] == user_id]
+    assert user["user_id"] == user_id
+    assert user["email"] == rows["email"].iat[0]
+    assert user["summary"]["count"] == len(rows)
+    assert user["summary"]["passed"] == int(rows["is_passed"].sum())
+    assert [score["training_id"] for score in user["scores"]] == rows[
+        "training_id"
+    ].tolist()
+
+    status, training = get(server, f"/trainings/{training_id}/scores")
+    assert status == 200
+    rows = report_data[report_data["training_id"] == training_id]
+    assert training["summary"]["count"] == len(rows)
+    assert training["summary"]["mean_marks"] == pytest.approx(rows["marks"].mean())
+
+    status, subject = get(server, f"/subjects/{subject_id}/scores")
+    assert status == 200
+    assert subject["summary"]["count"] == (report_data["subject_id"] == subject_id).sum()
+
+
+def test_unknown_ids_and_paths_are_not_found(server):
+    status, body = get(server, "/users/nobody/scores")
+    assert status == 404
+    assert body == {"error": "unknown users id 'nobody'"}
+
+    for path in ["/", "/users", "/users/x/marks", "/courses/x/scores"]:
+        status, body = get(server, path)
+        assert status == 404
+        assert "unknown path" in body["error"]
+
+
+def test_results_are_cached_per_report(server):
+    user_id = service.read_report()["user_id"].iat[0]
+
+    get(server, f"/users/{user_id}/scores")
+    get(server, f"/users/{user_id}/scores")
+    status, health = get(server, "/health")
+    assert status == 200
+    assert health["rows"] == len(service.read_report())
+    assert health["cache"]["user_scores"]["hits"] == 1
+    assert health["cache"]["user_scores"]["misses"] == 1
+
+    # a new report is loaded into a new index, with an empty cache
+    report_data = service.read_report()
+    report.write_report(report_data[report_data["user_id"] != user_id])
+
+    status, body = get(server, f"/users/{user_id}/scores")
+    assert status == 200
+    assert body["summary"]["count"] == 0
+    status, health = get(server, "/health")
+    assert health["rows"] == len(service.read_report())
+    assert health["cache"]["user_scores"]["hits"] == 0